@@ -0,0 +1,118 @@
+from __future__ import division
+import torch
+from models.beam_search.processors import LogitsProcessor
+
+# Token ids are packed into one int64 key per (n-1)-gram, 20 bits per token.
+KEY_BITS = 20
+
+
+class NGramBlocker(LogitsProcessor):
+    """
+    Token-id level n-gram blocking for batched beam search.
+
+    For every hypothesis the blocker keeps the keys of all the (n-1)-grams
+    generated so far together with the token that followed each of them.
+    The tokens that would repeat an n-gram are the followers of the keys
+    equal to the key of the current (n-1)-gram suffix, which gives the ban
+    mask of the whole batch with one comparison and one scatter.
+
+    The state is aligned with the rows of `alive_seq` and has to be
+    reordered and pruned alongside it.
+
+    Args:
+       ngram_size (int): size of the blocked n-grams (at most 4)
+       beam_size (int): number of hypotheses per example
+    """
+
+    def __init__(self, ngram_size, beam_size, batch_size, device):
+        assert 1 < ngram_size <= 64 // KEY_BITS + 1
+        self.ngram_size = ngram_size
+        self.beam_size = beam_size
+        self.keys = torch.zeros((batch_size * beam_size, 0), dtype=torch.long, device=device)
+        self.next_tokens = torch.zeros((batch_size * beam_size, 0), dtype=torch.long, device=device)
+
+    def _encode(self, tokens):
+        key = tokens[:, 0]
+        for i in range(1, tokens.size(1)):
+            key = (key << KEY_BITS) | tokens[:, i]
+        return key
+
+    def reorder(self, select_indices):
+        "Follow the hypotheses selected at the current step."
+        self.keys = self.keys.index_select(0, select_indices)
+        self.next_tokens = self.next_tokens.index_select(0, select_indices)
+
+    def prune(self, rows):
+        "Drop the hypotheses of the finished examples."
+        self.keys = self.keys.index_select(0, rows)
+        self.next_tokens = self.next_tokens.index_select(0, rows)
+
+    def merge(self, other):
+        "Append the hypotheses of another search, the keys are padded with -1 which never matches."
+        width = max(self.keys.size(1), other.keys.size(1))
+        self.keys = torch.cat([torch.nn.functional.pad(keys, (0, width - keys.size(1)), value=-1)
+                               for keys in [self.keys, other.keys]])
+        self.next_tokens = torch.cat([torch.nn.functional.pad(tokens, (0, width - tokens.size(1)))
+                                      for tokens in [self.next_tokens, other.next_tokens]])
+
+    def advance(self, alive_seq):
+        "Record the n-gram closed by the token just appended to `alive_seq`."
+        if alive_seq.size(1) < self.ngram_size:
+            return
+        key = self._encode(alive_seq[:, -self.ngram_size:-1])
+        self.keys = torch.cat([self.keys, key.unsqueeze(1)], -1)
+        self.next_tokens = torch.cat([self.next_tokens, alive_seq[:, -1:]], -1)
+
+    def ban_mask(self, alive_seq, vocab_size):
+        """
+        Returns a `(batch * beam, vocab_size)` boolean mask of the tokens
+        that would repeat an n-gram, or None if nothing can be repeated yet.
+        """
+        # Larger ids would overflow into the bits of the previous token.
+        assert vocab_size <= 1 << KEY_BITS, \
+            'n-gram blocking packs token ids on %d bits, the vocabulary has %d tokens' % (KEY_BITS, vocab_size)
+        if self.keys.size(1) == 0:
+            return None
+        key = self._encode(alive_seq[:, -(self.ngram_size - 1):])
+        hit = self.keys.eq(key.unsqueeze(1))
+        # Misses are sent to an extra column which is dropped afterwards.
+        banned = self.next_tokens.masked_fill(~hit, vocab_size)
+        mask = torch.zeros((alive_seq.size(0), vocab_size + 1), dtype=torch.bool, device=alive_seq.device)
+        mask.scatter_(1, banned, True)
+        return mask[:, :vocab_size]
+
+    def __call__(self, step, log_probs, alive_seq):
+        banned = self.ban_mask(alive_seq, log_probs.size(-1))
+        if banned is not None:
+            log_probs = log_probs.masked_fill(banned, -10e20)
+        return log_probs
+
+    def update(self, step, select_indices, alive_seq, topk_log_probs):
+        self.reorder(select_indices)
+        self.advance(alive_seq)
+        return None
+
+
+def repeat_token_mask(alive_seq, vocab_size):
+    """
+    Returns a `(batch * beam, vocab_size)` boolean mask banning the
+    immediate repetition of the last token, or None on the first step.
+    """
+    if alive_seq.size(1) < 2:
+        return None
+    mask = torch.zeros((alive_seq.size(0), vocab_size), dtype=torch.bool, device=alive_seq.device)
+    mask.scatter_(1, alive_seq[:, -1:], True)
+    return mask
+
+
+class RepeatTokenBlocker(LogitsProcessor):
+    "Bans the immediate repetition of the last token."
+
+    def __call__(self, step, log_probs, alive_seq):
+        banned = repeat_token_mask(alive_seq, log_probs.size(-1))
+        if banned is not None:
+            log_probs = log_probs.masked_fill(banned, -10e20)
+        return log_probs
+
+    def merge(self, other):
+        pass
@@ -0,0 +1,297 @@
+from __future__ import division
+import torch
+
+
+def tile(x, count, dim=0):
+    """
+    Tiles x on dimension dim count times.
+    """
+    perm = list(range(len(x.size())))
+    if dim != 0:
+        perm[0], perm[dim] = perm[dim], perm[0]
+        x = x.permute(perm).contiguous()
+    out_size = list(x.size())
+    out_size[0] *= count
+    batch = x.size(0)
+    x = x.view(batch, -1) \
+         .transpose(0, 1) \
+         .repeat(count, 1) \
+         .transpose(0, 1) \
+         .contiguous() \
+         .view(*out_size)
+    if dim != 0:
+        x = x.permute(perm).contiguous()
+    return x
+
+
+class LogitsProcessor(object):
+    """
+    Base class of the behaviors plugged into :obj:`BeamSearch`.
+
+    A processor edits the log probabilities of every step before they are
+    added to the beam scores and topk is taken (`__call__`), follows the
+    hypotheses selected at the step (`update`), drops the examples which
+    are done (`prune`) and takes the examples of another search (`merge`).
+    All its states are aligned with the rows of `alive_seq`, i.e.
+    batch * beam.
+
+    `monotonic` tells that the processor never raises the beam scores,
+    which lets the search stop an example once its best hypothesis is final.
+    """
+
+    monotonic = True
+
+    def __call__(self, step, log_probs, alive_seq):
+        return log_probs
+
+    def update(self, step, select_indices, alive_seq, topk_log_probs):
+        """
+        Called once the selected tokens are appended to `alive_seq`.
+        The last column of `alive_seq` and the `(batch, beam)` beam scores
+        can be amended in place. Returns a `(batch * beam)` boolean mask of
+        the hypotheses to finish, or None.
+        """
+        return None
+
+    def prune(self, rows):
+        "Keeps the `rows` (hypotheses) of the remaining examples."
+        pass
+
+    def merge(self, other):
+        """
+        Appends the rows of `other`, the same processor of another search.
+        Its hypotheses may have run a different number of steps.
+        """
+        raise NotImplementedError('%s can not be merged' % type(self).__name__)
+
+
+class MinLengthProcessor(LogitsProcessor):
+    """
+    Bans `token_ids` during the first `min_length` steps of every hypothesis.
+    """
+
+    def __init__(self, min_length, token_ids):
+        self.min_length = min_length
+        self.token_ids = token_ids
+        # Steps run by every hypothesis, set on the first step.
+        self.steps = None
+
+    def __call__(self, step, log_probs, alive_seq):
+        if self.steps is None:
+            self.steps = torch.zeros(log_probs.size(0), dtype=torch.long, device=log_probs.device)
+        too_short = (self.steps < self.min_length).unsqueeze(1)
+        log_probs[:, self.token_ids] = log_probs[:, self.token_ids].masked_fill(too_short, -1e20)
+        return log_probs
+
+    def update(self, step, select_indices, alive_seq, topk_log_probs):
+        self.steps = self.steps.index_select(0, select_indices) + 1
+        return None
+
+    def prune(self, rows):
+        self.steps = self.steps.index_select(0, rows)
+
+    def merge(self, other):
+        self.steps = torch.cat([self.steps, other.steps])
+
+
+class PlanConstraintProcessor(LogitsProcessor):
+    """
+    Plan generation: only the predicates of the source (and the plan
+    separator) can be generated, each of them at most once. A hypothesis
+    finishes once it has generated as many predicates as the source has.
+    """
+
+    def __init__(self, src, beam_size, vocab_size, start_token_id, plan_sep_token_id,
+                 predicates_start_from_id=32100):
+        self.beam_size = beam_size
+        self.plan_sep_token_id = plan_sep_token_id
+
+        is_predicate = src > predicates_start_from_id
+        allowed = torch.zeros((src.size(0), vocab_size), dtype=torch.bool, device=src.device)
+        allowed.scatter_(1, src, is_predicate)
+        allowed[:, plan_sep_token_id] = True
+        self.allowed = tile(allowed, beam_size, dim=0)
+        self.used = torch.zeros_like(self.allowed)
+        self.used[:, start_token_id] = True
+        self.src_pred_num = tile(is_predicate.sum(dim=1), beam_size, dim=0)
+
+    def __call__(self, step, log_probs, alive_seq):
+        return log_probs.masked_fill(self.used | ~self.allowed, -1e20)
+
+    def update(self, step, select_indices, alive_seq, topk_log_probs):
+        self.allowed = self.allowed.index_select(0, select_indices)
+        self.src_pred_num = self.src_pred_num.index_select(0, select_indices)
+        self.used = self.used.index_select(0, select_indices)
+        self.used.scatter_(1, alive_seq[:, -1:], True)
+        self.used[:, self.plan_sep_token_id] = False
+        generate_length = (alive_seq != self.plan_sep_token_id).sum(dim=1)
+        return generate_length > self.src_pred_num
+
+    def prune(self, rows):
+        self.allowed = self.allowed.index_select(0, rows)
+        self.used = self.used.index_select(0, rows)
+        self.src_pred_num = self.src_pred_num.index_select(0, rows)
+
+
+class SentencePlanProcessor(LogitsProcessor):
+    """
+    Sentence-by-sentence generation: tracks which target sentence every
+    hypothesis is generating (sentences end with `cls_token_id`) and
+    finishes it once all the `num_sents` sentences of its example are done.
+
+    Args:
+       num_sents (LongTensor): `(batch,)` number of target sentences
+       min_sent_length (int): sentences can not end before this length
+       force_end_token (bool): write the end token in the hypotheses
+            that are finished by the plan
+    """
+
+    def __init__(self, num_sents, beam_size, cls_token_id, end_token_id,
+                 min_sent_length=0, force_end_token=False):
+        self.beam_size = beam_size
+        self.cls_token_id = cls_token_id
+        self.end_token_id = end_token_id
+        self.min_sent_length = min_sent_length
+        self.force_end_token = force_end_token
+
+        device = num_sents.device
+        batch_size = num_sents.size(0)
+        self.num_sents = tile(num_sents, beam_size, dim=0)
+        self.example_ids = tile(torch.arange(batch_size, device=device), beam_size, dim=0)
+        self.sentence_idx = torch.zeros(batch_size * beam_size, dtype=torch.long, device=device)
+        self.sent_length = torch.zeros(batch_size * beam_size, dtype=torch.long, device=device)
+
+    def current_sentence(self):
+        "Sentence generated by every hypothesis (the last one once it is done)."
+        return torch.min(self.sentence_idx, self.num_sents - 1)
+
+    def __call__(self, step, log_probs, alive_seq):
+        self.sent_length += 1
+        if self.min_sent_length > 0:
+            log_probs[:, self.cls_token_id] = log_probs[:, self.cls_token_id].masked_fill(
+                self.sent_length < self.min_sent_length, -1e20)
+        return log_probs
+
+    def update(self, step, select_indices, alive_seq, topk_log_probs):
+        self.num_sents = self.num_sents.index_select(0, select_indices)
+        self.example_ids = self.example_ids.index_select(0, select_indices)
+        self.sentence_idx = self.sentence_idx.index_select(0, select_indices)
+        self.sent_length = self.sent_length.index_select(0, select_indices)
+
+        sent_finished = alive_seq[:, -1].eq(self.cls_token_id)
+        self.sentence_idx += sent_finished.long()
+        self.sent_length = self.sent_length.masked_fill(sent_finished, 0)
+        done = self.sentence_idx >= self.num_sents
+        if self.force_end_token:
+            alive_seq[:, -1] = alive_seq[:, -1].masked_fill(done, self.end_token_id)
+        return done
+
+    def prune(self, rows):
+        self.num_sents = self.num_sents.index_select(0, rows)
+        self.example_ids = self.example_ids.index_select(0, rows)
+        self.sentence_idx = self.sentence_idx.index_select(0, rows)
+        self.sent_length = self.sent_length.index_select(0, rows)
+
+
+class PromptForcingProcessor(LogitsProcessor):
+    """
+    Forces the target prefix up to the first plan separator (the prompt)
+    on the first beam of every example, and counts the minimum length
+    from the end of the prompt. Inside the prompt only the prompt token
+    keeps a finite score, so it has to come after the processors which
+    ban tokens.
+    """
+
+    def __init__(self, tgt, beam_size, plan_sep_token_id, end_token_id, min_length):
+        self.beam_size = beam_size
+        self.end_token_id = end_token_id
+        self.min_length = min_length
+
+        is_sep = tgt.eq(plan_sep_token_id)
+        is_sep[:, 0] = False
+        prompt_length = is_sep.int().argmax(dim=1) * is_sep.any(dim=1)
+        self.prompt_length = tile(prompt_length, beam_size, dim=0)
+        self.tgt = tile(tgt, beam_size, dim=0)
+
+    def __call__(self, step, log_probs, alive_seq):
+        log_probs[:, self.end_token_id] = log_probs[:, self.end_token_id].masked_fill(
+            step - self.prompt_length < self.min_length, -10e20)
+
+        in_prompt = self.prompt_length > step
+        prompt_ids = self.tgt[:, min(step + 1, self.tgt.size(1) - 1)]
+        forced = torch.full_like(log_probs, float("-inf"))
+        forced.scatter_(1, prompt_ids.unsqueeze(1), 0.0)
+        return torch.where(in_prompt.unsqueeze(1), forced, log_probs)
+
+    def update(self, step, select_indices, alive_seq, topk_log_probs):
+        self.prompt_length = self.prompt_length.index_select(0, select_indices)
+        self.tgt = self.tgt.index_select(0, select_indices)
+        return None
+
+    def prune(self, rows):
+        self.prompt_length = self.prompt_length.index_select(0, rows)
+        self.tgt = self.tgt.index_select(0, rows)
+
+
+class PlanForcingProcessor(LogitsProcessor):
+    """
+    Interleaved plan and text generation. At the beginning of every
+    sentence the tokens of its plan (ended by `plan_end_id`) are given
+    full probability; a hypothesis finishes when it completes a sentence
+    and the plans of its example are exhausted. It has to come after the
+    processors which ban tokens.
+
+    Args:
+       sentence_plans (list of LongTensor): plan tokens of every example,
+            ended by the end token
+    """
+
+    def __init__(self, sentence_plans, beam_size, cls_token_id, end_token_id, plan_end_id, min_sent_length):
+        self.beam_size = beam_size
+        self.cls_token_id = cls_token_id
+        self.end_token_id = end_token_id
+        self.plan_end_id = plan_end_id
+        self.min_sent_length = min_sent_length
+
+        # Plans padded with the end token into one (batch, plan_len) tensor.
+        self.sentence_plans = torch.nn.utils.rnn.pad_sequence(sentence_plans,
+                                                              batch_first=True,
+                                                              padding_value=end_token_id)
+        batch_size = self.sentence_plans.size(0)
+        device = self.sentence_plans.device
+        self.example_ids = tile(torch.arange(batch_size, device=device), beam_size, dim=0)
+        self.plan_idx = torch.zeros(batch_size * beam_size, dtype=torch.long, device=device)
+        self.is_plan_tokens = torch.ones(batch_size * beam_size, dtype=torch.bool, device=device)
+        self.sent_length = torch.zeros(batch_size * beam_size, dtype=torch.long, device=device)
+
+    def __call__(self, step, log_probs, alive_seq):
+        self.sent_length += (~self.is_plan_tokens).long()
+        log_probs[:, self.cls_token_id] = log_probs[:, self.cls_token_id].masked_fill(
+            self.sent_length < self.min_sent_length, -1e20)
+
+        token_in_plan = self.sentence_plans[self.example_ids, self.plan_idx]
+        read_plan_token = self.is_plan_tokens & token_in_plan.ne(self.end_token_id)
+        plan_scores = log_probs.gather(1, token_in_plan.unsqueeze(1))
+        plan_scores = plan_scores.masked_fill(read_plan_token.unsqueeze(1), 0.0)
+        log_probs.scatter_(1, token_in_plan.unsqueeze(1), plan_scores)
+        self.is_plan_tokens = self.is_plan_tokens & ~(read_plan_token & token_in_plan.eq(self.plan_end_id))
+        self.plan_idx = (self.plan_idx + read_plan_token.long()).clamp(max=self.sentence_plans.size(1) - 1)
+        return log_probs
+
+    def update(self, step, select_indices, alive_seq, topk_log_probs):
+        self.example_ids = self.example_ids.index_select(0, select_indices)
+        self.plan_idx = self.plan_idx.index_select(0, select_indices)
+        self.is_plan_tokens = self.is_plan_tokens.index_select(0, select_indices)
+        self.sent_length = self.sent_length.index_select(0, select_indices)
+
+        sent_finished = alive_seq[:, -1].eq(self.cls_token_id)
+        self.sent_length = self.sent_length.masked_fill(sent_finished, 0)
+        self.is_plan_tokens = self.is_plan_tokens | sent_finished
+        token_in_plan = self.sentence_plans[self.example_ids, self.plan_idx]
+        return sent_finished & token_in_plan.eq(self.end_token_id)
+
+    def prune(self, rows):
+        self.example_ids = self.example_ids.index_select(0, rows)
+        self.plan_idx = self.plan_idx.index_select(0, rows)
+        self.is_plan_tokens = self.is_plan_tokens.index_select(0, rows)
+        self.sent_length = self.sent_length.index_select(0, rows)
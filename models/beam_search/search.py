@@ -0,0 +1,318 @@
+from __future__ import division
+import torch
+
+
+def prune_beams(x, beam_size, non_finished):
+    """
+    Keeps the beams of the examples in `non_finished` from a state whose
+    first dimension is `batch * beam_size`.
+    """
+    size = list(x.size())
+    x = x.view([-1, beam_size] + size[1:]).index_select(0, non_finished)
+    return x.view([-1] + size[1:])
+
+
+def select_examples(x, select_indices, beam_size, tiled=True):
+    """
+    Follows the hypotheses selected by `select_indices` for a state which
+    is identical for all the beams of an example (encoder outputs, masks,
+    cross-attention key/values). Such a state is unchanged by beam
+    reordering, so it is only copied when finished examples are dropped.
+    `tiled` tells whether `x` has one row per hypothesis or per example.
+    """
+    batch_size = x.size(0) // beam_size if tiled else x.size(0)
+    if select_indices.size(0) == batch_size * beam_size:
+        return x
+    keep = torch.div(select_indices.view(-1, beam_size)[:, 0], beam_size, rounding_mode='floor')
+    if tiled:
+        return prune_beams(x, beam_size, keep)
+    return x.index_select(0, keep)
+
+
+def reorder_cache(past_key_values, select_indices, beam_size):
+    """
+    Reorders the cached decoder key/value states along the batch dimension.
+    Self-attention states follow the hypotheses, cross-attention states
+    are shared by the beams and only pruned.
+    """
+    reordered_past = ()
+    for layer_past in past_key_values:
+        self_attn_past = tuple(state.index_select(0, select_indices) for state in layer_past[:2])
+        cross_attn_past = tuple(select_examples(state, select_indices, beam_size,
+                                                tiled=(state.size(0) == layer_past[0].size(0)))
+                                for state in layer_past[2:])
+        reordered_past = reordered_past + (self_attn_past + cross_attn_past,)
+    return reordered_past
+
+
+def _pad(x, dim, length, left=False, value=0):
+    "Pads `x` to `length` on dimension `dim`."
+    pad = [0, 0] * (x.dim() - dim - 1) + ([length - x.size(dim), 0] if left else [0, length - x.size(dim)])
+    return torch.nn.functional.pad(x, pad, value=value)
+
+
+def merge_caches(past_key_values, other_past_key_values):
+    """
+    Concatenates the decoder caches of two searches along the batch
+    dimension. The self-attention states are left-padded to the longest
+    prefix, the cross-attention states are padded to the longest memory
+    (the padded memory positions have to be masked).
+    """
+    merged_past = ()
+    for layer_past, other_layer_past in zip(past_key_values, other_past_key_values):
+        merged_layer_past = ()
+        for i, (state, other_state) in enumerate(zip(layer_past, other_layer_past)):
+            length = max(state.size(2), other_state.size(2))
+            merged_layer_past = merged_layer_past + (torch.cat([_pad(state, 2, length, left=(i < 2)),
+                                                                _pad(other_state, 2, length, left=(i < 2))]),)
+        merged_past = merged_past + (merged_layer_past,)
+    return merged_past
+
+
+def trim_cache(past_key_values, num_positions):
+    "Drops the first `num_positions` positions of the self-attention states."
+    return tuple(tuple(state[:, :, num_positions:] for state in layer_past[:2]) + tuple(layer_past[2:])
+                 for layer_past in past_key_values)
+
+
+class BeamSearch(object):
+    """
+    Batched beam search shared by all the inference modes.
+
+    The model is run through two callbacks:
+    `step_fn(step, decoder_input, past_key_values)` returns the
+    `(batch * beam, vocab)` log probabilities of the next token and the
+    decoder cache, and `reorder_fn(select_indices)` reorders the other
+    model states (encoder outputs, masks) along with the hypotheses. The
+    search owns the cache: with `use_cache`, `decoder_input` is only the
+    newest token once a cache exists, and the cache is reordered with
+    `reorder_cache_fn`; otherwise it is the whole `alive_seq` and
+    `past_key_values` is None. The behaviors of the inference modes are
+    given as a list of :obj:`LogitsProcessor`.
+
+    The search is run at once with `search`, or one step at a time with
+    `start` and `advance`. Examples leave the search as soon as their best
+    hypothesis is final, unless a processor can raise the beam scores (see
+    `LogitsProcessor.monotonic`). `merge` adds the examples of another
+    search to a running one: the hypotheses of an example start at column
+    `start_positions[i]` of `alive_seq`, the columns before are padding.
+
+    Args:
+       beam_size (int): number of hypotheses per example
+       batch_size (int): number of examples
+       start_token_id, end_token_id (int): first token and end of hypothesis
+       max_length (int): maximum number of decoding steps
+       device (torch.device): device of the search
+       processors (list): :obj:`LogitsProcessor` applied in order
+       use_cache (bool): decode incrementally with the decoder cache
+       reorder_cache_fn (function): `(past_key_values, select_indices, beam_size)`
+            reordering of the cache
+    """
+
+    def __init__(self, beam_size, batch_size, start_token_id, end_token_id,
+                 max_length, device, processors=None, use_cache=False,
+                 reorder_cache_fn=reorder_cache):
+        self.beam_size = beam_size
+        self.batch_size = batch_size
+        self.start_token_id = start_token_id
+        self.end_token_id = end_token_id
+        self.max_length = max_length
+        self.device = device
+        self.processors = processors if processors is not None else []
+        self.use_cache = use_cache
+        self.reorder_cache_fn = reorder_cache_fn
+
+    @property
+    def num_alive(self):
+        "Number of examples still decoding."
+        return self.example_ids.size(0)
+
+    def search(self, step_fn, reorder_fn):
+        """
+        Runs the search to the end. `results["scores"][b]` and
+        `results["predictions"][b]` are one-element lists, the format of
+        the predictors.
+        """
+        results = {"scores": [None] * self.batch_size,
+                   "predictions": [None] * self.batch_size}
+        self.start()
+        while self.num_alive > 0:
+            for b, score, prediction in self.advance(step_fn, reorder_fn):
+                results["scores"][b] = [score]
+                results["predictions"][b] = [prediction]
+        return results
+
+    def start(self):
+        beam_size = self.beam_size
+        batch_size = self.batch_size
+        device = self.device
+
+        self.step = 0
+        self.num_examples = batch_size
+        self.example_ids = torch.arange(batch_size, dtype=torch.long, device=device)
+        self.start_positions = torch.zeros(batch_size, dtype=torch.long, device=device)
+        self.alive_seq = torch.full([batch_size * beam_size, 1], self.start_token_id, dtype=torch.long, device=device)
+
+        # Give full probability to the first beam on the first step.
+        self.topk_log_probs = (torch.tensor([0.0] + [float("-inf")] * (beam_size - 1), device=device).repeat(batch_size, 1))
+
+        # Best finished hypothesis of every example.
+        self.best_scores = torch.full([batch_size], float("-inf"), device=device)
+        self.best_lengths = torch.zeros(batch_size, dtype=torch.long, device=device)
+        self.best_seq = torch.full([batch_size, self.max_length], self.end_token_id, dtype=torch.long, device=device)
+        self.early_exit = all(processor.monotonic for processor in self.processors)
+        self.past_key_values = None
+
+    def advance(self, step_fn, reorder_fn):
+        """
+        Runs one decoding step. Returns the `(example id, score, prediction)`
+        of the examples which left the search at this step.
+        """
+        beam_size = self.beam_size
+        step = self.step
+        alive_seq = self.alive_seq
+        past_key_values = self.past_key_values
+        beam_offset = torch.arange(0, self.num_alive * beam_size, step=beam_size, dtype=torch.long, device=self.device)
+        beam_arange = torch.arange(beam_size, dtype=torch.long, device=self.device)
+
+        if past_key_values is not None:
+            # Only the newest token is fed, the prefix lives in the cache.
+            decoder_input = alive_seq[:, -1:]
+        else:
+            decoder_input = alive_seq
+        log_probs, past_key_values = step_fn(step, decoder_input, past_key_values)
+        if not self.use_cache:
+            past_key_values = None
+        for processor in self.processors:
+            log_probs = processor(step, log_probs, alive_seq)
+        vocab_size = log_probs.size(-1)
+
+        # Multiply probs by the beam probability.
+        log_probs += self.topk_log_probs.view(-1).unsqueeze(1)
+
+        # Flatten probs into a list of possibilities.
+        curr_scores = log_probs.reshape(-1, beam_size * vocab_size)
+        topk_scores, topk_ids = curr_scores.topk(beam_size, dim=-1)
+        topk_log_probs = topk_scores.clone()
+
+        # Resolve beam origin and true word ids.
+        topk_beam_index = torch.div(topk_ids, vocab_size, rounding_mode='floor')
+        topk_ids = topk_ids.fmod(vocab_size)
+
+        # Map beam_index to batch_index in the flat representation.
+        batch_index = (topk_beam_index + beam_offset.unsqueeze(1))
+        select_indices = batch_index.view(-1)
+
+        # Append last prediction.
+        alive_seq = torch.cat(
+            [alive_seq.index_select(0, select_indices),
+             topk_ids.view(-1, 1)], -1)
+
+        # Processors follow the selected hypotheses and may finish them.
+        is_finished = alive_seq[:, -1].eq(self.end_token_id)
+        for processor in self.processors:
+            finished = processor.update(step, select_indices, alive_seq, topk_log_probs)
+            if finished is not None:
+                is_finished = is_finished | finished
+        is_finished = is_finished.view(-1, beam_size)
+
+        # Number of tokens generated for every example.
+        lengths = alive_seq.size(-1) - 1 - self.start_positions
+        is_finished = is_finished | lengths.ge(self.max_length).unsqueeze(1)
+        # End condition is top beam is finished.
+        end_condition = is_finished[:, 0].eq(1)
+        # Save finished hypotheses.
+        if is_finished.any():
+            is_finished = is_finished | end_condition.unsqueeze(1)
+            predictions = alive_seq.view(-1, beam_size, alive_seq.size(-1))
+
+            # Only the best finished hypothesis of each example can be kept.
+            finished_scores = topk_scores.masked_fill(~is_finished, float("-inf"))
+            step_best_scores, step_best_beam = finished_scores.max(dim=-1)
+            improved = step_best_scores > self.best_scores
+            improved_rows = improved.nonzero().view(-1)
+            if len(improved_rows) > 0:
+                self.best_scores[improved_rows] = step_best_scores.index_select(0, improved_rows)
+                self.best_lengths[improved_rows] = lengths.index_select(0, improved_rows)
+                # Tokens after the start token, the hypotheses of an
+                # example may start after some padding.
+                positions = self.start_positions.index_select(0, improved_rows).unsqueeze(1) + 1 + \
+                    torch.arange(self.max_length, device=self.device).unsqueeze(0)
+                tokens = predictions[improved_rows, step_best_beam[improved_rows]].gather(
+                    1, positions.clamp(max=alive_seq.size(-1) - 1))
+                tokens = tokens.masked_fill(positions >= alive_seq.size(-1), self.end_token_id)
+                self.best_seq[improved_rows] = tokens
+
+        if self.early_exit:
+            # Beam scores never increase, an example is done as soon as
+            # its best finished hypothesis is not worse than all its beams.
+            end_condition = end_condition | self.best_scores.ge(topk_scores.max(dim=-1)[0])
+
+        done = []
+        if end_condition.any():
+            for i in end_condition.nonzero().view(-1).tolist():
+                done.append((self.example_ids[i].item(), self.best_scores[i],
+                             self.best_seq[i, :self.best_lengths[i]]))
+            non_finished = end_condition.eq(0).nonzero().view(-1)
+            # Compact the alive hypotheses: the rows of the remaining
+            # examples are computed once and gathered from every state.
+            rows = (non_finished.unsqueeze(1) * beam_size + beam_arange).view(-1)
+            topk_log_probs = topk_log_probs.index_select(0, non_finished)
+            batch_index = batch_index.index_select(0, non_finished)
+            alive_seq = alive_seq.index_select(0, rows)
+            self.example_ids = self.example_ids.index_select(0, non_finished)
+            self.start_positions = self.start_positions.index_select(0, non_finished)
+            self.best_scores = self.best_scores.index_select(0, non_finished)
+            self.best_lengths = self.best_lengths.index_select(0, non_finished)
+            self.best_seq = self.best_seq.index_select(0, non_finished)
+            for processor in self.processors:
+                processor.prune(rows)
+            # If all sentences are translated, no need to go further.
+            if len(non_finished) == 0:
+                return done
+
+        # Reorder states.
+        select_indices = batch_index.view(-1)
+        if past_key_values is not None:
+            past_key_values = self.reorder_cache_fn(past_key_values, select_indices, beam_size)
+        reorder_fn(select_indices)
+
+        # Drop the columns which are padding for all the remaining examples.
+        num_padding = int(self.start_positions.min())
+        if num_padding > 0:
+            alive_seq = alive_seq[:, num_padding:]
+            self.start_positions = self.start_positions - num_padding
+            if past_key_values is not None:
+                past_key_values = trim_cache(past_key_values, num_padding)
+
+        self.alive_seq = alive_seq
+        self.topk_log_probs = topk_log_probs
+        self.past_key_values = past_key_values
+        self.step += 1
+        return done
+
+    def merge(self, other):
+        """
+        Appends the examples still decoded by `other`, a search with the
+        same settings and processors which ran at least one step. The
+        hypotheses of the shorter search are left-padded. Returns the
+        offset added to the example ids of `other`.
+        """
+        length = max(self.alive_seq.size(1), other.alive_seq.size(1))
+        self.start_positions = torch.cat([self.start_positions + length - self.alive_seq.size(1),
+                                          other.start_positions + length - other.alive_seq.size(1)])
+        self.alive_seq = torch.cat([_pad(self.alive_seq, 1, length, left=True, value=self.start_token_id),
+                                    _pad(other.alive_seq, 1, length, left=True, value=self.start_token_id)])
+        if self.past_key_values is not None:
+            self.past_key_values = merge_caches(self.past_key_values, other.past_key_values)
+
+        offset = self.num_examples
+        self.num_examples += other.num_examples
+        self.example_ids = torch.cat([self.example_ids, other.example_ids + offset])
+        self.topk_log_probs = torch.cat([self.topk_log_probs, other.topk_log_probs])
+        self.best_scores = torch.cat([self.best_scores, other.best_scores])
+        self.best_lengths = torch.cat([self.best_lengths, other.best_lengths])
+        self.best_seq = torch.cat([self.best_seq, other.best_seq])
+        for processor, other_processor in zip(self.processors, other.processors):
+            processor.merge(other_processor)
+        return offset
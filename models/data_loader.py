@@ -1,10 +1,13 @@
 import gc
 import glob
 import bisect
+import functools
+import itertools
 import random
 import torch
 from models.logging import logger
-from transformers import AutoTokenizer
+from models.packed_dataset import PackedDataset, INDEX_SUFFIX
+from models.tokenizer import load_tokenizer, special_token_ids
 torch.set_printoptions(edgeitems=1000)
 
 class Batch(object):
@@ -57,18 +60,24 @@ class Batch(object):
             setattr(self, 'nsent_src', nsent_src)
             setattr(self, 'prompt_tokenized', prompt_tokenized)
 
-            if (ext_or_abs in ['step']) or (inference_mode in ['plan']):
-                src_sentence_mask = self.create_sentlevel_mask_src(src, mask_src, cls_id, max(nsent_src))
-                tgt_sentence_mask = self.create_sentlevel_mask_tgt(tgt, mask_tgt, cls_id, max(nsent_tgt))
-                src_predicate_mask = self.create_predicate_mask_src(src, mask_src, pred_special_tok_id, obj_special_tok_id, max(nsent_src))
+            if (ext_or_abs in ['step']) or (inference_mode in ['plan', 'non_prjective_tree']):
+                # Compact per-token segment ids, the dense masks are expanded on the device.
+                src_sent_ids = self.get_sentlevel_ids_src(src, mask_src, cls_id).to(device)
+                tgt_sent_ids = self.get_sentlevel_ids_tgt(tgt, mask_tgt, cls_id).to(device)
+                src_predicate_ids = self.get_predicate_ids_src(src, mask_src, pred_special_tok_id, obj_special_tok_id).to(device)
                 src_predicate_token_idx = self.get_src_predicate_idx(src, pred_special_tok_id)
                 src_predicate_token_idx = [item.to(device) for item in src_predicate_token_idx]
-                setattr(self, 'mask_tgt_sent', tgt_sentence_mask.to(device))
-                setattr(self, 'mask_src_sent', src_sentence_mask.to(device))
-                setattr(self, 'src_predicate_mask', src_predicate_mask.to(device))
+                setattr(self, 'src_sent_ids', src_sent_ids)
+                setattr(self, 'tgt_sent_ids', tgt_sent_ids)
+                setattr(self, 'src_predicate_ids', src_predicate_ids)
+                setattr(self, 'mask_tgt_sent', self._segment_masks(tgt_sent_ids, max(nsent_tgt)))
+                setattr(self, 'mask_src_sent', self._segment_masks(src_sent_ids, max(nsent_src)))
+                setattr(self, 'src_predicate_mask', self._segment_masks(src_predicate_ids, max(nsent_src)))
                 setattr(self, 'src_predicate_token_idx', src_predicate_token_idx)
 
             if (is_test):
+                order = [x[5] for x in data]
+                setattr(self, 'order', order)
                 src_str = [x[-4] for x in data]
                 setattr(self, 'src_str', src_str)
                 if prompt_style == 'plan_only':
@@ -103,55 +112,68 @@ class Batch(object):
             new_tgts.append(tgt)
         return new_tgts
 
+    def _segment_masks(self, segment_ids, max_sent_len):
+        """
+        Dense (batch, max_sent_len, seq_len) masks from the segment id of
+        every token (-1 out of any segment).
+        """
+        sent_range = torch.arange(max_sent_len, device=segment_ids.device).view(1, -1, 1)
+        return (segment_ids.unsqueeze(1) == sent_range).float()
+
+    def get_predicate_ids_src(self, src, mask_src, pred_special_tok_id, obj_special_tok_id):
+        # The j-th predicate spans the tokens between the j-th PRED and the j-th OBJ.
+        is_pred = (src == pred_special_tok_id).long()
+        npred_before = is_pred.cumsum(dim=1) - is_pred
+        nobj = (src == obj_special_tok_id).long().cumsum(dim=1)
+        segment_ids = npred_before - 1
+        in_predicate = (segment_ids == nobj) & (segment_ids >= 0) & mask_src
+        return segment_ids.masked_fill(~in_predicate, -1)
+
+    def get_sentlevel_ids_src(self, src, mask_src, cls_id):
+        # A sentence starts at its CLS and ends before the next one.
+        segment_ids = (src == cls_id).long().cumsum(dim=1) - 1
+        return segment_ids.masked_fill(~mask_src, -1)
+
+    def get_sentlevel_ids_tgt(self, tgt, mask_tgt, cls_id):
+        # A sentence ends with its CLS; the first CLS is not a boundary.
+        is_cls = (tgt == cls_id).long()
+        ncls = is_cls.sum(dim=1, keepdim=True)
+        ncls_before = is_cls.cumsum(dim=1) - is_cls
+        segment_ids = (ncls_before - 1).clamp(min=0)
+        in_sentence = (ncls_before < ncls) & (ncls >= 2) & mask_tgt
+        return segment_ids.masked_fill(~in_sentence, -1)
+
     def create_predicate_mask_src(self, src, mask_src, pred_special_tok_id, obj_special_tok_id, max_sent_len):
-        src_sentence_mask = []
-        for i, ex_src in enumerate(src):
-            pred_index = (ex_src == pred_special_tok_id).nonzero(as_tuple=True)[0]
-            obj_index = (ex_src == obj_special_tok_id).nonzero(as_tuple=True)[0]
-            mask = torch.zeros((max_sent_len, src.size(1)))
-            for j in range(len(pred_index)):
-                sid = pred_index[j]+1
-                eid = obj_index[j]
-                mask[j][sid:eid] = 1
-                mask[j] = mask[j] * mask_src[i]
-            src_sentence_mask.append(mask)
-        return torch.stack(src_sentence_mask)
+        segment_ids = self.get_predicate_ids_src(src, mask_src, pred_special_tok_id, obj_special_tok_id)
+        return self._segment_masks(segment_ids, max_sent_len)
 
     def create_sentlevel_mask_src(self, src, mask_src, cls_id, max_sent_len):
-        src_sentence_mask = []
-        for i, ex_src in enumerate(src):
-            cls_index = (ex_src == cls_id).nonzero(as_tuple=True)[0]
-            cls_index = cls_index.tolist() + [src.size(1)]
-            mask = torch.zeros((max_sent_len, src.size(1)))
-            for j in range(len(cls_index)-1):
-                sid = cls_index[j]
-                eid = cls_index[j+1]
-                mask[j][sid:eid] = 1
-                mask[j] = mask[j] * mask_src[i]
-            src_sentence_mask.append(mask)
-        return torch.stack(src_sentence_mask)
+        segment_ids = self.get_sentlevel_ids_src(src, mask_src, cls_id)
+        return self._segment_masks(segment_ids, max_sent_len)
 
     def create_sentlevel_mask_tgt(self, src, mask_src, cls_id, max_sent_len):
-        src_sentence_mask = []
-        for i, ex_src in enumerate(src):
-            cls_index = (ex_src == cls_id).nonzero(as_tuple=True)[0]
-            cls_index = cls_index.tolist()
-            cls_index[0] = -1
-            mask = torch.zeros((max_sent_len, src.size(1)))
-            for j in range(len(cls_index)-1):
-                sid = cls_index[j]+1
-                eid = cls_index[j+1]+1
-                mask[j][sid:eid] = 1
-                mask[j] = mask[j] * mask_src[i]
-            src_sentence_mask.append(mask)
-        return torch.stack(src_sentence_mask)
+        segment_ids = self.get_sentlevel_ids_tgt(src, mask_src, cls_id)
+        return self._segment_masks(segment_ids, max_sent_len)
 
     def get_src_predicate_idx(self, src, pred_special_tok_id):
-        src_sentence_mask = []
-        for ex_src in src:
-            pred_index = (ex_src == pred_special_tok_id).nonzero(as_tuple=True)[0]
-            src_sentence_mask.append(pred_index+1)
-        return src_sentence_mask
+        is_pred = (src == pred_special_tok_id)
+        pred_index = is_pred.nonzero(as_tuple=True)[1]
+        return list(torch.split(pred_index+1, is_pred.sum(dim=1).tolist()))
+
+    def _apply(self, fn):
+        for name, value in vars(self).items():
+            if torch.is_tensor(value):
+                setattr(self, name, fn(value))
+            elif isinstance(value, list) and value and torch.is_tensor(value[0]):
+                setattr(self, name, [fn(item) for item in value])
+        return self
+
+    def pin_memory(self):
+        # Called by torch's DataLoader when pin_memory is set.
+        return self._apply(lambda x: x.pin_memory())
+
+    def to(self, device, non_blocking=False):
+        return self._apply(lambda x: x.to(device, non_blocking=non_blocking))
 
     def __len__(self):
         return self.batch_size
@@ -170,13 +192,19 @@ def load_dataset(args, corpus_type, shuffle):
     assert corpus_type in ["train", "validation", "test"]
 
     def _lazy_dataset_loader(pt_file, corpus_type):
-        dataset = torch.load(pt_file)
+        if pt_file.endswith(INDEX_SUFFIX):
+            # Packed shard, memory-mapped rather than loaded.
+            dataset = PackedDataset(pt_file[:-len(INDEX_SUFFIX)])
+        else:
+            dataset = torch.load(pt_file)
         logger.info('Loading %s dataset from %s, number of examples: %d' %
                     (corpus_type, pt_file, len(dataset)))
         return dataset
 
     # Sort the glob output by file name (by increasing indexes).
-    pts = sorted(glob.glob(args.input_path + '/' + corpus_type + '.[0-9]*.pt'))
+    pts = sorted(glob.glob(args.input_path + '/' + corpus_type + '.[0-9]*' + INDEX_SUFFIX))
+    if not pts:
+        pts = sorted(glob.glob(args.input_path + '/' + corpus_type + '.[0-9]*.pt'))
     if pts:
         if (shuffle):
             random.shuffle(pts)
@@ -203,6 +231,116 @@ def ext_batch_size_fn(new, count):
     return src_elements
 
 
+# Width, in source tokens, of the length buckets of the token-budget
+# batches, the examples of a bucket are sorted by target length.
+SRC_BUCKET_WIDTH = 8
+
+# Hidden size used to express the attention cost in tokens: a layer costs
+# about L * d^2 for the projections and L^2 * d for the attention.
+ATTN_COST_DIM = 768
+
+
+def token_batch_size_fn(new, count, batch_policy='tokens'):
+    """
+    Padded tokens of a training batch, sources and targets, plus the
+    estimated attention cost with the 'attention' policy.
+    """
+    src, tgt = new[0], new[1]
+    global max_train_src_len, max_train_tgt_len
+    if count == 1:
+        max_train_src_len = 0
+        max_train_tgt_len = 0
+    max_train_src_len = max(max_train_src_len, len(src))
+    max_train_tgt_len = max(max_train_tgt_len, len(tgt))
+    tokens = count * (max_train_src_len + max_train_tgt_len)
+    if batch_policy == 'attention':
+        # encoder and decoder self-attention, cross-attention
+        attn = max_train_src_len ** 2 + max_train_tgt_len ** 2 + max_train_src_len * max_train_tgt_len
+        tokens += count * attn // ATTN_COST_DIM
+    return tokens
+
+
+def test_batch_size_fn(new, count, test_batch_by='src'):
+    """
+    Padded tokens of a test batch: sources only, or sources and
+    targets when batching by source x target length.
+    """
+    src, tgt = new[0], new[1]
+    global max_src_len, max_tgt_len
+    if count == 1:
+        max_src_len = 0
+        max_tgt_len = 0
+    max_src_len = max(max_src_len, len(src))
+    max_tgt_len = max(max_tgt_len, len(tgt))
+    if test_batch_by == 'src_x_tgt':
+        return count * (max_src_len + max_tgt_len)
+    return count * max_src_len
+
+
+class OrderedBuffer(object):
+    """
+    Releases the items pushed with their position in the original data
+    in that order, so that length-sorted batches are written back in the
+    order of the dataset.
+    """
+
+    def __init__(self):
+        self.next_order = 0
+        self.pending = {}
+
+    def push_batch(self, orders, items):
+        for order, item in zip(orders, items):
+            self.pending[order] = item
+        ready = []
+        while self.next_order in self.pending:
+            ready.append(self.pending.pop(self.next_order))
+            self.next_order += 1
+        return ready
+
+    def flush(self):
+        ready = [self.pending[order] for order in sorted(self.pending)]
+        self.pending = {}
+        return ready
+
+
+class BatchCollator(object):
+    """
+    Builds a Batch on the cpu from a list of preprocessed examples, small
+    enough to be sent to the DataLoader workers.
+    """
+
+    def __init__(self, args, is_test, pad_token_id, cls_token_id, pred_special_tok_id, obj_special_tok_id):
+        self.is_test = is_test
+        self.pad_token_id = pad_token_id
+        self.cls_token_id = cls_token_id
+        self.pred_special_tok_id = pred_special_tok_id
+        self.obj_special_tok_id = obj_special_tok_id
+        self.ext_or_abs = args.ext_or_abs
+        self.inference_mode = args.inference_mode
+        self.prompt_style = args.prompt_style
+        self.shuffle_plan_tok = args.shuffle_plan_tok
+
+    def __call__(self, minibatch, device='cpu'):
+        return Batch(minibatch, device, self.is_test,
+                     self.pad_token_id, cls_id=self.cls_token_id,
+                     pred_special_tok_id=self.pred_special_tok_id,
+                     obj_special_tok_id=self.obj_special_tok_id,
+                     ext_or_abs=self.ext_or_abs,
+                     inference_mode=self.inference_mode,
+                     prompt_style=self.prompt_style,
+                     shuffle_plan_tok=self.shuffle_plan_tok)
+
+
+class MinibatchDataset(torch.utils.data.Dataset):
+    """
+    The minibatches themselves are the indexes of the sampler: they are
+    formed lazily in the main process and sent to the workers as is.
+    """
+
+    def __getitem__(self, minibatch):
+        return minibatch
+
+
 class Dataloader(object):
     def __init__(self, args, datasets,  batch_size, device, shuffle, is_test):
         self.args = args
@@ -211,6 +349,7 @@ class Dataloader(object):
         self.device = device
         self.shuffle = shuffle
         self.is_test = is_test
+        self.order_offset = 0
         self.cur_iter = self._next_dataset_iterator(datasets)
         assert self.cur_iter is not None
 
@@ -219,6 +358,8 @@ class Dataloader(object):
         while self.cur_iter is not None:
             for batch in self.cur_iter:
                 yield batch
+            # Examples of the next shard follow the ones of this shard.
+            self.order_offset += self.cur_iter.num_examples
             self.cur_iter = self._next_dataset_iterator(dataset_iter)
 
 
@@ -236,34 +377,64 @@ class Dataloader(object):
             return None
 
         return DataIterator(args = self.args, dataset=self.cur_dataset, batch_size=self.batch_size,
-                            device=self.device, shuffle=self.shuffle, is_test=self.is_test)
+                            device=self.device, shuffle=self.shuffle, is_test=self.is_test,
+                            order_offset=self.order_offset)
 
 
 class DataIterator(object):
-    def __init__(self, args, dataset,  batch_size, device=None, is_test=False, shuffle=True):
+    def __init__(self, args, dataset,  batch_size, device=None, is_test=False, shuffle=True, order_offset=0):
         self.args = args
         self.batch_size, self.is_test, self.dataset = batch_size, is_test, dataset
+        self.order_offset = order_offset
+        self.num_examples = 0
         self.iterations = 0
         self.device = device
         self.shuffle = shuffle
-        self.tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path)
+        # Shared by the iterators of all the shards and epochs.
+        self.tokenizer = load_tokenizer(args.tokenizer_path)
         if self.tokenizer.cls_token_id is None:
             self.cls_token = self.tokenizer.eos_token
         else:
             self.cls_token = self.tokenizer.cls_token
-        self.pad_token_id = self.tokenizer.pad_token_id
-        self.cls_token_id = self.tokenizer.cls_token_id
-        self.pred_special_tok_id = self.tokenizer.convert_tokens_to_ids([self.args.pred_special_tok])[0]
-        self.obj_special_tok_id = self.tokenizer.convert_tokens_to_ids([self.args.obj_special_tok])[0]
+        special_ids = special_token_ids(args.tokenizer_path, args.pred_special_tok, args.obj_special_tok)
+        self.pad_token_id = special_ids.pad
+        self.cls_token_id = special_ids.cls
+        self.pred_special_tok_id = special_ids.pred
+        self.obj_special_tok_id = special_ids.obj
+        self.collator = BatchCollator(self.args, self.is_test, self.pad_token_id, self.cls_token_id,
+                                      self.pred_special_tok_id, self.obj_special_tok_id)
 
         self._iterations_this_epoch = 0
         self.batch_size_fn = ext_batch_size_fn
+        if self.is_test and self.args.test_batch_by != 'tgt':
+            # Bucket by source length and cap the padded tokens per batch.
+            self.batch_size_fn = functools.partial(test_batch_size_fn, test_batch_by=self.args.test_batch_by)
+            if self.args.test_max_tokens > 0:
+                self.batch_size = self.args.test_max_tokens
+        elif not self.is_test and self.args.batch_policy != 'src':
+            # Cap the padded tokens of source and target per batch.
+            self.batch_size_fn = functools.partial(token_batch_size_fn, batch_policy=self.args.batch_policy)
+            self.batch_size = self.args.max_tokens
 
     def data(self):
+        # Shuffles the positions, packed datasets are read-only.
+        order = list(range(len(self.dataset)))
         if self.shuffle:
-            random.shuffle(self.dataset)
-        xs = self.dataset
-        return xs
+            random.shuffle(order)
+        return (self.dataset[i] for i in order)
+
+    def sort_key(self, ex):
+        if not self.is_test:
+            if self.args.batch_policy == 'src':
+                return len(ex[1])
+            # Buckets of similar source lengths, sorted by target length inside.
+            return (len(ex[0]) // SRC_BUCKET_WIDTH, len(ex[1]))
+        if self.args.test_batch_by == 'tgt':
+            return len(ex[1])
+        if self.args.test_batch_by == 'src':
+            return len(ex[0])
+        # Buckets of similar source lengths, sorted by target length inside.
+        return (len(ex[0]) // SRC_BUCKET_WIDTH, len(ex[1]))
 
     def preprocess(self, ex, is_test):
         eid = ex['eid']
@@ -282,7 +453,10 @@ class DataIterator(object):
             prompt_tokenized = prompt_tokenized[:-1][:self.args.max_prompt_len]+[prompt_tokenized[-1]]
 
         if(is_test):
-            return src, tgt, nsent_src, nsent_tgt, prompt_tokenized, src_txt, tgt_txt, prompt_str, eid
+            # Position in the dataset, used to write outputs in the original order.
+            order = self.order_offset + self.num_examples
+            self.num_examples += 1
+            return src, tgt, nsent_src, nsent_tgt, prompt_tokenized, order, src_txt, tgt_txt, prompt_str, eid
         else:
             return src, tgt, nsent_src, nsent_tgt, prompt_tokenized
 
@@ -300,6 +474,11 @@ class DataIterator(object):
                 yield minibatch
                 minibatch, size_so_far = [], 0
             elif size_so_far > batch_size:
+                if len(minibatch) == 1:
+                    # An example over the budget on its own is a batch of its own.
+                    yield minibatch
+                    minibatch, size_so_far = [], 0
+                    continue
                 yield minibatch[:-1]
                 minibatch, size_so_far = minibatch[-1:], self.batch_size_fn(ex, 1)
         if minibatch:
@@ -315,6 +494,11 @@ class DataIterator(object):
                 yield minibatch
                 minibatch, size_so_far = [], 0
             elif size_so_far > batch_size:
+                if len(minibatch) == 1:
+                    # An example over the budget on its own is a batch of its own.
+                    yield minibatch
+                    minibatch, size_so_far = [], 0
+                    continue
                 yield minibatch[:-1]
                 minibatch, size_so_far = minibatch[-1:], self.batch_size_fn(ex, 1)
         if minibatch:
@@ -324,7 +508,7 @@ class DataIterator(object):
         """ Create batches """
         data = self.data()
         for buffer in self.batch_buffer(data, self.batch_size * 300):
-            p_batch = sorted(buffer, key=lambda x: len(x[1]))
+            p_batch = sorted(buffer, key=self.sort_key)
             p_batch = self.batch(p_batch, self.batch_size)
             p_batch = list(p_batch)
             if (self.shuffle):
@@ -335,6 +519,10 @@ class DataIterator(object):
                 yield b
 
     def __iter__(self):
+        if self.args.num_workers > 0:
+            for batch in self._iter_workers():
+                yield batch
+            return
         while True:
             self.batches = self.create_batches()
             for idx, minibatch in enumerate(self.batches):
@@ -343,15 +531,33 @@ class DataIterator(object):
                     continue
                 self.iterations += 1
                 self._iterations_this_epoch += 1
-                batch = Batch(minibatch, self.device, self.is_test, 
-                              self.pad_token_id, cls_id=self.cls_token_id, 
-                              pred_special_tok_id=self.pred_special_tok_id, 
-                              obj_special_tok_id=self.obj_special_tok_id,
-                              ext_or_abs=self.args.ext_or_abs,
-                              inference_mode=self.args.inference_mode,
-                              prompt_style=self.args.prompt_style,
-                              shuffle_plan_tok=self.args.shuffle_plan_tok)
+                batch = self.collator(minibatch, self.device)
                 yield batch
             return
 
-
+    def _iter_workers(self):
+        """
+        The minibatches are formed here, in the same order as without
+        workers, and collated into Batch objects by the DataLoader workers,
+        `-prefetch_factor` batches ahead per worker. The minibatches are
+        only formed as the workers need them. The batches are pinned and
+        copied to the device without blocking.
+        """
+        # fast-forward if loaded from state
+        minibatches = itertools.islice(self.create_batches(), self._iterations_this_epoch, None)
+        use_cuda = torch.device(self.device).type == 'cuda'
+        # Seeds the workers, for the random shuffling of the plan tokens.
+        generator = torch.Generator()
+        generator.manual_seed(self.args.seed + self.iterations)
+        loader = torch.utils.data.DataLoader(MinibatchDataset(),
+                                             sampler=minibatches,
+                                             batch_size=None,
+                                             collate_fn=self.collator,
+                                             num_workers=self.args.num_workers,
+                                             prefetch_factor=self.args.prefetch_factor,
+                                             pin_memory=(self.args.pin_memory and use_cuda),
+                                             generator=generator)
+        for batch in loader:
+            self.iterations += 1
+            self._iterations_this_epoch += 1
+            yield batch.to(self.device, non_blocking=use_cuda)
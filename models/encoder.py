@@ -3,6 +3,7 @@ import torch
 import torch.nn as nn
 
 from models.neural import MultiHeadedAttention, PositionwiseFeedForward
+from models.projective_tree import projective_marginals
 
 
 class Classifier(nn.Module):
@@ -70,11 +71,11 @@ class TransformerEncoderLayer(nn.Module):
 
 
 class TMTLayer(nn.Module):
-    def __init__(self, d_model,  d_ff, dropout, iter):
+    def __init__(self, d_model,  d_ff, dropout, iter, marginal='matrix_tree'):
         super(TMTLayer, self).__init__()
 
         self.iter = iter
-        self.self_attn = StructuredAttention( d_model, dropout)
+        self.self_attn = StructuredAttention( d_model, dropout, marginal=marginal)
         self.dropout = nn.Dropout(dropout)
         self.feed_forward = PositionwiseFeedForward(d_model, d_ff, dropout) # useless
         self.linears1 = nn.ModuleList([nn.Linear(2*d_model,d_model) for _ in range(iter)])
@@ -97,8 +98,9 @@ class TMTLayer(nn.Module):
 
 
 class StructuredAttention(nn.Module):
-    def __init__(self, model_dim, dropout=0.1):
+    def __init__(self, model_dim, dropout=0.1, marginal='matrix_tree'):
         self.model_dim = model_dim
+        self.marginal = marginal
 
         super(StructuredAttention, self).__init__()
 
@@ -131,6 +133,31 @@ class StructuredAttention(nn.Module):
         d = tmp1 - tmp2
         return d, d0
 
+    def _getMatrixTree_lu(self, scores, root, lengths):
+        """
+        Same marginals, through an LU factorization of the Laplacian of
+        every group of documents with the same number of sentences: the
+        padded rows are neither factorized nor counted in the Laplacian.
+        """
+        d = scores.new_zeros(scores.size())
+        d0 = root.new_zeros(root.size())
+        for n in lengths.unique().tolist():
+            if n == 0:
+                continue
+            idx = (lengths == n).nonzero(as_tuple=True)[0]
+            A = scores[idx, :n, :n]
+            R = root[idx, :n]
+
+            LL = torch.diag_embed(A.sum(1) + R) - A
+            LU, pivots = torch.linalg.lu_factor(LL)
+            eye = torch.eye(n, dtype=LL.dtype, device=LL.device).expand_as(LL)
+            LL_inv = torch.linalg.lu_solve(LU, pivots, eye)
+            LL_inv_diag = torch.diagonal(LL_inv, 0, 1, 2)
+
+            d0[idx, :n] = R * LL_inv_diag
+            d[idx, :n, :n] = A * LL_inv_diag.unsqueeze(1) - A * LL_inv.transpose(1, 2)
+        return d, d0
+
 
     def forward(self, x, mask=None):
 
@@ -147,7 +174,12 @@ class StructuredAttention(nn.Module):
         scores = scores - torch.transpose(mask, 1, 2) * 50
         scores = torch.clamp(scores, min=-40)
 
-        d, d0 = self._getMatrixTree_multi(scores, root)
+        if self.marginal == 'projective':
+            d, d0 = projective_marginals(scores, root, ~mask.squeeze(1).bool())
+        elif self.marginal == 'matrix_tree_lu':
+            d, d0 = self._getMatrixTree_lu(scores, root, (~mask.squeeze(1).bool()).sum(-1))
+        else:
+            d, d0 = self._getMatrixTree_multi(scores, root)
         attn = torch.transpose(d, 1,2)
         if mask is not None:
             mask = mask.expand_as(scores).bool()
@@ -156,12 +188,12 @@ class StructuredAttention(nn.Module):
 
 
 class TreeInference(nn.Module):
-    def __init__(self, d_model, d_ff, dropout, num_inter_layers=0):
+    def __init__(self, d_model, d_ff, dropout, num_inter_layers=0, marginal='matrix_tree'):
         super(TreeInference, self).__init__()
         self.d_model = d_model
         self.num_inter_layers = num_inter_layers
         self.pos_emb = PositionalEncoding(dropout, int(d_model))
-        self.transformer_inter = nn.ModuleList([TMTLayer(d_model, d_ff, dropout, i) for i in range(num_inter_layers)])
+        self.transformer_inter = nn.ModuleList([TMTLayer(d_model, d_ff, dropout, i, marginal=marginal) for i in range(num_inter_layers)])
         self.layer_norm2 = nn.LayerNorm(d_model, eps=1e-6)
 
     def forward(self, sent_vec, mask_block):
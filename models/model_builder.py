@@ -11,8 +11,9 @@ from models.encoder import Classifier, TreeInference, SentenceClassification
 from models.decoder import BartDecoderCS
 from models.t5_encoder_decoder import T5Stacker
 from models.optimizers import Optimizer
-from transformers import AutoModelForSeq2SeqLM, AutoTokenizer
-from models.tree_reader import tree_to_content_mask, tree_building, gumbel_softmax_function, topn_function
+from transformers import AutoModelForSeq2SeqLM
+from models.tokenizer import load_tokenizer
+from models.tree_reader import tree_to_content_mask, tree_building, gumbel_softmax_function, topn_function, topk_mask
 from models.neural import SimpleSelfAttention
 
 def build_optim_enc_dec(args, model, checkpoint):
@@ -123,7 +124,7 @@ class ExtSummarizer(nn.Module):
         self.vocab_size = vocab_size
         self.model = AutoModelForSeq2SeqLM.from_pretrained(self.args.model_name)
 
-        self.original_tokenizer = AutoTokenizer.from_pretrained(self.args.model_name)
+        self.original_tokenizer = load_tokenizer(self.args.model_name)
         print (self.vocab_size, len(self.original_tokenizer))
         if self.vocab_size > len(self.original_tokenizer):
             self.model.resize_token_embeddings(self.vocab_size)
@@ -133,7 +134,8 @@ class ExtSummarizer(nn.Module):
             self.planning_layer = TreeInference(self.model.config.hidden_size, 
                                                 args.ext_ff_size, 
                                                 args.ext_dropout, 
-                                                args.ext_layers)
+                                                args.ext_layers,
+                                                marginal=args.tree_marginal)
         else:
             self.planning_layer = SentenceClassification(self.model.config.hidden_size, 
                                                          args.ext_ff_size, 
@@ -199,7 +201,7 @@ class AbsSummarizer(nn.Module):
         self.cls_token_id = cls_token_id
         self.gumbel_tau = args.gumbel_tau
 
-        self.original_tokenizer = AutoTokenizer.from_pretrained(self.args.model_name)
+        self.original_tokenizer = load_tokenizer(self.args.model_name)
         print (self.vocab_size, len(self.original_tokenizer))
         if self.vocab_size > len(self.original_tokenizer):
             self.model.resize_token_embeddings(self.vocab_size)
@@ -256,7 +258,7 @@ class StepAbsSummarizer(nn.Module):
         self.gumbel_tau = args.gumbel_tau
         self.softmax = nn.Softmax(dim=-1)
 
-        self.original_tokenizer = AutoTokenizer.from_pretrained(self.args.model_name)
+        self.original_tokenizer = load_tokenizer(self.args.model_name)
         if self.vocab_size > len(self.original_tokenizer):
             self.model.resize_token_embeddings(self.vocab_size)
 
@@ -368,7 +370,7 @@ class SoftSrcPromptSummarizer(nn.Module):
         self.vocab_size = len(tokenizer)
         self.cls_token_id = tokenizer.cls_token_id
 
-        self.original_tokenizer = AutoTokenizer.from_pretrained(self.args.model_name)
+        self.original_tokenizer = load_tokenizer(self.args.model_name)
         if self.vocab_size > len(self.original_tokenizer):
             self.model.resize_token_embeddings(self.vocab_size)
 
@@ -528,30 +530,18 @@ class ExtAbsSummarizer(nn.Module):
             root_probs[:, min(gt_selection.size(1), int(self.args.ext_topn)):] = 1
             root_probs = root_probs * mask_block
         elif self.args.planning_method == 'random':
-            root_probs = torch.zeros(gt_selection.size(), device=self.device).int()
+            # ext_topn sentences drawn at random among the real ones.
             nsents = mask_block.sum(dim=1)
-            for i in range(root_probs.size(0)):
-                sample_num = min(nsents[i], int(self.args.ext_topn))
-                for idx in random.sample(range(0, int(nsents[i])), sample_num):
-                    root_probs[i][idx] = 1
+            random_scores = torch.rand(mask_block.size(), device=self.device).masked_fill(~mask_block.bool(), -1)
+            root_probs = topk_mask(random_scores, nsents.clamp(max=int(self.args.ext_topn))).int()
             root_probs = root_probs * mask_block
         else:
             root_probs = gumbel_softmax_function(root_probs, self.gumbel_tau, self.args.ext_topn)
 
-        sep_id = self.cls_token_id
-        batch_size, ntokens = input_ids.size()
-        content_selection_weights = []
-        for i in range(batch_size):
-            example_ids = input_ids[i, :]
-            sep_indices = (example_ids == sep_id).nonzero(as_tuple=True)[0].tolist()
-            sep_indices[0] = 0
-            sep_indices.append(input_ids.size(1))
-            weights = root_probs[i, :]
-            content_selection = []
-            for j in range(len(sep_indices)-1):
-                content_selection.append(weights[j].repeat(sep_indices[j+1]-sep_indices[j]))
-            content_selection_weights.append(torch.cat(content_selection))
-        content_selection_weights = torch.stack(content_selection_weights)
+        # Every token takes the weight of its sentence.
+        sent_ids = _get_token_sentence_ids(input_ids, self.cls_token_id)
+        sent_ids = sent_ids.clamp(max=root_probs.size(1)-1)
+        content_selection_weights = root_probs.gather(1, sent_ids)
         content_selection_weights = content_selection_weights * attention_mask
         return content_selection_weights, root_probs
 
@@ -583,19 +573,36 @@ class ExtAbsSummarizer(nn.Module):
 
 
 
-def _get_sentence_maxpool(top_vec, mask_src_sent, maxpool_linear):
-    top_vec = top_vec.unsqueeze(1).repeat((1, mask_src_sent.size(1), 1, 1))
-    mask_src_sent = mask_src_sent.unsqueeze(3).repeat((1, 1, 1, top_vec.size(-1)))
-    top_vec = top_vec.masked_fill(~mask_src_sent.bool(), -1e18)
-    sents_vec = torch.max(top_vec, -2)[0]
-    return sents_vec
+def _get_token_sentence_ids(input_ids, sep_id):
+    """
+    Sentence of every token, sentences start at the separators (the
+    tokens before the first separator belong to the first sentence).
+    """
+    sent_ids = (input_ids == sep_id).long().cumsum(dim=1) - 1
+    return sent_ids.clamp(min=0)
+
+
+def _get_sentence_maxpool(top_vec, mask_src_sent, maxpool_linear=None):
+    """
+    Max over the tokens of every sentence, as a segment max over the
+    sentence id of every token (sentences do not overlap). Empty
+    sentences get -1e18.
+    """
+    batch_size, nsent = mask_src_sent.size(0), mask_src_sent.size(1)
+    in_sent = mask_src_sent.bool()
+    # Tokens out of every sentence go to an extra, dropped, segment.
+    sent_ids = torch.where(in_sent.any(dim=1), in_sent.int().argmax(dim=1), nsent)
+    sent_ids = sent_ids.unsqueeze(-1).expand(-1, -1, top_vec.size(-1))
+    sents_vec = top_vec.new_full((batch_size, nsent+1, top_vec.size(-1)), -1e18)
+    sents_vec = sents_vec.scatter_reduce(1, sent_ids, top_vec, reduce='amax', include_self=True)
+    return sents_vec[:, :nsent]
 
 
 def _get_sentence_meanpool(top_vec, mask_src_sent):
-    top_vec = top_vec.unsqueeze(1).repeat((1, mask_src_sent.size(1), 1, 1))
-    mask_src_sent = mask_src_sent.unsqueeze(3).repeat((1, 1, 1, top_vec.size(-1)))
-    top_vec = top_vec * mask_src_sent.float()
-    return torch.sum(top_vec, -2)/torch.clamp(mask_src_sent.sum(-2), min=1e-9)
+    mask_src_sent = mask_src_sent.to(top_vec.dtype)
+    # Segment sums as one (nsent x seq_len) x (seq_len x hidden) product.
+    sents_sum = torch.bmm(mask_src_sent, top_vec)
+    return sents_sum/torch.clamp(mask_src_sent.sum(-1, keepdim=True), min=1e-9)
 
 
 def _get_predicate_embedding(top_vec, mask_src_predicate, mask_cls, predicate_linear=None):
@@ -621,7 +628,7 @@ class MarginalProjectiveTreeSumm(nn.Module):
         self.gumbel_tau = args.gumbel_tau
         self.model = AutoModelForSeq2SeqLM.from_pretrained(self.args.model_name)
 
-        self.original_tokenizer = AutoTokenizer.from_pretrained(self.args.model_name)
+        self.original_tokenizer = load_tokenizer(self.args.model_name)
         print (self.vocab_size, len(self.original_tokenizer))
         if self.vocab_size > len(self.original_tokenizer):
             self.model.resize_token_embeddings(self.vocab_size)
@@ -642,7 +649,8 @@ class MarginalProjectiveTreeSumm(nn.Module):
             self.planning_layer = TreeInference(self.model.config.hidden_size, 
                                                 args.ext_ff_size, 
                                                 args.ext_dropout, 
-                                                args.ext_layers)
+                                                args.ext_layers,
+                                                marginal=args.tree_marginal)
 
         # Sentence embedding
         self.maxpool_linear = nn.Linear(self.model.config.hidden_size, self.model.config.hidden_size, bias=True)
@@ -790,13 +798,13 @@ class MarginalProjectiveTreeSumm(nn.Module):
         #tree_info_embs = self.tree_info_layer_norm(tree_info_embs)
         tree_info_embs = self.tree_info_tanh(tree_info_embs)
 
-        # Add embedding of tree information to the token embedding
-        top_vec = top_vec.unsqueeze(1).repeat((1, mask_src_sent.size(1), 1, 1))
-        tree_info_embs = tree_info_embs.unsqueeze(2).repeat((1, 1, src.size(1), 1))
-        top_vec = top_vec + tree_info_embs
+        # Add embedding of tree information to the token embedding:
+        # sum_s mask[s, l] * (top_vec[l] + tree_info_embs[s]), computed without
+        # the (batch, nsent, seq_len, hidden) copies.
+        mask_src_sent = mask_src_sent.to(top_vec.dtype)
         #top_vec = self.emd_and_tree_wr(torch.cat([top_vec, tree_info_embs], dim=-1))
-        top_vec = top_vec * mask_src_sent[:, :, :, None].float()
-        top_vec = top_vec.sum(dim=1)
+        top_vec = top_vec * mask_src_sent.sum(dim=1).unsqueeze(-1) + \
+                  torch.bmm(mask_src_sent.transpose(1, 2), tree_info_embs)
 
         if not run_decoder:
             return {"encoder_outpus":top_vec, 
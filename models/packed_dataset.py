@@ -0,0 +1,88 @@
+"""
+Packed shard format, read through numpy.memmap instead of unpickling.
+
+A shard `<prefix>` is stored as three files:
+    <prefix>.tokens.bin    int32, the src/tgt/prompt token ids of all examples
+    <prefix>.strings.bin   utf-8, one json object per example with its strings
+    <prefix>.index.npy     int64 (num_examples, len(INDEX_FIELDS)) offsets
+"""
+import json
+import os
+
+import numpy
+
+INDEX_FIELDS = ['src_start', 'src_len', 'tgt_start', 'tgt_len',
+                'prompt_start', 'prompt_len', 'strings_start', 'strings_len',
+                'nsent_src', 'nsent_tgt']
+STRING_FIELDS = ['src_txt', 'tgt_txt', 'prompt_str', 'eid']
+INDEX_SUFFIX = '.index.npy'
+
+
+def write_packed_shard(datasets, prefix):
+    """
+    Writes the list of example dicts built by prepro.data_builder as a
+    packed shard. `prompt_tokenized` may be None (stored with length -1).
+    """
+    index = numpy.zeros((len(datasets), len(INDEX_FIELDS)), dtype=numpy.int64)
+    num_tokens, num_bytes = 0, 0
+    with open(prefix + '.tokens.bin', 'wb') as tokens_file, \
+            open(prefix + '.strings.bin', 'wb') as strings_file:
+        for i, ex in enumerate(datasets):
+            for j, key in enumerate(['src', 'tgt', 'prompt_tokenized']):
+                if ex[key] is None:
+                    index[i, 2*j:2*j+2] = (num_tokens, -1)
+                    continue
+                numpy.asarray(ex[key], dtype=numpy.int32).tofile(tokens_file)
+                index[i, 2*j:2*j+2] = (num_tokens, len(ex[key]))
+                num_tokens += len(ex[key])
+            strings = json.dumps({key: ex[key] for key in STRING_FIELDS}).encode('utf-8')
+            strings_file.write(strings)
+            index[i, 6:8] = (num_bytes, len(strings))
+            num_bytes += len(strings)
+            index[i, 8:10] = (ex['nsent_src'], ex['nsent_tgt'])
+    # Written last: a shard is complete once its index exists.
+    numpy.save(prefix + INDEX_SUFFIX, index)
+
+
+def _memmap(path, dtype):
+    # numpy.memmap refuses empty files.
+    if os.path.getsize(path) == 0:
+        return numpy.zeros(0, dtype=dtype)
+    return numpy.memmap(path, dtype=dtype, mode='r')
+
+
+class PackedDataset(object):
+    """
+    Read-only list of the example dicts of a packed shard. The shard is
+    mapped, not loaded: examples are decoded when they are accessed and
+    the pages are shared by all the processes reading the shard.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.index = numpy.load(prefix + INDEX_SUFFIX, mmap_mode='r')
+        self.tokens = _memmap(prefix + '.tokens.bin', numpy.int32)
+        self.strings = _memmap(prefix + '.strings.bin', numpy.uint8)
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    def _tokens(self, start, length):
+        if length < 0:
+            return None
+        return self.tokens[start:start+length].tolist()
+
+    def __getitem__(self, i):
+        (src_start, src_len, tgt_start, tgt_len, prompt_start, prompt_len,
+         strings_start, strings_len, nsent_src, nsent_tgt) = self.index[i].tolist()
+        ex = json.loads(bytes(self.strings[strings_start:strings_start+strings_len]).decode('utf-8'))
+        ex['src'] = self._tokens(src_start, src_len)
+        ex['tgt'] = self._tokens(tgt_start, tgt_len)
+        ex['prompt_tokenized'] = self._tokens(prompt_start, prompt_len)
+        ex['nsent_src'] = nsent_src
+        ex['nsent_tgt'] = nsent_tgt
+        return ex
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
@@ -6,42 +6,22 @@ import os
 import json
 import math
 import torch
-from models.beam_search.beam import GNMTGlobalScorer
+from models.data_loader import OrderedBuffer
+from models.beam_search.blocking import NGramBlocker
+from models.beam_search.processors import MinLengthProcessor, PlanConstraintProcessor, tile
+from models.beam_search.search import BeamSearch, select_examples
 from models.tree_reader import tree_building, headlist_to_string
 from models.model_builder import _get_sentence_maxpool, _get_sentence_meanpool, _get_predicate_embedding
 from tool.analysis_edge import Analysis
 
-def tile(x, count, dim=0):
-    """
-    Tiles x on dimension dim count times.
-    """
-    perm = list(range(len(x.size())))
-    if dim != 0:
-        perm[0], perm[dim] = perm[dim], perm[0]
-        x = x.permute(perm).contiguous()
-    out_size = list(x.size())
-    out_size[0] *= count
-    batch = x.size(0)
-    x = x.view(batch, -1) \
-         .transpose(0, 1) \
-         .repeat(count, 1) \
-         .transpose(0, 1) \
-         .contiguous() \
-         .view(*out_size)
-    if dim != 0:
-        x = x.permute(perm).contiguous()
-    return x
-
-
 def build_predictor_plan(args, tokenizer, model, logger=None):
-    scorer = GNMTGlobalScorer(args.alpha,length_penalty='wu')
-    translator = Translator(args, model, tokenizer, global_scorer=scorer, logger=logger)
+    translator = Translator(args, model, tokenizer, logger=logger)
     return translator
 
 
 class Translator(object):
 
-    def __init__(self, args, model, tokenizer, global_scorer=None, logger=None, dump_beam=""):
+    def __init__(self, args, model, tokenizer, logger=None, dump_beam=""):
 
         self.logger = logger
         self.cuda = args.visible_gpus != '-1'
@@ -58,7 +38,6 @@ class Translator(object):
             self.cls_token = self.tokenizer.cls_token
         self.plan_sep_token_id = self.tokenizer.convert_tokens_to_ids(['|||'])[0]
 
-        self.global_scorer = global_scorer
         self.beam_size = args.beam_size
         self.min_length = args.test_min_length
         self.max_length = args.test_max_length
@@ -78,6 +57,9 @@ class Translator(object):
         self.src_out_file = codecs.open(raw_src_path, 'w', 'utf-8')
         self.eid_out_file = codecs.open(eid_path, 'w', 'utf-8')
 
+        # Batches are sorted by length, outputs are written in the data order.
+        output_buffer = OrderedBuffer()
+
         self.model.eval()
         with torch.no_grad():
             for batch in data_iter:
@@ -86,24 +68,32 @@ class Translator(object):
                 # prepare output data
                 translations = self.from_batch(batch_data)
 
-                for trans in translations:
-                    pred_str, gold_str, src_str, src_list, eid = trans
-                    self.can_out_file.write(pred_str.strip() + '\n')
-                    self.gold_out_file.write(gold_str.strip() + '\n')
-                    self.src_out_file.write(src_str.strip() + '\n')
-                    self.eid_out_file.write(eid + '\n')
+                for trans in output_buffer.push_batch(batch.order, translations):
+                    self.write_translation(trans)
 
                 self.can_out_file.flush()
                 self.gold_out_file.flush()
                 self.src_out_file.flush()
                 self.eid_out_file.flush()
 
+            # Left-overs, only if some positions of the data were skipped.
+            for trans in output_buffer.flush():
+                self.write_translation(trans)
+
         self.can_out_file.close()
         self.gold_out_file.close()
         self.src_out_file.close()
         self.eid_out_file.close()
 
 
+    def write_translation(self, trans):
+        pred_str, gold_str, src_str, src_list, eid = trans
+        self.can_out_file.write(pred_str.strip() + '\n')
+        self.gold_out_file.write(gold_str.strip() + '\n')
+        self.src_out_file.write(src_str.strip() + '\n')
+        self.eid_out_file.write(eid + '\n')
+
+
     def from_batch(self, translation_batch):
         batch = translation_batch["batch"]
         assert (len(translation_batch["scores"]) == len(translation_batch["predictions"]))
@@ -147,13 +137,6 @@ class Translator(object):
 
     def _fast_translate_batch(self, batch, max_length, min_length=0):
 
-        def sent_probs_to_selected_ids(sent_probs):
-            selected_ids = []
-            for i in range(sent_probs.size(0)):
-                weights = sent_probs[i, :].tolist()
-                selected_ids.append([i for i in range(len(weights)) if weights[i] == 1])
-            return selected_ids
-
         assert not self.dump_beam
         beam_size = self.beam_size
         batch_size = batch.batch_size
@@ -165,7 +148,6 @@ class Translator(object):
         prompt_tokenized = batch.prompt_tokenized
         src_predicate_token_idx = batch.src_predicate_token_idx
         device = src.device
-        results = {}
 
         # Run encoder and tree prediction
         src_res = self.model(src, tgt, mask_src, mask_tgt,
@@ -179,154 +161,37 @@ class Translator(object):
         mask_src = tile(mask_src, beam_size, dim=0)
         src_features = tile(src_features, beam_size, dim=0)
 
-        batch_offset = torch.arange(batch_size, dtype=torch.long, device=device)
-        beam_offset = torch.arange(0, batch_size * beam_size, step=beam_size, dtype=torch.long, device=device)
-        alive_seq = torch.full([batch_size * beam_size, 1], self.start_token_id, dtype=torch.long, device=device)
-
-        # Give full probability to the first beam on the first step.
-        topk_log_probs = (torch.tensor([0.0] + [float("-inf")] * (beam_size - 1), device=device).repeat(batch_size))
-
-        # Constrained generation -- constrains
-        vocab_size = len(self.tokenizer)
-        constrains = torch.ones((batch_size, vocab_size), device=device) * -1e20
-        for i in range(batch_size):
-            '''
-            for idx in src_predicate_token_idx[i]:
-                vocab_idx = src[i][idx]
-                constrains[i][vocab_idx] = 0
-            '''
-            for vocab_idx in src[i]:
-                if vocab_idx > 32100:
-                    constrains[i][vocab_idx] = 0
-
-            constrains[i][self.plan_sep_token_id] = 0
-        constrains = tile(constrains, beam_size, dim=0)
-        src_pred_num = []
-        '''
-        for item in src_predicate_token_idx:
-            src_pred_num += [item.size(0)] * beam_size
-        '''
-        for i in range(batch_size):
-            src_pred_num += [(src[i] > 32100).sum().int()] * beam_size
-        src_pred_num = torch.tensor(src_pred_num, device=device, dtype=int)
-
-        # Structure that holds finished hypotheses.
-        hypotheses = [[] for _ in range(batch_size)]
-
-        results["predictions"] = [[] for _ in range(batch_size)]
-        results["scores"] = [[] for _ in range(batch_size)]
-        results["batch"] = batch
-
-        for step in range(max_length):
-
-            #decoder_input = alive_seq[:, -1].view(1, -1)
-            decoder_input = alive_seq
+        def step_fn(step, decoder_input, past_key_values):
             decoder_outputs = self.model.decoder(input_ids=decoder_input,
                                                  encoder_hidden_states=src_features,
-                                                 encoder_attention_mask=mask_src)
+                                                 encoder_attention_mask=mask_src,
+                                                 past_key_values=past_key_values,
+                                                 use_cache=self.args.use_cache)
 
             dec_out = decoder_outputs.last_hidden_state[:, -1, :]
 
             # Generator forward.
-            log_probs = self.generator.forward(dec_out)
-            vocab_size = log_probs.size(-1)
-
-            if step < min_length:
-                log_probs[:, self.end_token_id] = -1e20
-            curr_constrains = torch.zeros(constrains.size(), device=device)
-            for i in range(decoder_input.size(0)):
-                for tok in decoder_input[i]:
-                    if tok == self.plan_sep_token_id:
-                        continue
-                    curr_constrains[i][tok] = -1e20
-            curr_constrains += constrains
-            log_probs = (log_probs + curr_constrains)
-
-            # Multiply probs by the beam probability.
-            log_probs += topk_log_probs.view(-1).unsqueeze(1)
-
-            #alpha = self.global_scorer.alpha
-            #length_penalty = ((5.0 + (step + 1)) / 6.0) ** alpha
-            length_penalty = 1.0
-
-            # Flatten probs into a list of possibilities.
-            curr_scores = log_probs / length_penalty
-
-            if(self.args.block_trigram):
-                cur_len = alive_seq.size(1)
-                if(cur_len>3):
-                    for i in range(alive_seq.size(0)):
-                        fail = False
-                        words = [int(w) for w in alive_seq[i]]
-                        words = self.tokenizer.decode(words).split()
-                        if(len(words)<=3):
-                            continue
-                        trigrams = [(words[i-1],words[i],words[i+1]) for i in range(1,len(words)-1)]
-                        trigram = tuple(trigrams[-1])
-                        if trigram in trigrams[:-1]:
-                            fail = True
-                        if fail:
-                            curr_scores[i] = -10e20
-
-            curr_scores = curr_scores.reshape(-1, beam_size * vocab_size)
-            topk_scores, topk_ids = curr_scores.topk(beam_size, dim=-1)
-
-            # Recover log probs.
-            topk_log_probs = topk_scores * length_penalty
-
-            # Resolve beam origin and true word ids.
-            topk_beam_index = topk_ids.div(vocab_size).int()
-            topk_ids = topk_ids.fmod(vocab_size)
-
-            # Map beam_index to batch_index in the flat representation.
-            batch_index = (topk_beam_index + beam_offset[:topk_beam_index.size(0)].unsqueeze(1))
-            select_indices = batch_index.view(-1)
-
-            # Append last prediction.
-            alive_seq = torch.cat(
-                [alive_seq.index_select(0, select_indices),
-                 topk_ids.view(-1, 1)], -1)
-            generate_length = (alive_seq != self.plan_sep_token_id).sum(dim=1)
-
-            #is_finished = topk_ids.eq(self.end_token_id)
-            is_finished = ((generate_length - src_pred_num)>0).view(-1, beam_size)
-            if step + 1 == max_length:
-                is_finished.fill_(1)
-            # End condition is top beam is finished.
-            end_condition = is_finished[:, 0].eq(1)
-            # Save finished hypotheses.
-            if is_finished.any():
-                predictions = alive_seq.view(-1, beam_size, alive_seq.size(-1))
-                for i in range(is_finished.size(0)):
-                    b = batch_offset[i]
-                    if end_condition[i]:
-                        is_finished[i].fill_(1)
-                    finished_hyp = is_finished[i].nonzero().view(-1)
-                    # Store finished hypotheses for this batch.
-                    for j in finished_hyp:
-                        hypotheses[b].append((topk_scores[i, j], predictions[i, j, 1:]))
-                    # If the batch reached the end, save the n_best hypotheses.
-                    if end_condition[i]:
-                        best_hyp = sorted(hypotheses[b], key=lambda x: x[0], reverse=True)
-                        score, pred = best_hyp[0]
-                        results["scores"][b].append(score)
-                        results["predictions"][b].append(pred)
-                non_finished = end_condition.eq(0).nonzero().view(-1)
-                # If all sentences are translated, no need to go further.
-                if len(non_finished) == 0:
-                    break
-                # Remove finished batches for the next step.
-                topk_log_probs = topk_log_probs.index_select(0, non_finished)
-                batch_index = batch_index.index_select(0, non_finished)
-                batch_offset = batch_offset.index_select(0, non_finished)
-                alive_seq = predictions.index_select(0, non_finished).view(-1, alive_seq.size(-1))
-
-            # Reorder states.
-            select_indices = batch_index.view(-1)
-            src_features = src_features.index_select(0, select_indices)
-            mask_src = mask_src.index_select(0, select_indices)
-            src_pred_num = src_pred_num.index_select(0, select_indices)
-            constrains = constrains.index_select(0, select_indices)
+            return self.generator.forward(dec_out), decoder_outputs.past_key_values
+
+        def reorder_fn(select_indices):
+            nonlocal src_features, mask_src
+            src_features = select_examples(src_features, select_indices, beam_size)
+            mask_src = select_examples(mask_src, select_indices, beam_size)
+
+        # Constrained generation -- only the predicates of the source
+        # (and the plan separator) are allowed, each of them at most once.
+        processors = [MinLengthProcessor(min_length, [self.end_token_id]),
+                      PlanConstraintProcessor(src, beam_size, len(self.tokenizer),
+                                              self.start_token_id, self.plan_sep_token_id)]
+        if self.args.block_trigram:
+            processors.append(NGramBlocker(3, beam_size, batch_size, device))
+
+        beam_search = BeamSearch(beam_size, batch_size,
+                                 self.start_token_id, self.end_token_id,
+                                 max_length, device, processors=processors,
+                                 use_cache=self.args.use_cache)
+        results = beam_search.search(step_fn, reorder_fn)
+        results["batch"] = batch
 
         return results
 
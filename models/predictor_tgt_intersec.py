@@ -6,41 +6,21 @@ import os
 import json
 import math
 import torch
-from models.beam_search.beam import GNMTGlobalScorer
+from models.data_loader import OrderedBuffer
+from models.beam_search.blocking import NGramBlocker
+from models.beam_search.processors import PlanForcingProcessor, tile
+from models.beam_search.search import BeamSearch, select_examples
 from models.tree_reader import tree_building, headlist_to_string, tree_to_mask_list
 from tool.analysis_edge import Analysis
 
-def tile(x, count, dim=0):
-    """
-    Tiles x on dimension dim count times.
-    """
-    perm = list(range(len(x.size())))
-    if dim != 0:
-        perm[0], perm[dim] = perm[dim], perm[0]
-        x = x.permute(perm).contiguous()
-    out_size = list(x.size())
-    out_size[0] *= count
-    batch = x.size(0)
-    x = x.view(batch, -1) \
-         .transpose(0, 1) \
-         .repeat(count, 1) \
-         .transpose(0, 1) \
-         .contiguous() \
-         .view(*out_size)
-    if dim != 0:
-        x = x.permute(perm).contiguous()
-    return x
-
-
 def build_predictor_intersec(args, tokenizer, model, logger=None):
-    scorer = GNMTGlobalScorer(args.alpha,length_penalty='wu')
-    translator = Translator(args, model, tokenizer, global_scorer=scorer, logger=logger)
+    translator = Translator(args, model, tokenizer, logger=logger)
     return translator
 
 
 class Translator(object):
 
-    def __init__(self, args, model, tokenizer, global_scorer=None, logger=None, dump_beam=""):
+    def __init__(self, args, model, tokenizer, logger=None, dump_beam=""):
 
         self.logger = logger
         self.cuda = args.visible_gpus != '-1'
@@ -58,7 +38,6 @@ class Translator(object):
         self.plan_beg_id = plan_special_token_ids[0]
         self.plan_end_id = plan_special_token_ids[1]
 
-        self.global_scorer = global_scorer
         self.beam_size = args.beam_size
         self.min_length = args.test_min_length
         self.max_length = args.test_max_length
@@ -80,6 +59,9 @@ class Translator(object):
         self.eid_out_file = codecs.open(eid_path, 'w', 'utf-8')
         self.alg_out_file = codecs.open(alg_path, 'w', 'utf-8')
 
+        # Batches are sorted by length, outputs are written in the data order.
+        output_buffer = OrderedBuffer()
+
         self.model.eval()
         with torch.no_grad():
             for batch in data_iter:
@@ -88,13 +70,8 @@ class Translator(object):
                 # prepare output data
                 translations = self.from_batch(batch_data)
 
-                for trans in translations:
-                    pred_str, gold_str, src_str, src_list, eid, alignments, prompt_str = trans
-                    self.can_out_file.write(pred_str.strip() + '\n')
-                    self.gold_out_file.write(gold_str.strip() + '\n')
-                    self.src_out_file.write(src_str.strip() + '\n')
-                    self.eid_out_file.write(eid + '\n')
-                    self.alg_out_file.write(prompt_str + '\n')
+                for trans in output_buffer.push_batch(batch.order, translations):
+                    self.write_translation(trans)
 
                 self.can_out_file.flush()
                 self.gold_out_file.flush()
@@ -102,6 +79,10 @@ class Translator(object):
                 self.eid_out_file.flush()
                 self.alg_out_file.flush()
 
+            # Left-overs, only if some positions of the data were skipped.
+            for trans in output_buffer.flush():
+                self.write_translation(trans)
+
         self.can_out_file.close()
         self.gold_out_file.close()
         self.src_out_file.close()
@@ -109,6 +90,15 @@ class Translator(object):
         self.alg_out_file.close()
 
 
+    def write_translation(self, trans):
+        pred_str, gold_str, src_str, src_list, eid, alignments, prompt_str = trans
+        self.can_out_file.write(pred_str.strip() + '\n')
+        self.gold_out_file.write(gold_str.strip() + '\n')
+        self.src_out_file.write(src_str.strip() + '\n')
+        self.eid_out_file.write(eid + '\n')
+        self.alg_out_file.write(prompt_str + '\n')
+
+
     def from_batch(self, translation_batch):
         batch = translation_batch["batch"]
         assert (len(translation_batch["scores"]) == len(translation_batch["predictions"]))
@@ -177,7 +167,6 @@ class Translator(object):
         gt_aj_matrix = batch.gt_aj_matrix
         src_predicate_token_idx = batch.src_predicate_token_idx
         device = src.device
-        results = {}
 
         # Run encoder and tree prediction
         src_res = self.model(src, tgt, mask_src, mask_tgt,
@@ -188,171 +177,41 @@ class Translator(object):
         src_features = src_res['encoder_outpus']
         mask_src = src_res['encoder_attention_mask']
 
-        sentence_plans = prompt_tokenized
-        current_tgt_example_id = []
-        for j in range(src.size(0)):
-            current_tgt_example_id.extend([j] * beam_size)
-        current_tgt_example_id = torch.tensor(current_tgt_example_id, dtype=int, device=device)
-        current_plan_idx = torch.zeros(src.size(0)*beam_size, device=device).int()
-        current_is_plan_tokens = torch.ones(batch_size * beam_size, device=device).bool()
-        current_sent_length = torch.zeros(batch_size * beam_size, device=device)
-
         src_features = tile(src_features, beam_size, dim=0)
         mask_src = tile(mask_src, beam_size, dim=0)
 
-        batch_offset = torch.arange(batch_size, dtype=torch.long, device=device)
-        beam_offset = torch.arange(0, batch_size * beam_size, step=beam_size, dtype=torch.long, device=device)
-        alive_seq = torch.full([batch_size * beam_size, 1], self.start_token_id, dtype=torch.long, device=device)
-
-        # Give full probability to the first beam on the first step.
-        topk_log_probs = (torch.tensor([0.0] + [float("-inf")] * (beam_size - 1), device=device).repeat(batch_size))
-
-        # Structure that holds finished hypotheses.
-        hypotheses = [[] for _ in range(batch_size)]
-
-        results["predictions"] = [[] for _ in range(batch_size)]
-        results["scores"] = [[] for _ in range(batch_size)]
-        results["batch"] = batch
-
-        for step in range(max_length):
-
-            for row in alive_seq:
-                print (self.tokenizer.decode(row))
-            print ('\n\n')
-            decoder_input = alive_seq
+        def step_fn(step, decoder_input, past_key_values):
             decoder_outputs = self.model.decoder(input_ids=decoder_input,
-                                           encoder_hidden_states=src_features,
-                                           encoder_attention_mask=mask_src)
+                                                 encoder_hidden_states=src_features,
+                                                 encoder_attention_mask=mask_src,
+                                                 past_key_values=past_key_values,
+                                                 use_cache=self.args.use_cache)
+
             dec_out = decoder_outputs.last_hidden_state[:, -1, :]
 
             # Generator forward.
-            log_probs = self.generator.forward(dec_out)
-            vocab_size = log_probs.size(-1)
-
-            for i, current_state in enumerate(current_is_plan_tokens):
-                if not current_is_plan_tokens[i]:
-                    current_sent_length[i] += 1
-
-            for i in range(current_sent_length.size(0)):
-                if current_sent_length[i] < min_length:
-                    log_probs[i, self.cls_token_id] = -1e20
-
-            # Consider about the plan
-            for i, example_id in enumerate(current_tgt_example_id):
-                sentence_plan = sentence_plans[example_id]
-                read_plan_token = current_is_plan_tokens[i]
-                if not read_plan_token:
-                    continue
-                token_in_plan = sentence_plan[current_plan_idx[i]]
-                if token_in_plan == self.end_token_id:
-                    continue
-                log_probs[i, token_in_plan] = 0.0
-                if token_in_plan == self.plan_end_id:
-                    current_is_plan_tokens[i] = 0
-                current_plan_idx[i] += 1
-
-            # Multiply probs by the beam probability.
-            log_probs += topk_log_probs.view(-1).unsqueeze(1)
-
-            #alpha = self.global_scorer.alpha
-            #length_penalty = ((5.0 + (step + 1)) / 6.0) ** alpha
-            length_penalty = 1.0
-
-            # Flatten probs into a list of possibilities.
-            curr_scores = log_probs / length_penalty
-
-            if(self.args.block_trigram):
-                cur_len = alive_seq.size(1)
-                if(cur_len>3):
-                    for i in range(alive_seq.size(0)):
-                        fail = False
-                        words = [int(w) for w in alive_seq[i]]
-                        words = self.tokenizer.decode(words).split()
-                        if(len(words)<=3):
-                            continue
-                        trigrams = [(words[i-1],words[i],words[i+1]) for i in range(1,len(words)-1)]
-                        trigram = tuple(trigrams[-1])
-                        if trigram in trigrams[:-1]:
-                            fail = True
-                        if fail:
-                            curr_scores[i] = -10e20
-
-            curr_scores = curr_scores.reshape(-1, beam_size * vocab_size)
-            topk_scores, topk_ids = curr_scores.topk(beam_size, dim=-1)
-
-            # Recover log probs.
-            topk_log_probs = topk_scores * length_penalty
-
-            # Resolve beam origin and true word ids.
-            topk_beam_index = topk_ids.div(vocab_size).int()
-            topk_ids = topk_ids.fmod(vocab_size)
-
-            # Map beam_index to batch_index in the flat representation.
-            batch_index = (topk_beam_index + beam_offset[:topk_beam_index.size(0)].unsqueeze(1))
-            select_indices = batch_index.view(-1)
-            current_plan_idx = current_plan_idx.index_select(0, select_indices)
-            current_is_plan_tokens = current_is_plan_tokens.index_select(0, select_indices)
-            current_sent_length = current_sent_length.index_select(0, select_indices)
-            # Append last prediction.
-            alive_seq = torch.cat(
-                [alive_seq.index_select(0, select_indices),
-                 topk_ids.view(-1, 1)], -1)
-
-            # If one sentence finishes
-            topk_ids = topk_ids.view(-1)
-            sent_finished = topk_ids.eq(self.cls_token_id)
-            for i in range(sent_finished.size(0)):
-                if sent_finished[i]:
-                    current_sent_length[i] = 0
-                    current_is_plan_tokens[i] = 1
-                    example_id = current_tgt_example_id[i]
-                    sentence_plan = sentence_plans[example_id]
-                    token_in_plan = sentence_plan[current_plan_idx[i]]
-                    if token_in_plan == self.end_token_id:
-                        topk_ids[i] = self.end_token_id
-            topk_ids = topk_ids.view(-1, beam_size)
-
-            is_finished = topk_ids.eq(self.end_token_id)
-            if step + 1 == max_length:
-                is_finished.fill_(1)
-            # End condition is top beam is finished.
-            end_condition = is_finished[:, 0].eq(1)
-            # Save finished hypotheses.
-            if is_finished.any():
-                predictions = alive_seq.view(-1, beam_size, alive_seq.size(-1))
-                for i in range(is_finished.size(0)):
-                    b = batch_offset[i]
-                    if end_condition[i]:
-                        is_finished[i].fill_(1)
-                    finished_hyp = is_finished[i].nonzero().view(-1)
-                    # Store finished hypotheses for this batch.
-                    for j in finished_hyp:
-                        hypotheses[b].append((topk_scores[i, j], predictions[i, j, 1:]))
-                    # If the batch reached the end, save the n_best hypotheses.
-                    if end_condition[i]:
-                        best_hyp = sorted(hypotheses[b], key=lambda x: x[0], reverse=True)
-                        score, pred = best_hyp[0]
-                        results["scores"][b].append(score)
-                        results["predictions"][b].append(pred)
-                non_finished = end_condition.eq(0).nonzero().view(-1)
-                # If all sentences are translated, no need to go further.
-                if len(non_finished) == 0:
-                    break
-                # Remove finished batches for the next step.
-                topk_log_probs = topk_log_probs.index_select(0, non_finished)
-                batch_index = batch_index.index_select(0, non_finished)
-                batch_offset = batch_offset.index_select(0, non_finished)
-                alive_seq = predictions.index_select(0, non_finished).view(-1, alive_seq.size(-1))
-
-            # Reorder states.
-            select_indices = batch_index.view(-1)
-            src_features = src_features.index_select(0, select_indices)
-            mask_src = mask_src.index_select(0, select_indices)
-            if is_finished.any():
-                current_tgt_example_id = current_tgt_example_id.index_select(0, select_indices)
-                current_sent_length = current_sent_length.index_select(0, select_indices)
-                current_plan_idx = current_plan_idx.index_select(0, select_indices)
-                current_is_plan_tokens = current_is_plan_tokens.index_select(0, select_indices)
+            return self.generator.forward(dec_out), decoder_outputs.past_key_values
+
+        def reorder_fn(select_indices):
+            nonlocal src_features, mask_src
+            src_features = select_examples(src_features, select_indices, beam_size)
+            mask_src = select_examples(mask_src, select_indices, beam_size)
+
+        processors = []
+        if self.args.block_trigram:
+            processors.append(NGramBlocker(3, beam_size, batch_size, device))
+        # Sentence plans are forced at the beginning of every sentence,
+        # after the blocking.
+        processors.append(PlanForcingProcessor(prompt_tokenized, beam_size,
+                                               self.cls_token_id, self.end_token_id,
+                                               self.plan_end_id, min_length))
+
+        beam_search = BeamSearch(beam_size, batch_size,
+                                 self.start_token_id, self.end_token_id,
+                                 max_length, device, processors=processors,
+                                 use_cache=self.args.use_cache)
+        results = beam_search.search(step_fn, reorder_fn)
+        results["batch"] = batch
 
         return results
 
@@ -7,41 +7,21 @@ import json
 import math
 import torch
 from models.neural import CalculateSelfAttention
-from models.beam_search.beam import GNMTGlobalScorer
-from models.tree_reader import headlist_to_string, tree_to_content_mask, gumbel_softmax_function, tree_building, headlist_to_alignments
+from models.data_loader import OrderedBuffer
+from models.beam_search.blocking import NGramBlocker
+from models.beam_search.processors import MinLengthProcessor, SentencePlanProcessor, tile
+from models.beam_search.search import BeamSearch, select_examples
+from models.tree_reader import headlist_to_string, tree_to_content_mask, gumbel_softmax_function, tree_building_async, headlists_to_subtrees, subtrees_to_alignments, TreeDecoder
 from tool.analysis_edge import Analysis
 
-def tile(x, count, dim=0):
-    """
-    Tiles x on dimension dim count times.
-    """
-    perm = list(range(len(x.size())))
-    if dim != 0:
-        perm[0], perm[dim] = perm[dim], perm[0]
-        x = x.permute(perm).contiguous()
-    out_size = list(x.size())
-    out_size[0] *= count
-    batch = x.size(0)
-    x = x.view(batch, -1) \
-         .transpose(0, 1) \
-         .repeat(count, 1) \
-         .transpose(0, 1) \
-         .contiguous() \
-         .view(*out_size)
-    if dim != 0:
-        x = x.permute(perm).contiguous()
-    return x
-
-
 def build_predictor_tree(args, tokenizer, model, logger=None):
-    scorer = GNMTGlobalScorer(args.alpha,length_penalty='wu')
-    translator = Translator(args, model, tokenizer, global_scorer=scorer, logger=logger)
+    translator = Translator(args, model, tokenizer, logger=logger)
     return translator
 
 
 class Translator(object):
 
-    def __init__(self, args, model, tokenizer, global_scorer=None, logger=None, dump_beam=""):
+    def __init__(self, args, model, tokenizer, logger=None, dump_beam=""):
 
         self.logger = logger
         self.cuda = args.visible_gpus != '-1'
@@ -55,7 +35,6 @@ class Translator(object):
         self.cls_token_id = self.tokenizer.cls_token_id
         self.cls_token = self.tokenizer.cls_token
 
-        self.global_scorer = global_scorer
         self.beam_size = args.beam_size
         self.min_length = args.test_min_length
         self.max_length = args.test_max_length
@@ -63,6 +42,7 @@ class Translator(object):
 
         self.model_analysis = Analysis()
         self.self_attn_layer = CalculateSelfAttention()
+        self.tree_decoder = TreeDecoder(args.tree_workers, projective=(args.tree_marginal == 'projective'))
 
     def translate(self, data_iter, step, attn_debug=False):
         gold_path = self.args.result_path + '.%d.gold' % step
@@ -79,29 +59,41 @@ class Translator(object):
         self.alg_out_file = codecs.open(alg_path, 'w', 'utf-8')
         self.tree_out_file = codecs.open(tree_path, 'w', 'utf-8')
 
+        # Batches are sorted by length, outputs are written in the data order.
+        output_buffer = OrderedBuffer()
+
+        def write_batch(batch, batch_data):
+            translations = self.from_batch(batch_data)
+
+            for trans in output_buffer.push_batch(batch.order, translations):
+                self.write_translation(trans)
+
+            self.can_out_file.flush()
+            self.gold_out_file.flush()
+            self.src_out_file.flush()
+            self.eid_out_file.flush()
+            self.alg_out_file.flush()
+            self.tree_out_file.flush()
+
         self.model.eval()
-        with torch.no_grad():
+        # The tree workers are stopped once the data is translated.
+        with torch.no_grad(), self.tree_decoder:
+            # One batch of lookahead: the trees of a batch are decoded by the
+            # tree workers while the previous batch runs the beam search.
+            pending = None
             for batch in data_iter:
-                # pridiction
-                batch_data = self.translate_batch(batch)
-                # prepare output data
-                translations = self.from_batch(batch_data)
-
-                for trans in translations:
-                    pred_str, gold_str, src_str, src_list, eid, alignments, trees = trans
-                    self.can_out_file.write(pred_str.strip() + '\n')
-                    self.gold_out_file.write(gold_str.strip() + '\n')
-                    self.src_out_file.write(src_str.strip() + '\n')
-                    self.eid_out_file.write(eid + '\n')
-                    self.alg_out_file.write(alignments + '\n')
-                    self.tree_out_file.write(json.dumps(trees)+'\n')
-
-                self.can_out_file.flush()
-                self.gold_out_file.flush()
-                self.src_out_file.flush()
-                self.eid_out_file.flush()
-                self.alg_out_file.flush()
-                self.tree_out_file.flush()
+                # encoder and tree scores, tree decoding is submitted
+                encoded = self.encode_batch(batch)
+                if pending is not None:
+                    # pridiction
+                    write_batch(pending['batch'], self.decode_batch(pending, self.max_length, self.min_length))
+                pending = encoded
+            if pending is not None:
+                write_batch(pending['batch'], self.decode_batch(pending, self.max_length, self.min_length))
+
+            # Left-overs, only if some positions of the data were skipped.
+            for trans in output_buffer.flush():
+                self.write_translation(trans)
 
         self.can_out_file.close()
         self.gold_out_file.close()
@@ -111,6 +103,16 @@ class Translator(object):
         self.tree_out_file.close()
 
 
+    def write_translation(self, trans):
+        pred_str, gold_str, src_str, src_list, eid, alignments, trees = trans
+        self.can_out_file.write(pred_str.strip() + '\n')
+        self.gold_out_file.write(gold_str.strip() + '\n')
+        self.src_out_file.write(src_str.strip() + '\n')
+        self.eid_out_file.write(eid + '\n')
+        self.alg_out_file.write(alignments + '\n')
+        self.tree_out_file.write(json.dumps(trees)+'\n')
+
+
     def from_batch(self, translation_batch):
         batch = translation_batch["batch"]
         assert (len(translation_batch["scores"]) == len(translation_batch["predictions"]))
@@ -161,10 +163,14 @@ class Translator(object):
 
 
     def _fast_translate_batch(self, batch, max_length, min_length=0):
+        return self.decode_batch(self.encode_batch(batch), max_length, min_length)
 
-        assert not self.dump_beam
-        beam_size = self.beam_size
-        batch_size = batch.batch_size
+
+    def encode_batch(self, batch):
+        """
+        Runs the encoder and the tree scorer, and submits the tree
+        decoding to the tree workers.
+        """
 
         src = batch.src
         mask_src = batch.mask_src
@@ -176,7 +182,6 @@ class Translator(object):
         mask_cls = batch.mask_cls
         labels = batch.alg
         device = src.device
-        results = {}
 
         ## Run encoder and tree prediction
         src_res = self.model(src, tgt, mask_src, mask_tgt, mask_tgt_sent, tgt_nsent, clss, mask_cls, labels, run_decoder=False)
@@ -196,170 +201,73 @@ class Translator(object):
         # fake root
         fake_roots = torch.zeros((gumble_attns.size(0), gumble_attns.size(1))).to(device)+0.1
         # run tree-building
-        heads_ret = tree_building(fake_roots, gumble_attns, mask_cls, device)
-        # convert to lable format
-        labels = [headlist_to_alignments(headlist, mask_cls[i].sum()+1) for i, headlist in enumerate(heads_ret)]
-        # generate stepwise mask
-        mask_src = tree_to_content_mask(labels, src, mask_src, tgt_nsent, self.cls_token_id)
+        heads_future = tree_building_async(fake_roots, gumble_attns, mask_cls, device, self.tree_decoder)
 
-        # Tile states and memory beam_size times.
-        idx = 0
-        mask_src_list = []
-        current_tgt_example_id = []
-        for j, nsent in enumerate(tgt_nsent):
-            one_ex = []
-            for i in range(idx, idx+nsent):
-                one_ex.append(mask_src[i].unsqueeze(0))
-            idx += nsent
-            mask_src_list.append(one_ex)
-            current_tgt_example_id.extend([j] * beam_size)
-        current_tgt_generation = [0] * len(mask_src_list*beam_size)
-        current_tgt_example_id = torch.tensor(current_tgt_example_id, device=src.device)
-        current_tgt_generation = torch.tensor(current_tgt_generation, device=src.device)
+        return {'batch': batch, 'src_features': src_features, 'heads': heads_future}
 
-        src_features = tile(src_features, beam_size, dim=0)
 
-        batch_offset = torch.arange(batch_size, dtype=torch.long, device=device)
-        beam_offset = torch.arange(0, batch_size * beam_size, step=beam_size, dtype=torch.long, device=device)
-        alive_seq = torch.full([batch_size * beam_size, 1], self.start_token_id, dtype=torch.long, device=device)
+    def decode_batch(self, encoded, max_length, min_length=0):
 
-        # Give full probability to the first beam on the first step.
-        topk_log_probs = (torch.tensor([0.0] + [float("-inf")] * (beam_size - 1), device=device).repeat(batch_size))
-
-        # Structure that holds finished hypotheses.
-        hypotheses = [[] for _ in range(batch_size)]
-
-        results["predictions"] = [[] for _ in range(batch_size)]
-        results["scores"] = [[] for _ in range(batch_size)]
-        results["batch"] = batch
-        results["trees"] = labels
+        assert not self.dump_beam
+        beam_size = self.beam_size
+        batch = encoded['batch']
+        batch_size = batch.batch_size
 
-        for step in range(max_length):
+        src = batch.src
+        mask_cls = batch.mask_cls
+        device = src.device
+        src_features = encoded['src_features']
 
-            decoder_input = alive_seq
+        heads_ret = encoded['heads'].result()
+        # convert to lable format
+        subtree_ids, nsubtrees = headlists_to_subtrees(heads_ret, mask_cls.sum(dim=1)+1)
+        labels = subtrees_to_alignments(subtree_ids, nsubtrees)
+        # generate stepwise mask
+        # One row per generated sentence: the target is not known yet, every
+        # target sentence stands for a single token.
+        num_sents = nsubtrees.to(device)
+        mask_tgt_sent = torch.eye(int(num_sents.max()), device=device).unsqueeze(0).expand(batch_size, -1, -1)
+        # (batch, max_nsent, src_len) source mask of every sentence of the plan.
+        mask_src_list = tree_to_content_mask(subtree_ids, batch.mask_src_sent, mask_tgt_sent)
 
-            mask_src = []
-            for i, idx in enumerate(current_tgt_generation):
-                example_id = current_tgt_example_id[i]
+        # Tile states and memory beam_size times.
+        plan_processor = SentencePlanProcessor(num_sents, beam_size,
+                                               self.cls_token_id, self.end_token_id,
+                                               force_end_token=True)
 
-                # For some cases where the top generation in the beam is unfinished but some of the rest have finished
-                idx = min(idx, len(mask_src_list[example_id])-1)
+        src_features = tile(src_features, beam_size, dim=0)
 
-                mask_src.append(mask_src_list[example_id][idx])
-            mask_src = torch.cat(mask_src)
+        def step_fn(step, decoder_input, past_key_values):
+            # Mask of the sentence each hypothesis is generating.
+            mask_src = mask_src_list[plan_processor.example_ids, plan_processor.current_sentence()]
 
             decoder_outputs = self.model.decoder(input_ids=decoder_input,
-                                           encoder_hidden_states=src_features,
-                                           encoder_attention_mask=mask_src)
+                                                 encoder_hidden_states=src_features,
+                                                 encoder_attention_mask=mask_src,
+                                                 past_key_values=past_key_values,
+                                                 use_cache=self.args.use_cache)
 
             dec_out = decoder_outputs.last_hidden_state[:, -1, :]
 
             # Generator forward.
-            log_probs = self.generator.forward(dec_out)
-            vocab_size = log_probs.size(-1)
-
-            if step < min_length:
-                log_probs[:, self.end_token_id] = -1e20
-                log_probs[:, self.cls_token_id] = -1e20
-
-            # Multiply probs by the beam probability.
-            log_probs += topk_log_probs.view(-1).unsqueeze(1)
-
-            #alpha = self.global_scorer.alpha
-            #length_penalty = ((5.0 + (step + 1)) / 6.0) ** alpha
-            length_penalty = 1.0
-
-            # Flatten probs into a list of possibilities.
-            curr_scores = log_probs / length_penalty
-
-            if(self.args.block_trigram):
-                cur_len = alive_seq.size(1)
-                if(cur_len>3):
-                    for i in range(alive_seq.size(0)):
-                        fail = False
-                        words = [int(w) for w in alive_seq[i]]
-                        words = self.tokenizer.decode(words).split()
-                        if(len(words)<=3):
-                            continue
-                        trigrams = [(words[i-1],words[i],words[i+1]) for i in range(1,len(words)-1)]
-                        trigram = tuple(trigrams[-1])
-                        if trigram in trigrams[:-1]:
-                            fail = True
-                        if fail:
-                            curr_scores[i] = -10e20
-
-            curr_scores = curr_scores.reshape(-1, beam_size * vocab_size)
-            topk_scores, topk_ids = curr_scores.topk(beam_size, dim=-1)
-
-            # Recover log probs.
-            topk_log_probs = topk_scores * length_penalty
-
-            # Resolve beam origin and true word ids.
-            topk_beam_index = topk_ids.div(vocab_size).int()
-            topk_ids = topk_ids.fmod(vocab_size)
-
-            # Map beam_index to batch_index in the flat representation.
-            batch_index = (topk_beam_index + beam_offset[:topk_beam_index.size(0)].unsqueeze(1))
-            select_indices = batch_index.view(-1)
-
-            # If one sentence finishes
-            current_tgt_example_id = current_tgt_example_id.index_select(0, select_indices)
-            current_tgt_generation = current_tgt_generation.index_select(0, select_indices)
-            topk_ids = topk_ids.view(-1)
-            sent_finished = topk_ids.eq(self.cls_token_id)
-            report = False
-            for i in range(sent_finished.size(0)):
-                if sent_finished[i]:
-                    current_tgt_generation[i] += 1
-                example_id = current_tgt_example_id[i]
-                if current_tgt_generation[i] >= len(mask_src_list[example_id]):
-                    report = True
-                    topk_ids[i] = self.end_token_id
-            topk_ids = topk_ids.view(-1, beam_size)
-
-            # Append last prediction.
-            alive_seq = torch.cat(
-                [alive_seq.index_select(0, select_indices),
-                 topk_ids.view(-1, 1)], -1)
-
-            is_finished = topk_ids.eq(self.end_token_id)
-            if step + 1 == max_length:
-                is_finished.fill_(1)
-            # End condition is top beam is finished.
-            end_condition = is_finished[:, 0].eq(1)
-            # Save finished hypotheses.
-            if is_finished.any():
-                predictions = alive_seq.view(-1, beam_size, alive_seq.size(-1))
-                for i in range(is_finished.size(0)):
-                    b = batch_offset[i]
-                    if end_condition[i]:
-                        is_finished[i].fill_(1)
-                    finished_hyp = is_finished[i].nonzero().view(-1)
-                    # Store finished hypotheses for this batch.
-                    for j in finished_hyp:
-                        hypotheses[b].append((topk_scores[i, j], predictions[i, j, 1:]))
-                    # If the batch reached the end, save the n_best hypotheses.
-                    if end_condition[i]:
-                        best_hyp = sorted(hypotheses[b], key=lambda x: x[0], reverse=True)
-                        score, pred = best_hyp[0]
-                        results["scores"][b].append(score)
-                        results["predictions"][b].append(pred)
-                non_finished = end_condition.eq(0).nonzero().view(-1)
-                # If all sentences are translated, no need to go further.
-                if len(non_finished) == 0:
-                    break
-                # Remove finished batches for the next step.
-                topk_log_probs = topk_log_probs.index_select(0, non_finished)
-                batch_index = batch_index.index_select(0, non_finished)
-                batch_offset = batch_offset.index_select(0, non_finished)
-                alive_seq = predictions.index_select(0, non_finished).view(-1, alive_seq.size(-1))
-
-            # Reorder states.
-            select_indices = batch_index.view(-1)
-            src_features = src_features.index_select(0, select_indices)
-            if is_finished.any():
-                current_tgt_example_id = current_tgt_example_id.index_select(0, select_indices)
-                current_tgt_generation = current_tgt_generation.index_select(0, select_indices)
+            return self.generator.forward(dec_out), decoder_outputs.past_key_values
+
+        def reorder_fn(select_indices):
+            nonlocal src_features
+            src_features = select_examples(src_features, select_indices, beam_size)
+
+        processors = [MinLengthProcessor(min_length, [self.end_token_id, self.cls_token_id]),
+                      plan_processor]
+        if self.args.block_trigram:
+            processors.append(NGramBlocker(3, beam_size, batch_size, device))
+
+        beam_search = BeamSearch(beam_size, batch_size,
+                                 self.start_token_id, self.end_token_id,
+                                 max_length, device, processors=processors,
+                                 use_cache=self.args.use_cache)
+        results = beam_search.search(step_fn, reorder_fn)
+        results["batch"] = batch
+        results["trees"] = labels
 
         return results
 
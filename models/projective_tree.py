@@ -0,0 +1,126 @@
+"""
+Batched projective dependency trees (Eisner's algorithm) over padded
+sentence-level scores.
+
+Scores are log-potentials laid out as `scores[b, dep, head]` over
+`n + 1` nodes, node 0 being the root; an example with `lengths[b]`
+sentences uses nodes 0..lengths[b]. The inside pass is vectorized over
+the batch and over all the spans of a width. The marginals are the
+gradients of the log partition, the best tree the gradients of its max
+version, so both come from the same pass.
+"""
+import torch
+
+
+def _stripe(x, n, w, offset=(0, 0), dim=1):
+    """
+    Returns a (n, w, ...) view of x, where row i holds the `w` elements
+    starting at `(i + offset[0], i + offset[1])`, taken along the row
+    (dim=1) or the column (dim=0).
+    """
+    x, seq_len = x.contiguous(), x.size(1)
+    stride, numel = list(x.stride()), x[0, 0].numel()
+    stride[0] = (seq_len + 1) * numel
+    stride[1] = (1 if dim == 1 else seq_len) * numel
+    return x.as_strided(size=(n, w, *x.shape[2:]),
+                        stride=stride,
+                        storage_offset=(offset[0] * seq_len + offset[1]) * numel)
+
+
+def eisner_inside(scores, lengths, viterbi=False):
+    """
+    Log partition (or best tree score if `viterbi`) of the projective
+    trees of every example.
+
+    Args:
+        scores (FloatTensor): `(batch, n + 1, n + 1)`, `scores[b, dep, head]`
+        lengths (LongTensor): `(batch,)` number of nodes without the root
+    Returns:
+        FloatTensor: `(batch,)`
+    """
+    reduce = (lambda x: x.max(-1)[0]) if viterbi else (lambda x: x.logsumexp(-1))
+    seq_len = scores.size(1)
+    # (head, dep, batch)
+    scores = scores.permute(2, 1, 0)
+    s_i = torch.full_like(scores, float('-inf'))
+    s_c = torch.full_like(scores, float('-inf'))
+    s_c.diagonal().fill_(0)
+
+    for w in range(1, seq_len):
+        n = seq_len - w
+        # C(i->r) + C(j->r+1), i <= r < j
+        ilr = (_stripe(s_c, n, w) + _stripe(s_c, n, w, (w, 1))).permute(2, 0, 1)
+        # I(j->i)
+        s_i.diagonal(-w).copy_(reduce(ilr + scores.diagonal(-w).unsqueeze(-1)))
+        # I(i->j)
+        s_i.diagonal(w).copy_(reduce(ilr + scores.diagonal(w).unsqueeze(-1)))
+        # C(j->i) = C(r->i) + I(j->r), i <= r < j
+        cl = _stripe(s_c, n, w, (0, 0), 0) + _stripe(s_i, n, w, (w, 0))
+        s_c.diagonal(-w).copy_(reduce(cl.permute(2, 0, 1)))
+        # C(i->j) = I(i->r) + C(r->j), i < r <= j
+        cr = _stripe(s_i, n, w, (0, 1)) + _stripe(s_c, n, w, (1, w), 0)
+        s_c.diagonal(w).copy_(reduce(cr.permute(2, 0, 1)))
+
+    return s_c[0].gather(0, lengths.unsqueeze(0)).squeeze(0)
+
+
+def _full_scores(edges, roots):
+    """
+    (batch, n + 1, n + 1) dep x head scores from the `edges[b, head, child]`
+    and `roots[b, child]` scores of the sentences.
+    """
+    batch_size, n, _ = edges.size()
+    scores = edges.new_zeros(batch_size, n + 1, n + 1)
+    scores[:, 1:, 0] = roots
+    scores[:, 1:, 1:] = edges.transpose(1, 2)
+    return scores
+
+
+def projective_marginals(edges, roots, mask):
+    """
+    Edge and root marginals of the projective trees, the projective
+    counterpart of the matrix-tree marginals of StructuredAttention.
+
+    Args:
+        edges (FloatTensor): `(batch, n, n)` log-potentials, `edges[b, head, child]`
+        roots (FloatTensor): `(batch, n)` log-potentials of the root edges
+        mask (BoolTensor): `(batch, n)` real sentences
+    Returns:
+        (FloatTensor, FloatTensor): `(batch, n, n)` edge marginals
+        `[b, head, child]` and `(batch, n)` root marginals
+    """
+    lengths = mask.long().sum(-1)
+    with torch.enable_grad():
+        scores = _full_scores(edges, roots)
+        if not scores.requires_grad:
+            scores.requires_grad_()
+        log_z = eisner_inside(scores, lengths)
+        # Keep the graph so that the marginals can be trained through.
+        marginals, = torch.autograd.grad(log_z.sum(), scores, create_graph=torch.is_grad_enabled() and edges.requires_grad)
+    d = marginals[:, 1:, 1:].transpose(1, 2)
+    d0 = marginals[:, 1:, 0]
+    return d, d0
+
+
+def eisner_decode(energy, lengths):
+    """
+    Best projective tree of every example, in the format of decode_mst.
+
+    Args:
+        energy (FloatTensor): `(batch, n + 1, n + 1)`, `energy[b, head, child]`,
+            node 0 is the root
+        lengths (list): number of nodes of every example, root included
+    Returns:
+        list of numpy arrays: the head of every node (-1 for the root),
+            padded to n + 1
+    """
+    lengths = torch.tensor(lengths, dtype=torch.long, device=energy.device) - 1
+    with torch.enable_grad():
+        scores = energy.detach().transpose(1, 2).contiguous().requires_grad_()
+        best = eisner_inside(scores, lengths, viterbi=True)
+        arcs, = torch.autograd.grad(best.sum(), scores)
+    heads = arcs.argmax(-1)
+    heads = heads.masked_fill(arcs.sum(-1).eq(0), 0)
+    heads[:, 0] = -1
+    heads = heads.int().cpu().numpy()
+    return [heads[b] for b in range(heads.shape[0])]
@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+""" Local inference server with continuous batching """
+from __future__ import print_function
+import json
+import queue
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import torch
+import torch.nn.functional as F
+from models.beam_search.processors import tile
+from models.beam_search.search import select_examples
+from models.data_loader import Batch
+from models.logging import logger
+
+
+class Request(object):
+    def __init__(self, src, eid, plan=None):
+        self.src = src
+        self.eid = eid
+        self.plan = plan
+        self.arrival = time.time()
+        self.done = threading.Event()
+        self.prediction = None
+        self.score = None
+        self.latency = None
+
+
+class LatencyStats(object):
+    """
+    Latencies of the last `window` requests, in seconds.
+    """
+
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=window)
+        self.count = 0
+
+    def add(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            self.count += 1
+
+    def percentiles(self, ps=(50, 90, 95, 99)):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            count = self.count
+        stats = {'requests': count}
+        for p in ps:
+            if latencies:
+                idx = min(len(latencies) - 1, int(round(p / 100.0 * (len(latencies) - 1))))
+                stats['p%d' % p] = latencies[idx]
+            else:
+                stats['p%d' % p] = None
+        return stats
+
+
+class LiveBatch(object):
+    """
+    Examples being decoded together: their beam search, the encoder memory
+    of their hypotheses and the request of every example.
+
+    New requests are encoded into a LiveBatch of their own which runs its
+    first step alone, then `merge` appends its hypotheses, cache and memory
+    to the batch in flight. Finished examples are evicted from all of them
+    by the beam search.
+    """
+
+    def __init__(self, predictor, search, memory, mask, requests):
+        self.predictor = predictor
+        self.decoder = predictor.model.decoder
+        self.search = search
+        self.memory = memory
+        self.mask = mask
+        self.requests = dict(enumerate(requests))
+
+    def step_fn(self, step, decoder_input, past_key_values):
+        search = self.search
+        start_positions = tile(search.start_positions, search.beam_size, dim=0)
+        columns = torch.arange(search.alive_seq.size(1), device=start_positions.device)
+        # The merged examples are left-padded.
+        attention_mask = columns.unsqueeze(0).ge(start_positions.unsqueeze(1)).long()
+        if hasattr(self.decoder, 'embed_positions'):
+            inputs = {'inputs_embeds': self.embed(decoder_input, columns[-decoder_input.size(1):], start_positions)}
+        else:
+            # Relative positions (T5) only need the mask.
+            inputs = {'input_ids': decoder_input}
+        decoder_outputs = self.decoder(attention_mask=attention_mask,
+                                       encoder_hidden_states=self.memory,
+                                       encoder_attention_mask=self.mask,
+                                       past_key_values=past_key_values,
+                                       use_cache=search.use_cache,
+                                       **inputs)
+
+        dec_out = decoder_outputs.last_hidden_state[:, -1, :]
+        return self.predictor.generator.forward(dec_out), decoder_outputs.past_key_values
+
+    def embed(self, decoder_input, columns, start_positions):
+        """
+        Token embeddings corrected so that the learned positions, which the
+        decoder adds by column, count from the start of every hypothesis.
+        """
+        embed_positions = self.decoder.embed_positions
+        weight, offset = embed_positions.weight, embed_positions.offset
+        positions = (columns.unsqueeze(0) - start_positions.unsqueeze(1)).clamp(min=0)
+        embeds = self.decoder.embed_tokens(decoder_input) * getattr(self.decoder, 'embed_scale', 1.0)
+        return embeds + weight[positions + offset] - weight[columns + offset]
+
+    def reorder_fn(self, select_indices):
+        self.memory = select_examples(self.memory, select_indices, self.search.beam_size)
+        self.mask = select_examples(self.mask, select_indices, self.search.beam_size)
+
+    def advance(self):
+        """
+        Runs one step, returns the `(request, score, prediction)` of the
+        examples which are done.
+        """
+        return [(self.requests.pop(b), score, prediction)
+                for b, score, prediction in self.search.advance(self.step_fn, self.reorder_fn)]
+
+    def merge(self, other):
+        # The memory is padded to the longest source, the padding is masked.
+        src_len = max(self.memory.size(1), other.memory.size(1))
+        self.memory = torch.cat([F.pad(memory, (0, 0, 0, src_len - memory.size(1)))
+                                 for memory in [self.memory, other.memory]])
+        self.mask = torch.cat([F.pad(mask, (0, src_len - mask.size(1)))
+                               for mask in [self.mask, other.mask]])
+        offset = self.search.merge(other.search)
+        for b, request in other.requests.items():
+            self.requests[b + offset] = request
+
+
+class InferenceServer(object):
+    """
+    Keeps the model resident and decodes the incoming requests.
+
+    A worker thread owns the model and a single batch in flight (see
+    :obj:`LiveBatch`). Every time the number of examples still decoding
+    drops below `-serve_max_batch`, the waiting requests are encoded and
+    merged into it after their first step, so a request does not wait for
+    the batch in flight to finish.
+    """
+
+    def __init__(self, args, predictor, tokenizer, device):
+        self.args = args
+        self.predictor = predictor
+        self.tokenizer = tokenizer
+        self.device = device
+        if self.tokenizer.cls_token_id is None:
+            self.cls_token = self.tokenizer.eos_token
+        else:
+            self.cls_token = self.tokenizer.cls_token
+        # The plan is part of the source, or of the soft prompt.
+        self.prompt_style = 'src' if args.prompt_style == 'src' else 'none'
+        self.needs_plan = (args.add_plan_to_src != 'none' or self.prompt_style == 'src'
+                           or args.ext_or_abs == 'soft_src_prompt')
+
+        self.requests = queue.Queue()
+        self.stats = LatencyStats()
+        self.num_requests = 0
+        self.lock = threading.Lock()
+        self.worker = threading.Thread(target=self.run, daemon=True)
+
+    def start(self):
+        self.worker.start()
+
+    def submit(self, src, plan=None):
+        """
+        Queues a request, `src` is the list of the source sentences.
+        """
+        with self.lock:
+            eid = str(self.num_requests)
+            self.num_requests += 1
+        request = Request(src, eid, plan)
+        self.requests.put(request)
+        return request
+
+    def make_batch(self, requests):
+        """
+        Tokenizes the requests as prepro.data_builder does.
+        """
+        data = []
+        for order, request in enumerate(requests):
+            src_txt = (' ' + self.cls_token + ' ').join(request.src)
+            if self.args.add_plan_to_src == 'hard_prompt':
+                src_txt = src_txt + ' ' + self.cls_token + ' ' + request.plan
+            elif self.args.add_plan_to_src == 'soft_prompt':
+                plan_seg_number = len(request.plan.split('|||'))
+                src_txt = src_txt + ' ' + self.cls_token + ' ||| ' + ' '.join(['-Pred-ROOT']*plan_seg_number)
+            if self.args.tokenizer_path.startswith('t5-'):
+                src_txt = self.cls_token + ' ' + src_txt
+            src = self.tokenizer(src_txt, padding='do_not_pad', truncation=True,
+                                 max_length=self.args.max_pos)['input_ids']
+            prompt_tokenized = None
+            if self.needs_plan:
+                prompt_tokenized = self.tokenizer(request.plan, padding='do_not_pad', truncation=True,
+                                                  max_length=self.args.max_tgt_len)['input_ids']
+            tgt = [self.tokenizer.eos_token_id]
+            data.append((src, tgt, len(request.src), 1, prompt_tokenized, order,
+                         request.src, [], request.plan or '', request.eid))
+        return Batch(data, self.device, is_test=True,
+                     pad_id=self.tokenizer.pad_token_id,
+                     cls_id=self.tokenizer.cls_token_id,
+                     prompt_style=self.prompt_style)
+
+    def admit(self, num_alive, block):
+        """
+        Takes as many waiting requests as there are free slots.
+        """
+        requests = []
+        while num_alive + len(requests) < self.args.serve_max_batch:
+            try:
+                requests.append(self.requests.get(block=(block and not requests), timeout=1))
+            except queue.Empty:
+                break
+        return requests
+
+    def start_cohort(self, requests):
+        """
+        Encodes new requests into a LiveBatch of their own.
+        """
+        batch = self.make_batch(requests)
+        memory, mask = self.predictor.encode(batch)
+        search = self.predictor.build_search(batch.batch_size, self.predictor.max_length,
+                                             self.predictor.min_length, memory.device)
+        search.start()
+        return LiveBatch(self.predictor, search, memory, mask, requests)
+
+    def finish_requests(self, finished):
+        end = time.time()
+        for request, score, prediction in finished:
+            pred_sent = self.tokenizer.decode(prediction, skip_special_tokens=True)
+            request.prediction = pred_sent.replace(self.cls_token, '<q>')
+            request.score = float(score)
+            request.latency = end - request.arrival
+            self.stats.add(request.latency)
+            request.done.set()
+
+    def run(self):
+        self.predictor.model.eval()
+        live = None
+        while True:
+            num_alive = live.search.num_alive if live is not None else 0
+            requests = self.admit(num_alive, block=(live is None))
+
+            cohort = None
+            if requests:
+                try:
+                    with torch.no_grad():
+                        cohort = self.start_cohort(requests)
+                        self.finish_requests(cohort.advance())
+                except Exception:
+                    # Only the new requests fail, the batch in flight goes on.
+                    logger.exception('Decoding failed for %d new requests' % len(requests))
+                    for request in requests:
+                        request.done.set()
+                    cohort = None
+
+            try:
+                with torch.no_grad():
+                    if live is not None:
+                        self.finish_requests(live.advance())
+                    if cohort is not None and cohort.search.num_alive > 0:
+                        if live is None or live.search.num_alive == 0:
+                            live = cohort
+                        else:
+                            live.merge(cohort)
+                    if live is not None and live.search.num_alive == 0:
+                        live = None
+            except Exception:
+                # Fail the requests in flight instead of leaving them hanging.
+                logger.exception('Decoding failed')
+                for batch in [live, cohort]:
+                    if batch is not None:
+                        for request in batch.requests.values():
+                            request.done.set()
+                live = None
+
+
+def _make_handler(server):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def _reply(self, code, obj):
+            body = json.dumps(obj).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/stats':
+                self._reply(200, server.stats.percentiles())
+            else:
+                self._reply(404, {'error': 'unknown path %s' % self.path})
+
+        def do_POST(self):
+            if self.path != '/translate':
+                self._reply(404, {'error': 'unknown path %s' % self.path})
+                return
+            try:
+                length = int(self.headers.get('Content-Length', 0))
+                body = json.loads(self.rfile.read(length).decode('utf-8'))
+                src = body['src']
+                if isinstance(src, str):
+                    src = [src]
+                if not isinstance(src, list) or not src or not all(isinstance(sent, str) for sent in src):
+                    raise ValueError('src must be a string or a non-empty list of strings')
+                plan = body.get('plan')
+                if server.needs_plan and not isinstance(plan, str):
+                    raise ValueError('plan must be a string')
+            except (ValueError, KeyError, TypeError) as e:
+                self._reply(400, {'error': 'bad request: %s' % e})
+                return
+            request = server.submit(src, plan if server.needs_plan else None)
+            request.done.wait()
+            if request.prediction is None:
+                self._reply(500, {'error': 'decoding failed'})
+                return
+            self._reply(200, {'eid': request.eid,
+                              'prediction': request.prediction,
+                              'score': request.score,
+                              'latency': request.latency})
+
+        def log_message(self, format, *args):
+            logger.debug(format % args)
+
+    return Handler
+
+
+def serve(args, predictor, tokenizer, device):
+    """
+    POST /translate {"src": [sentences]} returns the prediction, the
+    request also carries a "plan" string when it is part of the source,
+    GET /stats returns the latency percentiles (seconds).
+    """
+    server = InferenceServer(args, predictor, tokenizer, device)
+    server.start()
+    httpd = ThreadingHTTPServer((args.serve_host, args.serve_port), _make_handler(server))
+    logger.info('Serving on %s:%d' % (args.serve_host, args.serve_port))
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
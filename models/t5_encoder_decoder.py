@@ -62,7 +62,9 @@ class T5AttentionM(T5Attention):
 
         def shape(states):
             """projection"""
-            return states.view(batch_size, -1, self.n_heads, self.key_value_proj_dim).transpose(1, 2)
+            # The rows of the key/value states are the hypotheses, or the
+            # examples when the encoder memory is shared by the beams.
+            return states.view(states.size(0), -1, self.n_heads, self.key_value_proj_dim).transpose(1, 2)
 
         def unshape(states):
             """reshape"""
@@ -100,6 +102,16 @@ class T5AttentionM(T5Attention):
             hidden_states, self.v, key_value_states, past_key_value[1] if past_key_value is not None else None
         )
 
+        # Cross-attention over a memory shared by groups of consecutive queries
+        # (the beams of an example): the key/values have one row per group and
+        # the queries of a group are folded into the query length.
+        group_size = batch_size // key_states.shape[0]
+        if group_size > 1:
+            # (memory_batch_size, n_heads, group_size * seq_length, dim_per_head)
+            query_states = query_states.view(-1, group_size, self.n_heads, seq_length, self.key_value_proj_dim) \
+                                       .transpose(1, 2) \
+                                       .reshape(-1, self.n_heads, group_size * seq_length, self.key_value_proj_dim)
+
         # compute scores
         scores = torch.matmul(
             query_states, key_states.transpose(3, 2)
@@ -108,15 +120,21 @@ class T5AttentionM(T5Attention):
         if content_weights is not None:
             weight_format = content_weights['format']
             content_weights = content_weights['weights']
+            # With cached key/values the weights may carry only the newest rows,
+            # otherwise keep the rows of the current queries.
+            content_weights = content_weights[:, -seq_length:, :]
             if weight_format == 'hard':
                 content_weights = (1.0 - content_weights) * -1e9
-            content_weights = content_weights.unsqueeze(1).repeat(1, self.n_heads, 1, 1)
+            # (batch_size, 1, seq_length, key_length), broadcast over heads
+            content_weights = content_weights.reshape(scores.shape[0], 1, -1, key_length)
             scores += content_weights
 
         if position_bias is None:
             if not self.has_relative_attention_bias:
+                # Folded queries share one row of bias, broadcast over the queries.
+                bias_length = 1 if group_size > 1 else real_seq_length
                 position_bias = torch.zeros(
-                    (1, self.n_heads, real_seq_length, key_length), device=scores.device, dtype=scores.dtype
+                    (1, self.n_heads, bias_length, key_length), device=scores.device, dtype=scores.dtype
                 )
                 if self.gradient_checkpointing and self.training:
                     position_bias.requires_grad = True
@@ -143,7 +161,16 @@ class T5AttentionM(T5Attention):
         if layer_head_mask is not None:
             attn_weights = attn_weights * layer_head_mask
 
-        attn_output = unshape(torch.matmul(attn_weights, value_states))  # (batch_size, seq_length, dim)
+        attn_output = torch.matmul(attn_weights, value_states)
+        if group_size > 1:
+            # Unfold the queries of every group back to (batch_size, n_heads, seq_length, ...)
+            attn_output = attn_output.view(-1, self.n_heads, group_size, seq_length, self.key_value_proj_dim) \
+                                     .transpose(1, 2) \
+                                     .reshape(batch_size, self.n_heads, seq_length, self.key_value_proj_dim)
+            attn_weights = attn_weights.view(-1, self.n_heads, group_size, seq_length, key_length) \
+                                       .transpose(1, 2) \
+                                       .reshape(batch_size, self.n_heads, seq_length, key_length)
+        attn_output = unshape(attn_output)  # (batch_size, seq_length, dim)
         attn_output = self.o(attn_output)
 
         present_key_value_state = (key_states, value_states) if (self.is_decoder and use_cache) else None
@@ -363,6 +390,33 @@ class T5Stacker(T5Stack):
         self.device_map = t5_decoder.device_map
         self.gradient_checkpointing = t5_decoder.gradient_checkpointing
 
+    def reorder_cache(self, past_key_values, beam_idx, beam_size):
+        """
+        Reorders the cached key/values of every block along the batch
+        dimension. The self-attention states follow the hypotheses; the
+        cross-attention states are the same for all the beams of an example
+        (one row per hypothesis or, when the memory is shared, one row per
+        example) and are only pruned when examples are dropped.
+        """
+        num_examples = beam_idx.size(0) // beam_size
+        keep = torch.div(beam_idx.view(-1, beam_size)[:, 0], beam_size, rounding_mode='floor')
+        reordered_past = ()
+        for layer_past in past_key_values:
+            self_attn_past = tuple(state.index_select(0, beam_idx) for state in layer_past[:2])
+            cross_attn_past = ()
+            for state in layer_past[2:]:
+                shared = state.size(0) != layer_past[0].size(0)
+                memory_examples = state.size(0) if shared else state.size(0) // beam_size
+                if memory_examples != num_examples:
+                    if shared:
+                        state = state.index_select(0, keep)
+                    else:
+                        state = state.view(-1, beam_size, *state.shape[1:]).index_select(0, keep) \
+                                     .view(-1, *state.shape[1:])
+                cross_attn_past = cross_attn_past + (state,)
+            reordered_past = reordered_past + (self_attn_past + cross_attn_past,)
+        return reordered_past
+
     def forward(
         self,
         input_ids=None,
@@ -0,0 +1,23 @@
+""" Process-wide cache of the tokenizers and their special ids """
+from collections import namedtuple
+from functools import lru_cache
+
+from transformers import AutoTokenizer
+
+SpecialIds = namedtuple('SpecialIds', ['pad', 'cls', 'pred', 'obj'])
+
+
+@lru_cache(maxsize=None)
+def load_tokenizer(tokenizer_path):
+    """
+    Loads a tokenizer once per process. The instance is shared by every
+    caller, it must not be modified.
+    """
+    return AutoTokenizer.from_pretrained(tokenizer_path)
+
+
+@lru_cache(maxsize=None)
+def special_token_ids(tokenizer_path, pred_special_tok, obj_special_tok):
+    tokenizer = load_tokenizer(tokenizer_path)
+    pred_id, obj_id = tokenizer.convert_tokens_to_ids([pred_special_tok, obj_special_tok])
+    return SpecialIds(tokenizer.pad_token_id, tokenizer.cls_token_id, pred_id, obj_id)
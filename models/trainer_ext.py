@@ -8,7 +8,7 @@ from models.reporter_ext import StatisticsExt as Statistics
 from models.reporter_ext import ReportMgrExt
 from models.logging import logger
 from models.loss import ConentSelectionLossCompute
-from models.tree_reader import tree_building, headlist_to_string
+from models.tree_reader import tree_building, headlist_to_string, TreeDecoder
 
 from tool.analysis_edge import Analysis, attention_evaluation
 
@@ -91,6 +91,8 @@ class Trainer(object):
         self.loss = ConentSelectionLossCompute(self.args.sentence_modelling_for_ext)
 
         self.model_analysis = Analysis()
+        # Tree dumps of the analysis are decoded by a pool of workers.
+        self.tree_decoder = TreeDecoder(args.tree_workers, projective=(args.tree_marginal == 'projective')) if args.do_analysis else None
 
         assert grad_accum_count > 0
         # Set model in training mode.
@@ -340,7 +342,7 @@ class Trainer(object):
                         for sid in _pred_select:
                             root_selection[i][sid] = 1
 
-                    trees = tree_building(root_selection, aj_matrixes, mask, device)
+                    trees = tree_building(root_selection, aj_matrixes, mask, device, self.tree_decoder)
                     for i in range(batch.batch_size):
                         tree, height = headlist_to_string(trees[i])
                         src_list = batch.src_str[i]
@@ -355,6 +357,8 @@ class Trainer(object):
         save_selected_ids.close()
         save_trees.close()
         save_edges.close()
+        if self.tree_decoder is not None:
+            self.tree_decoder.close()
 
         return stats
 
@@ -1,6 +1,10 @@
 from typing import List, Set, Tuple, Dict
+import math
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import numpy
 import torch
+from models.projective_tree import eisner_decode
 
 def gumbel_softmax_function(scores, tau, top_k):
     top_k = int(top_k)
@@ -16,19 +20,25 @@ def gumbel_softmax_function(scores, tau, top_k):
     return ret
 
 
+def topk_mask(scores, k):
+    """
+    Hard mask of the k[b] best scores of every row, with a different k
+    per row: one sort, the ranks are compared with k and scattered back.
+    """
+    order = torch.sort(scores, dim=-1, descending=True, stable=True)[1]
+    ranks = torch.arange(scores.size(-1), device=scores.device).unsqueeze(0)
+    selected = ranks < k.view(-1, 1).to(scores.device)
+    return torch.zeros_like(selected).scatter_(-1, order, selected)
+
+
 def topn_function(scores, mask_block, top_n):
     if top_n >= 1:
         top_n = int(top_n)
         indices = torch.topk(scores, min(scores.size(1), top_n))[1]
         y_hard = torch.zeros_like(scores.contiguous()).scatter_(-1, indices, 1)
     else:
-        y_hard = []
-        nsent_selection = (mask_block.sum(dim=1) * top_n).int().tolist()
-        for b in range(len(nsent_selection)):
-            indices = torch.topk(scores[b], nsent_selection[b])[1]
-            y_h = torch.zeros_like(scores[b].contiguous()).scatter_(-1, indices, 1)
-            y_hard.append(y_h)
-        y_hard = torch.stack(y_hard)
+        nsent_selection = (mask_block.sum(dim=1) * top_n).int()
+        y_hard = topk_mask(scores, nsent_selection).to(scores.dtype)
     return y_hard
 
 
@@ -68,250 +78,228 @@ def decode_mst(energy: numpy.ndarray, length: int, has_labels: bool = True) -> T
     else:
         energy = energy[:length, :length]
         label_id_matrix = None
-    # get original score matrix
-    original_score_matrix = energy
-    # initialize score matrix to original score matrix
-    score_matrix = numpy.array(original_score_matrix, copy=True)
-
-    old_input = numpy.zeros([length, length], dtype=numpy.int32)
-    old_output = numpy.zeros([length, length], dtype=numpy.int32)
-    current_nodes = [True for _ in range(length)]
-    representatives: List[Set[int]] = []
-
-    for node1 in range(length):
-        original_score_matrix[node1, node1] = 0.0
-        score_matrix[node1, node1] = 0.0
-        representatives.append({node1})
-
-        for node2 in range(node1 + 1, length):
-            old_input[node1, node2] = node1
-            old_output[node1, node2] = node2
-
-            old_input[node2, node1] = node2
-            old_output[node2, node1] = node1
-
-    final_edges: Dict[int, int] = {}
-
-    # The main algorithm operates inplace.
-    chu_liu_edmonds(
-        length, score_matrix, current_nodes, final_edges, old_input, old_output, representatives
-    )
 
     heads = numpy.zeros([max_length], numpy.int32)
+    heads[:length] = chu_liu_edmonds(energy)
     if has_labels:
+        # The root has no head (-1): indexing the labels with it would read
+        # the label of the edge from the last node into the root, which is
+        # not in the tree. It keeps the default label, like the padding.
         head_type = numpy.ones([max_length], numpy.int32)
+        head_type[1:length] = label_id_matrix[heads[1:length], numpy.arange(1, length)]
     else:
         head_type = None
 
-    for child, parent in final_edges.items():
-        heads[child] = parent
-        if has_labels:
-            head_type[child] = label_id_matrix[parent, child]
-
     return heads, head_type
 
 
-def chu_liu_edmonds(
-    length: int,
-    score_matrix: numpy.ndarray,
-    current_nodes: List[bool],
-    final_edges: Dict[int, int],
-    old_input: numpy.ndarray,
-    old_output: numpy.ndarray,
-    representatives: List[Set[int]],):
+def decode_mst_batch(energy: numpy.ndarray, lengths) -> List[numpy.ndarray]:
     """
-    Applies the chu-liu-edmonds algorithm recursively
-    to a graph with edge weights defined by score_matrix.
-    Note that this function operates in place, so variables
-    will be modified.
+    Decodes the MST of every example of a padded batch.
     # Parameters
-    length : `int`, required.
-        The number of nodes.
-    score_matrix : `numpy.ndarray`, required.
-        The score matrix representing the scores for pairs
-        of nodes.
-    current_nodes : `List[bool]`, required.
-        The nodes which are representatives in the graph.
-        A representative at it's most basic represents a node,
-        but as the algorithm progresses, individual nodes will
-        represent collapsed cycles in the graph.
-    final_edges : `Dict[int, int]`, required.
-        An empty dictionary which will be populated with the
-        nodes which are connected in the maximum spanning tree.
-    old_input : `numpy.ndarray`, required.
-    old_output : `numpy.ndarray`, required.
-    representatives : `List[Set[int]]`, required.
-        A list containing the nodes that a particular node
-        is representing at this iteration in the graph.
+    energy : `numpy.ndarray`, required.
+        A tensor with shape (batch_size, timesteps, timesteps), `energy[b, h, c]`
+        is the score of the edge from head `h` to child `c`; node 0 is the root.
+    lengths : `List[int]`, required.
+        The number of nodes (root included) of every example.
     # Returns
-    Nothing - all variables are modified in place.
+    The heads of every example, padded to timesteps.
     """
-    # Set the initial graph to be the greedy best one.
-    parents = [-1]
-    for node1 in range(1, length):
-        parents.append(0)
-        if current_nodes[node1]:
-            max_score = score_matrix[0, node1]
-            for node2 in range(1, length):
-                if node2 == node1 or not current_nodes[node2]:
-                    continue
-
-                new_score = score_matrix[node2, node1]
-                if new_score > max_score:
-                    max_score = new_score
-                    parents[node1] = node2
-
-    # Check if this solution has a cycle.
-    has_cycle, cycle = _find_cycle(parents, length, current_nodes)
-    # If there are no cycles, find all edges and return.
-    if not has_cycle:
-        final_edges[0] = -1
-        for node in range(1, length):
-            if not current_nodes[node]:
-                continue
-
-            parent = old_input[parents[node], node]
-            child = old_output[parents[node], node]
-            final_edges[child] = parent
-        return
-
-    # Otherwise, we have a cycle so we need to remove an edge.
-    # From here until the recursive call is the contraction stage of the algorithm.
-    cycle_weight = 0.0
-    # Find the weight of the cycle.
-    index = 0
-    for node in cycle:
-        index += 1
-        cycle_weight += score_matrix[parents[node], node]
-
-    # For each node in the graph, find the maximum weight incoming
-    # and outgoing edge into the cycle.
-    cycle_representative = cycle[0]
-    for node in range(length):
-        if not current_nodes[node] or node in cycle:
-            continue
-
-        in_edge_weight = float("-inf")
-        in_edge = -1
-        out_edge_weight = float("-inf")
-        out_edge = -1
-
-        for node_in_cycle in cycle:
-            if score_matrix[node_in_cycle, node] > in_edge_weight:
-                in_edge_weight = score_matrix[node_in_cycle, node]
-                in_edge = node_in_cycle
-
-            # Add the new edge score to the cycle weight
-            # and subtract the edge we're considering removing.
-            score = (
-                cycle_weight
-                + score_matrix[node, node_in_cycle]
-                - score_matrix[parents[node_in_cycle], node_in_cycle]
-            )
-
-            if score > out_edge_weight:
-                out_edge_weight = score
-                out_edge = node_in_cycle
-
-        score_matrix[cycle_representative, node] = in_edge_weight
-        old_input[cycle_representative, node] = old_input[in_edge, node]
-        old_output[cycle_representative, node] = old_output[in_edge, node]
-
-        score_matrix[node, cycle_representative] = out_edge_weight
-        old_output[node, cycle_representative] = old_output[node, out_edge]
-        old_input[node, cycle_representative] = old_input[node, out_edge]
-
-    # For the next recursive iteration, we want to consider the cycle as a
-    # single node. Here we collapse the cycle into the first node in the
-    # cycle (first node is arbitrary), set all the other nodes not be
-    # considered in the next iteration. We also keep track of which
-    # representatives we are considering this iteration because we need
-    # them below to check if we're done.
-    considered_representatives: List[Set[int]] = []
-    for i, node_in_cycle in enumerate(cycle):
-        considered_representatives.append(set())
-        if i > 0:
-            # We need to consider at least one
-            # node in the cycle, arbitrarily choose
-            # the first.
-            current_nodes[node_in_cycle] = False
-
-        for node in representatives[node_in_cycle]:
-            considered_representatives[i].add(node)
-            if i > 0:
-                representatives[cycle_representative].add(node)
-
-    chu_liu_edmonds(
-        length, score_matrix, current_nodes, final_edges, old_input, old_output, representatives
-    )
-
-    # Expansion stage.
-    # check each node in cycle, if one of its representatives
-    # is a key in the final_edges, it is the one we need.
-    found = False
-    key_node = -1
-    for i, node in enumerate(cycle):
-        for cycle_rep in considered_representatives[i]:
-            if cycle_rep in final_edges:
-                key_node = node
-                found = True
-                break
-        if found:
-            break
-
-    previous = parents[key_node]
-    while previous != key_node:
-        child = old_output[parents[previous], previous]
-        parent = old_input[parents[previous], previous]
-        final_edges[child] = parent
-        previous = parents[previous]
+    heads_ret = []
+    for eid, length in enumerate(lengths):
+        heads = numpy.zeros([energy.shape[-1]], numpy.int32)
+        heads[:length] = chu_liu_edmonds(energy[eid, :length, :length])
+        heads_ret.append(heads)
+    return heads_ret
 
 
-def _find_cycle(
-    parents: List[int], length: int, current_nodes: List[bool]
-) -> Tuple[bool, List[int]]:
+def chu_liu_edmonds(score_matrix: numpy.ndarray) -> numpy.ndarray:
+    """
+    Maximum spanning arborescence rooted at node 0 of a dense graph,
+    `score_matrix[head, child]` being the score of an edge.
+
+    Iterative formulation on arrays (Tarjan's dense variant): cycles of
+    the greedy graph are contracted into their first node until none
+    is left, the contractions are kept on a stack and expanded in reverse
+    order. A contraction only touches the rows/columns of its cycle, so a
+    graph of n nodes is decoded in O(n^2).
+    # Returns
+    The head of every node, -1 for the root.
+    """
+    length = score_matrix.shape[0]
+    heads = numpy.full([length], -1, dtype=numpy.int64)
+    if length <= 1:
+        return heads
+
+    score_matrix = numpy.array(score_matrix, dtype=numpy.float64, copy=True)
+    numpy.fill_diagonal(score_matrix, float("-inf"))
+    # Original edge (old_input -> old_output) standing for an edge between
+    # contracted nodes.
+    old_input = numpy.repeat(numpy.arange(length)[:, None], length, axis=1)
+    old_output = numpy.repeat(numpy.arange(length)[None, :], length, axis=0)
+    current_nodes = numpy.ones([length], dtype=bool)
+    # Contracted node that every original node belongs to.
+    representatives = numpy.arange(length)
+
+    # Greedy graph: best incoming edge of every node.
+    parents = score_matrix.argmax(axis=0)
+    parents[0] = -1
+
+    contractions = []
+    while True:
+        cycle = _find_cycle(parents, current_nodes)
+        if cycle is None:
+            break
 
-    added = [False for _ in range(length)]
-    added[0] = True
-    cycle = set()
-    has_cycle = False
+        in_cycle = numpy.zeros([length], dtype=bool)
+        in_cycle[cycle] = True
+        others = numpy.nonzero(current_nodes & ~in_cycle)[0]
+        cycle_scores = score_matrix[parents[cycle], cycle]
+        cycle_weight = cycle_scores.sum()
+        cycle_representative = cycle[0]
+
+        # Best edge from the cycle to every other node.
+        in_scores = score_matrix[cycle][:, others]
+        in_edge = cycle[in_scores.argmax(axis=0)]
+        # Best edge from every other node into the cycle, breaking the
+        # cycle edge it replaces.
+        out_scores = cycle_weight + score_matrix[others][:, cycle] - cycle_scores[None, :]
+        out_edge = cycle[out_scores.argmax(axis=1)]
+
+        contractions.append((cycle, parents[cycle], representatives.copy()))
+
+        score_matrix[cycle_representative, others] = in_scores.max(axis=0)
+        old_input[cycle_representative, others] = old_input[in_edge, others]
+        old_output[cycle_representative, others] = old_output[in_edge, others]
+        score_matrix[others, cycle_representative] = out_scores.max(axis=1)
+        old_input[others, cycle_representative] = old_input[others, out_edge]
+        old_output[others, cycle_representative] = old_output[others, out_edge]
+
+        # Collapse the cycle into its first node.
+        removed = cycle[1:]
+        current_nodes[removed] = False
+        score_matrix[removed, :] = float("-inf")
+        score_matrix[:, removed] = float("-inf")
+        representatives[in_cycle[representatives]] = cycle_representative
+
+        # Only the edges into the cycle and out of it have changed.
+        children = others[others != 0]
+        parents[children[in_cycle[parents[children]]]] = cycle_representative
+        parents[cycle_representative] = score_matrix[:, cycle_representative].argmax()
+
+    nodes = numpy.nonzero(current_nodes)[0][1:]
+    heads[old_output[parents[nodes], nodes]] = old_input[parents[nodes], nodes]
+    has_head = numpy.zeros([length], dtype=bool)
+    has_head[0] = True
+    has_head[old_output[parents[nodes], nodes]] = True
+
+    # Expansion stage: inside every cycle, keep all the edges but the one
+    # into the node which received the edge from outside of the cycle.
+    for cycle, cycle_parents, cycle_members in reversed(contractions):
+        entered = numpy.zeros([length], dtype=bool)
+        entered[cycle_members[has_head]] = True
+        key_node = cycle[entered[cycle]][0]
+        in_cycle_parent = dict(zip(cycle.tolist(), cycle_parents.tolist()))
+        previous = in_cycle_parent[key_node]
+        while previous != key_node:
+            child = old_output[in_cycle_parent[previous], previous]
+            heads[child] = old_input[in_cycle_parent[previous], previous]
+            has_head[child] = True
+            previous = in_cycle_parent[previous]
+
+    return heads
+
+
+def _find_cycle(parents: numpy.ndarray, current_nodes: numpy.ndarray):
+    """
+    Returns the nodes of a cycle of the graph given by `parents`
+    (in increasing order), or None.
+    """
+    length = len(parents)
+    # 0: not visited, 1: on the current path, 2: done.
+    state = [0 if current else 2 for current in current_nodes.tolist()]
+    state[0] = 2
+    parents = parents.tolist()
     for i in range(1, length):
-        if has_cycle:
-            break
-        # don't redo nodes we've already
-        # visited or aren't considering.
-        if added[i] or not current_nodes[i]:
+        if state[i]:
             continue
-        # Initialize a new possible cycle.
-        this_cycle = set()
-        this_cycle.add(i)
-        added[i] = True
-        has_cycle = True
-        next_node = i
-        while parents[next_node] not in this_cycle:
-            next_node = parents[next_node]
-            # If we see a node we've already processed,
-            # we can stop, because the node we are
-            # processing would have been in that cycle.
-            if added[next_node]:
-                has_cycle = False
-                break
-            added[next_node] = True
-            this_cycle.add(next_node)
-
-        if has_cycle:
-            original = next_node
-            cycle.add(original)
-            next_node = parents[original]
-            while next_node != original:
-                cycle.add(next_node)
-                next_node = parents[next_node]
-            break
+        path = []
+        node = i
+        while state[node] == 0:
+            state[node] = 1
+            path.append(node)
+            node = parents[node]
+        if state[node] == 1:
+            cycle = path[path.index(node):]
+            return numpy.array(sorted(cycle))
+        for node in path:
+            state[node] = 2
+    return None
+
+
+class TreeFuture(object):
+    """
+    Heads of a batch being decoded, `result()` waits for all its chunks.
+    """
+
+    def __init__(self, futures=None, heads=None):
+        self.futures = futures
+        self.heads = heads
 
-    return has_cycle, list(cycle)
+    def result(self):
+        if self.heads is None:
+            self.heads = [heads for future in self.futures for heads in future.result()]
+        return self.heads
 
 
-def tree_building(roots, edges, mask, device):
+class TreeDecoder(object):
+    """
+    Persistent pool of worker processes decoding the MSTs of a batch.
+    The batch is split into one chunk per worker; `submit` returns at
+    once, so the caller can run the model meanwhile. With no worker the
+    trees are decoded in the calling process. Projective trees are
+    decoded with the batched Eisner algorithm on the device instead.
+    The pool is started by the first `submit` and stopped by `close`,
+    or at the end of a `with` block.
+    """
+
+    def __init__(self, num_workers=0, projective=False):
+        self.num_workers = num_workers
+        self.projective = projective
+        self.pool = None
+
+    def submit(self, energy, lengths):
+        if self.projective:
+            return TreeFuture(heads=eisner_decode(energy, lengths))
+        energy = energy.cpu().detach().numpy()
+        if self.num_workers == 0:
+            return TreeFuture(heads=decode_mst_batch(energy, lengths))
+        if self.pool is None:
+            # Workers only run numpy, spawn them so that they never touch
+            # the CUDA context of the parent.
+            self.pool = ProcessPoolExecutor(self.num_workers, mp_context=multiprocessing.get_context('spawn'))
+        chunk_size = int(math.ceil(len(lengths) / self.num_workers))
+        futures = [self.pool.submit(decode_mst_batch, energy[i:i + chunk_size], lengths[i:i + chunk_size])
+                   for i in range(0, len(lengths), chunk_size)]
+        return TreeFuture(futures=futures)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def tree_energy(roots, edges, mask, device):
+    """
+    Energy of the root and edge scores (node 0 is the root), and the
+    number of nodes of every example.
+    """
     edge_prob = edges
     #roots = roots.unsqueeze(1)
     roots = roots.transpose(1, 2)
@@ -319,37 +307,22 @@ def tree_building(roots, edges, mask, device):
     dumy_column = torch.zeros((new_matrix.size(0), new_matrix.size(1), 1)).to(device)
     new_matrix = torch.cat([dumy_column, new_matrix], dim=2)
 
-    batch_size = new_matrix.size(0)
     nsents = (torch.sum(mask, dim=1)+1).tolist()
-    matrix_npy = new_matrix.cpu().detach().numpy()
+    return new_matrix, nsents
 
-    heads_ret = []
-    for eid in range(batch_size):
-        matrix = matrix_npy[eid]
-        sent_num = nsents[eid]
-        heads, _ = decode_mst(matrix, sent_num, has_labels=False)
-        heads_ret.append(heads)
-        
-    return heads_ret
 
+def tree_building_async(roots, edges, mask, device, tree_decoder):
+    energy, nsents = tree_energy(roots, edges, mask, device)
+    return tree_decoder.submit(energy, nsents)
 
-def headlist_to_string(list_input):
 
-    def create_tree_str(cnode, childrens, string_list):
-        if cnode not in childrens:
-            # leaf
-            string_list.append('(SENT-'+str(cnode)+' )')
-            height = 1
-            return string_list, height
-        string_list.append('(SENT-'+str(cnode))
-        child_heights = []
-        for child in childrens[cnode]:
-            string_list, height = create_tree_str(child, childrens, string_list)
-            child_heights.append(height)
-        height = max(child_heights)+1
-        string_list.append(')')
-        return string_list, height
+def tree_building(roots, edges, mask, device, tree_decoder=None):
+    if tree_decoder is None:
+        tree_decoder = TreeDecoder()
+    return tree_building_async(roots, edges, mask, device, tree_decoder).result()
+
 
+def headlist_to_string(list_input):
     childrens = {}
     root = -1
     for vet in range(len(list_input)):
@@ -357,76 +330,155 @@ def headlist_to_string(list_input):
         if head == -1:
             root = vet
             continue
-        if head not in childrens:
-            childrens[head] = set()
-        childrens[head].add(vet)
+        # A set, whose iteration order is the order of the children in
+        # the dumped .trees strings.
+        childrens.setdefault(head, set()).add(vet)
 
+    # Iterative depth-first traversal, the node is closed on its second visit.
     string_list = []
-    string_list, height = create_tree_str(root, childrens, string_list)
-    return string_list, height-1
+    heights = {}
+    stack = [(root, False)]
+    while stack:
+        cnode, visited = stack.pop()
+        if cnode not in childrens:
+            # leaf
+            string_list.append('(SENT-'+str(cnode)+' )')
+            heights[cnode] = 1
+        elif visited:
+            string_list.append(')')
+            heights[cnode] = max(heights[child] for child in childrens[cnode])+1
+        else:
+            string_list.append('(SENT-'+str(cnode))
+            stack.append((cnode, True))
+            stack.extend((child, False) for child in reversed(list(childrens[cnode])))
+    return string_list, heights[root]-1
+
+
+def _num_alignments(tree):
+    if torch.is_tensor(tree):
+        return (tree.max(dim=-1)[0] + 1).clamp(min=0)
+    return torch.tensor([len(alg) for alg in tree])
+
+
+def alignments_to_matrix(tree, nsent_tgt, nsent_src, device, dtype=torch.float):
+    """
+    (batch, nsent_tgt, nsent_src) number of times every source sentence
+    is aligned to every target sentence. `tree` is a list of alignments
+    or the subtree ids of headlists_to_subtrees.
+    """
+    if torch.is_tensor(tree):
+        if tree.size(-1) < nsent_src:
+            tree = torch.nn.functional.pad(tree, (0, nsent_src - tree.size(-1)), value=-1)
+        targets = torch.arange(nsent_tgt, device=device).view(1, -1, 1)
+        matrix = tree.to(device).unsqueeze(1).eq(targets).to(dtype)
+        return matrix[:, :, :nsent_src]
+    matrix = torch.zeros((len(tree), nsent_tgt, nsent_src), dtype=dtype, device=device)
+    index = [(i, j, k) for i, alg in enumerate(tree) for j, sent_alg in enumerate(alg) for k in sent_alg]
+    if index:
+        index = torch.tensor(index, dtype=torch.long, device=device).t()
+        matrix.index_put_(tuple(index), torch.ones(index.size(1), dtype=dtype, device=device), accumulate=True)
+    return matrix
 
 
 def tree_to_content_mask(tree, mask_src_sent, mask_tgt_sent):
+    batch_size, nsent_tgt, tgt_len = mask_tgt_sent.size()
     device = mask_src_sent.device
-    tgt_len = mask_tgt_sent.size(-1)
-    cross_attn_mask = []
-    for i, alg in enumerate(tree):
-        src_sent = mask_src_sent[i]
-        tgt_sent = mask_tgt_sent[i]
-        # for each sent in tgt
-        c_mask = []
-        for j, sent_alg in enumerate(alg):
-            sent_mask = src_sent[sent_alg].sum(dim=0)
-            sent_mask = sent_mask.unsqueeze(0)
-            sent_mask = sent_mask.repeat((int(tgt_sent[j].sum()), 1))
-            c_mask.append(sent_mask)
-        c_mask = torch.cat(c_mask)
-        # padding
-        mask_padding = torch.zeros((tgt_len-c_mask.size(0), c_mask.size(1)), device=device)
-        #print (c_mask.size(), mask_padding.size())
-        c_mask = torch.cat([c_mask, mask_padding])
-        cross_attn_mask.append(c_mask)
-    return torch.stack(cross_attn_mask)
+    alg_matrix = alignments_to_matrix(tree, nsent_tgt, mask_src_sent.size(1), device, mask_src_sent.dtype)
+    # Sum of the masks of the source sentences of every target sentence.
+    sent_masks = torch.bmm(alg_matrix, mask_src_sent)
 
+    # Target sentence of every target token: the rows of a sentence follow
+    # the ones of the previous sentence, the remaining rows are padding.
+    nalg = _num_alignments(tree).to(device)
+    ntok = mask_tgt_sent.sum(dim=-1).long()
+    ntok = ntok * (torch.arange(nsent_tgt, device=device).unsqueeze(0) < nalg.unsqueeze(1))
+    sent_ends = ntok.cumsum(dim=-1)
+    positions = torch.arange(tgt_len, device=device).unsqueeze(0).expand(batch_size, tgt_len).contiguous()
+    tok_sent_ids = torch.searchsorted(sent_ends, positions, right=True)
+    covered = tok_sent_ids < nsent_tgt
 
-def tree_to_mask_list(tree, mask_src_sent):
-    cross_attn_mask = []
-    for i, alg in enumerate(tree):
-        src_sent = mask_src_sent[i]
-        # for each sent in tgt
-        c_mask = []
-        for j, sent_alg in enumerate(alg):
-            sent_mask = src_sent[sent_alg].sum(dim=0)
-            c_mask.append(sent_mask)
-        cross_attn_mask.append(c_mask)
-    return cross_attn_mask
+    tok_sent_ids = tok_sent_ids.clamp(max=nsent_tgt-1)
+    cross_attn_mask = sent_masks.gather(1, tok_sent_ids.unsqueeze(-1).expand(-1, -1, sent_masks.size(-1)))
+    return cross_attn_mask * covered.unsqueeze(-1)
 
 
-def headlist_to_alignments(headlist, length):
+def tree_to_mask_list(tree, mask_src_sent):
+    nalg = _num_alignments(tree).tolist()
+    alg_matrix = alignments_to_matrix(tree, max(nalg), mask_src_sent.size(1), mask_src_sent.device, mask_src_sent.dtype)
+    sent_masks = torch.bmm(alg_matrix, mask_src_sent)
+    return [list(sent_masks[i, :n]) for i, n in enumerate(nalg)]
+
 
-    def find_children(headlist, idx):
-        children = numpy.where(headlist == idx)[0]
-        grand_children_list = []
-        for children_idx in children:
-            grand_children_list.append(children_idx)
-            grand_children = find_children(headlist, children_idx)
-            grand_children_list.extend(grand_children)
-        return grand_children_list
-            
-    roots = numpy.where(headlist == 0)[0]
-    sub_trees = []
-    for idx in roots:
-        if idx >= length:
+def headlists_to_subtrees(heads, lengths):
+    """
+    Splits a batch of trees into the subtrees of the children of the root.
+
+    Args:
+        heads: (batch, n + 1) head of every node (padded head lists of
+            decode_mst), node 0 is the root
+        lengths: number of nodes of every example, root included
+    Returns:
+        (LongTensor, LongTensor): `(batch, n)` subtree of every sentence
+        (node - 1), in the order of the children of the root, -1 for
+        padding; `(batch,)` number of subtrees
+    """
+    if not torch.is_tensor(heads):
+        heads = torch.as_tensor(numpy.stack(heads))
+    heads = heads.long()
+    device = heads.device
+    lengths = torch.as_tensor(lengths, device=device).long().view(-1, 1)
+    batch_size, num_nodes = heads.size()
+
+    nodes = torch.arange(num_nodes, device=device).unsqueeze(0)
+    valid = (nodes < lengths) & (nodes > 0)
+    root_children = valid & heads.eq(0)
+    subtree_ids = torch.where(root_children, root_children.long().cumsum(dim=1) - 1,
+                              torch.full_like(heads, -1))
+
+    # Children of every node in CSR format, from one sort of the heads
+    # (global node ids over the batch).
+    offsets = torch.arange(batch_size, device=device).unsqueeze(1) * num_nodes
+    flat_heads = torch.where(valid, heads + offsets, torch.full_like(heads, -1)).view(-1)
+    order = torch.argsort(flat_heads, stable=True)
+    children = order[flat_heads[order] >= 0]
+    degrees = torch.bincount(flat_heads[children], minlength=batch_size * num_nodes)
+    starts = degrees.cumsum(0) - degrees
+
+    # Level-synchronous traversal: every level gives its subtree id to the
+    # children of its nodes, each node is visited once.
+    subtree_ids = subtree_ids.view(-1)
+    frontier = root_children.view(-1).nonzero(as_tuple=True)[0]
+    while frontier.numel() > 0:
+        counts = degrees[frontier]
+        parents = torch.repeat_interleave(frontier, counts)
+        if parents.numel() == 0:
             break
-        grand_children_list = find_children(headlist, idx)
-        sub_trees.append(grand_children_list+[idx])
+        first = torch.repeat_interleave(starts[frontier] - (counts.cumsum(0) - counts), counts)
+        frontier = children[first + torch.arange(parents.numel(), device=device)]
+        subtree_ids[frontier] = subtree_ids[parents]
+    subtree_ids = subtree_ids.view(batch_size, num_nodes)
+
+    return subtree_ids[:, 1:], root_children.sum(dim=1)
+
 
-    updated_sub_tress = []
-    for sub_tree in sub_trees:
-        sub_tree = [int(idx-1) for idx in sorted(sub_tree)]
-        updated_sub_tress.append(sub_tree)
+def subtrees_to_alignments(subtree_ids, nsubtrees):
+    """
+    Sentence indexes of every subtree, as lists.
+    """
+    subtree_ids = subtree_ids.tolist()
+    alignments = []
+    for ids, n in zip(subtree_ids, nsubtrees.tolist()):
+        alg = [[] for _ in range(n)]
+        for sid, tid in enumerate(ids):
+            if tid >= 0:
+                alg[tid].append(sid)
+        alignments.append(alg)
+    return alignments
 
-    return updated_sub_tress
+
+def headlist_to_alignments(headlist, length):
+    subtree_ids, nsubtrees = headlists_to_subtrees([headlist], [length])
+    return subtrees_to_alignments(subtree_ids, nsubtrees)[0]
 
 if __name__ == '__main__':
     root = [[0.1, 0.1, 0.1, 0.1, 0.1, 0.1]]
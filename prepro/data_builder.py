@@ -16,6 +16,7 @@ from multiprocess import Pool
 from transformers import AutoTokenizer
 
 from models.logging import logger
+from models.packed_dataset import write_packed_shard, INDEX_SUFFIX
 
 
 class DataCreator():
@@ -96,7 +97,10 @@ def _process(params):
 
     corpus_type, json_file, args, save_file = params
     logger.info('Processing %s' % json_file)
-    if (os.path.exists(save_file)):
+    if args.shard_format == 'packed':
+        # Packed shards are written as <prefix>.{tokens.bin,strings.bin,index.npy}
+        save_file = save_file[:-len('.pt')]
+    if (os.path.exists(save_file) or os.path.exists(save_file + INDEX_SUFFIX)):
         logger.info('Ignore %s' % save_file)
         return
 
@@ -137,7 +141,10 @@ def _process(params):
     logger.info('Saving to %s' % save_file)
     logger.info('Max src length %d' % max_src_len)
     logger.info('Max tgt length %d' % max_tgt_len)
-    torch.save(datasets, save_file)
+    if args.shard_format == 'packed':
+        write_packed_shard(datasets, save_file)
+    else:
+        torch.save(datasets, save_file)
     datasets = []
     gc.collect()
 
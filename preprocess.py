@@ -28,6 +28,7 @@ if __name__ == '__main__':
     parser.add_argument("-predicted_plan_id_path", default='')
     parser.add_argument('-log_file', default='./logs/cnndm.log')
     parser.add_argument("-shard_size", default=2000, type=int)
+    parser.add_argument("-shard_format", default='packed', type=str, choices=['packed', 'pt'])
     parser.add_argument('-max_tgt_ntokens', default=500, type=int)
     parser.add_argument('-max_src_ntokens', default=1024, type=int)
     parser.add_argument("-oracle_topn", default=-1, type=int)
@@ -0,0 +1,86 @@
+import unittest
+
+import torch
+
+from models.beam_search.blocking import KEY_BITS, NGramBlocker, RepeatTokenBlocker
+
+
+def run_blocker(blocker, sequences):
+    """
+    Feeds the sequences to the blocker token by token, as the beam search
+    does, and returns the final ban mask.
+    """
+    alive_seq = torch.tensor(sequences)
+    for step in range(1, alive_seq.size(1)):
+        select_indices = torch.arange(alive_seq.size(0))
+        blocker.update(step, select_indices, alive_seq[:, :step + 1], None)
+    return alive_seq
+
+
+def banned_tokens(mask):
+    return [row.nonzero().flatten().tolist() for row in mask]
+
+
+class NGramBlockerTest(unittest.TestCase):
+
+    def test_bans_repeated_trigram(self):
+        blocker = NGramBlocker(3, 1, 3, 'cpu')
+        alive_seq = run_blocker(blocker, [[0, 5, 6, 7, 5, 6],
+                                          [0, 5, 6, 7, 9, 6],
+                                          [0, 5, 6, 7, 5, 5]])
+        # Only the token which closes the repeated trigram (5, 6, 7) is banned.
+        self.assertEqual(banned_tokens(blocker.ban_mask(alive_seq, 10)), [[7], [], []])
+        log_probs = blocker(5, torch.zeros(3, 10), alive_seq)
+        self.assertLess(log_probs[0, 7], -1e20)
+        self.assertEqual(int((log_probs < 0).sum()), 1)
+
+    def test_several_followers(self):
+        blocker = NGramBlocker(2, 1, 1, 'cpu')
+        alive_seq = run_blocker(blocker, [[0, 4, 5, 4, 8, 2, 4]])
+        self.assertEqual(banned_tokens(blocker.ban_mask(alive_seq, 10)), [[5, 8]])
+
+    def test_nothing_to_repeat(self):
+        blocker = NGramBlocker(3, 1, 1, 'cpu')
+        alive_seq = run_blocker(blocker, [[0, 5]])
+        self.assertIsNone(blocker.ban_mask(alive_seq, 10))
+
+    def test_largest_ids(self):
+        # Ids which differ only in their high bits must not collide.
+        vocab_size = 1 << KEY_BITS
+        high, low = vocab_size - 1, (1 << (KEY_BITS - 1)) - 1
+        blocker = NGramBlocker(3, 1, 2, 'cpu')
+        alive_seq = run_blocker(blocker, [[0, high, high, 3, high, high],
+                                          [0, high, high, 3, low, high]])
+        self.assertEqual(banned_tokens(blocker.ban_mask(alive_seq, vocab_size)), [[3], []])
+
+    def test_vocabulary_too_large(self):
+        blocker = NGramBlocker(3, 1, 1, 'cpu')
+        alive_seq = run_blocker(blocker, [[0, 5, 6, 7]])
+        with self.assertRaises(AssertionError):
+            blocker.ban_mask(alive_seq, (1 << KEY_BITS) + 1)
+
+    def test_merge(self):
+        blocker = NGramBlocker(3, 1, 1, 'cpu')
+        alive_seq = run_blocker(blocker, [[0, 5, 6, 7, 5, 6]])
+        other = NGramBlocker(3, 1, 1, 'cpu')
+        other_seq = run_blocker(other, [[0, 5, 6]])
+        blocker.merge(other)
+        # The shorter history is padded with keys which never match.
+        self.assertEqual(banned_tokens(blocker.ban_mask(torch.cat([alive_seq, torch.cat(
+            [torch.zeros(1, 3, dtype=torch.long), other_seq], 1)]), 10)), [[7], []])
+
+
+class RepeatTokenBlockerTest(unittest.TestCase):
+
+    def test_bans_last_token(self):
+        blocker = RepeatTokenBlocker()
+        log_probs = blocker(1, torch.zeros(2, 10), torch.tensor([[0, 4], [0, 9]]))
+        self.assertEqual(banned_tokens(log_probs < 0), [[4], [9]])
+
+    def test_first_step(self):
+        log_probs = RepeatTokenBlocker()(0, torch.zeros(2, 10), torch.tensor([[0], [0]]))
+        self.assertFalse((log_probs < 0).any())
+
+
+if __name__ == '__main__':
+    unittest.main()
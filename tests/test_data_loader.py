@@ -0,0 +1,87 @@
+import types
+import unittest
+from unittest import mock
+
+from models import data_loader
+
+
+def make_args(**kwargs):
+    args = dict(tokenizer_path='tok', pred_special_tok='<PRED>', obj_special_tok='<OBJ>',
+                max_pos=1024, max_tgt_len=250, max_prompt_len=150,
+                batch_policy='src', max_tokens=0, test_batch_by='tgt', test_max_tokens=0,
+                num_workers=0, ext_or_abs='abs', inference_mode='abs',
+                prompt_style='none', shuffle_plan_tok=False)
+    args.update(kwargs)
+    return types.SimpleNamespace(**args)
+
+
+def make_example(i, src_len, tgt_len):
+    return {'eid': str(i), 'src': [0] + [10] * (src_len - 2) + [2],
+            'tgt': [0] + [11] * (tgt_len - 2) + [2],
+            'src_txt': ['x'], 'tgt_txt': ['y'], 'nsent_src': 1, 'nsent_tgt': 1,
+            'prompt_str': '', 'prompt_tokenized': None}
+
+
+class OversizeExampleTest(unittest.TestCase):
+    """
+    An example over the token budget on its own goes in a batch of its
+    own, the other batches stay within the budget.
+    """
+
+    def setUp(self):
+        tokenizer = types.SimpleNamespace(cls_token_id=3, cls_token='<cls>', eos_token='</s>')
+        special_ids = types.SimpleNamespace(pad=1, cls=3, pred=4, obj=5)
+        for patch in [mock.patch.object(data_loader, 'load_tokenizer', return_value=tokenizer),
+                      mock.patch.object(data_loader, 'special_token_ids', return_value=special_ids)]:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def _batches(self, args, dataset, batch_size, is_test):
+        iterator = data_loader.DataIterator(args, dataset, batch_size, is_test=is_test, shuffle=False)
+        return list(iterator.create_batches())
+
+    def test_training_budget(self):
+        # The first example and one in the middle are over the budget.
+        dataset = [make_example(0, 80, 10)] + [make_example(i, 10 + i, 6) for i in range(1, 9)] + \
+                  [make_example(9, 80, 10)] + [make_example(i, 12, 5) for i in range(10, 14)]
+        for policy in ['tokens', 'attention']:
+            args = make_args(batch_policy=policy, max_tokens=64)
+            batches = self._batches(args, dataset, 1, is_test=False)
+            self.assertTrue(all(batches))
+            self.assertEqual(sum(len(b) for b in batches), len(dataset))
+            oversize = [b for b in batches if any(len(ex[0]) == 80 for ex in b)]
+            self.assertEqual([len(b) for b in oversize], [1, 1])
+            for b in batches:
+                if b not in oversize:
+                    padded = len(b) * (max(len(ex[0]) for ex in b) + max(len(ex[1]) for ex in b))
+                    self.assertLessEqual(padded, 64)
+
+    def test_no_empty_minibatch(self):
+        args = make_args(batch_policy='tokens', max_tokens=16)
+        iterator = data_loader.DataIterator(args, [], 16, is_test=False, shuffle=False)
+        examples = [iterator.preprocess(make_example(i, n, 4), False) for i, n in enumerate([40, 6, 30])]
+        self.assertEqual([len(b) for b in iterator.batch(examples, 16)], [1, 1, 1])
+        dataset = [make_example(i, n, 4) for i, n in enumerate([40, 6, 30])]
+        self.assertEqual([len(b) for b in iterator.batch_buffer(dataset, 16)], [1, 1, 1])
+
+    def test_test_budget(self):
+        # Every example is decoded, the long sources alone.
+        dataset = [make_example(i, n, 4) for i, n in enumerate([6, 50, 8, 7, 45, 6, 9])]
+        for test_batch_by in ['src', 'src_x_tgt']:
+            args = make_args(test_batch_by=test_batch_by, test_max_tokens=32)
+            iterator = data_loader.DataIterator(args, dataset, 1, is_test=True, shuffle=False)
+            batches = list(iterator)
+            self.assertEqual(sorted(order for batch in batches for order in batch.order),
+                             list(range(len(dataset))))
+            for batch in batches:
+                if batch.src.size(1) > 32:
+                    self.assertEqual(batch.batch_size, 1)
+
+    def test_single_oversize_example(self):
+        args = make_args(batch_policy='tokens', max_tokens=16)
+        batches = self._batches(args, [make_example(0, 40, 8)], 1, is_test=False)
+        self.assertEqual([len(b) for b in batches], [1])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,117 @@
+import types
+import unittest
+
+import torch
+import torch.nn as nn
+from transformers import BartConfig, BartForConditionalGeneration, T5Config, T5ForConditionalGeneration
+
+from models.data_loader import Batch
+from models.predictor import build_predictor
+from models.server import LiveBatch
+
+PAD, BOS, EOS, CLS, VOCAB = 1, 0, 2, 3, 40
+
+
+class TinySummarizer(nn.Module):
+    """
+    The interface of AbsSummarizer used by the predictor, on a small
+    randomly initialized BART or T5.
+    """
+
+    def __init__(self, kind):
+        super(TinySummarizer, self).__init__()
+        if kind == 'bart':
+            config = BartConfig(vocab_size=VOCAB, d_model=16, encoder_layers=2, decoder_layers=2,
+                                encoder_attention_heads=2, decoder_attention_heads=2,
+                                encoder_ffn_dim=32, decoder_ffn_dim=32, max_position_embeddings=128,
+                                pad_token_id=PAD, bos_token_id=BOS, eos_token_id=EOS,
+                                decoder_start_token_id=BOS)
+            model = BartForConditionalGeneration(config)
+        else:
+            config = T5Config(vocab_size=VOCAB, d_model=16, d_kv=8, d_ff=32, num_layers=2, num_heads=2,
+                              pad_token_id=PAD, eos_token_id=EOS, decoder_start_token_id=BOS)
+            model = T5ForConditionalGeneration(config)
+        self.encoder = model.get_encoder()
+        self.decoder = model.get_decoder()
+        self.generator = nn.Sequential(nn.Linear(16, VOCAB), nn.LogSoftmax(-1))
+
+    def forward(self, src, tgt, mask_src, mask_tgt, prompt_tokenized=None, run_decoder=True):
+        memory = self.encoder(input_ids=src, attention_mask=mask_src).last_hidden_state
+        return {'encoder_outpus': memory, 'encoder_attention_mask': mask_src}
+
+
+def make_batch(srcs):
+    data = [(src, [EOS], 1, 1, None, i, ['x'], [], '', str(i)) for i, src in enumerate(srcs)]
+    return Batch(data, 'cpu', is_test=True, pad_id=PAD, cls_id=CLS)
+
+
+class MergeTest(unittest.TestCase):
+    """
+    Requests merged into the batch in flight, left-padded, are decoded as
+    if they were decoded alone.
+    """
+
+    def setUp(self):
+        generator = torch.Generator().manual_seed(0)
+        self.srcs = [[BOS] + torch.randint(8, VOCAB, (n,), generator=generator).tolist() + [EOS]
+                     for n in [5, 12, 3, 9, 14]]
+        self.tokenizer = types.SimpleNamespace(bos_token_id=BOS, eos_token_id=EOS,
+                                               cls_token_id=CLS, cls_token='<cls>')
+
+    def _predictor(self, kind, use_cache):
+        torch.manual_seed(0)
+        model = TinySummarizer(kind).eval()
+        args = types.SimpleNamespace(visible_gpus='-1', beam_size=3, test_min_length=2,
+                                     test_max_length=20, block_trigram=True,
+                                     block_repeat_tok=True, use_cache=use_cache)
+        return build_predictor(args, self.tokenizer, model)
+
+    def _live_batch(self, predictor, ids):
+        batch = make_batch([self.srcs[i] for i in ids])
+        memory, mask = predictor.encode(batch)
+        search = predictor.build_search(batch.batch_size, predictor.max_length,
+                                        predictor.min_length, memory.device)
+        search.start()
+        return LiveBatch(predictor, search, memory, mask, ids)
+
+    def _decode_merged(self, predictor, merge_step):
+        """
+        Decodes the first requests, merges the others after `merge_step`
+        steps, as InferenceServer.run does.
+        """
+        outputs = {}
+
+        def finish(finished):
+            for i, score, prediction in finished:
+                outputs[i] = (prediction.tolist(), float(score))
+
+        live = self._live_batch(predictor, [0, 1])
+        finish(live.advance())
+        for _ in range(merge_step):
+            finish(live.advance())
+        cohort = self._live_batch(predictor, [2, 3, 4])
+        finish(cohort.advance())
+        finish(live.advance())
+        live.merge(cohort)
+        while live.search.num_alive > 0:
+            finish(live.advance())
+        return outputs
+
+    def test_merge(self):
+        for kind in ['bart', 't5']:
+            for use_cache in [True, False]:
+                predictor = self._predictor(kind, use_cache)
+                with torch.no_grad():
+                    alone = []
+                    for src in self.srcs:
+                        results = predictor.translate_batch(make_batch([src]))
+                        alone.append((results['predictions'][0][0].tolist(), float(results['scores'][0][0])))
+                    for merge_step in [0, 3]:
+                        merged = self._decode_merged(predictor, merge_step)
+                        for i, (prediction, score) in enumerate(alone):
+                            self.assertEqual(merged[i][0], prediction, (kind, use_cache, merge_step, i))
+                            self.assertAlmostEqual(merged[i][1], score, places=4)
+
+
+if __name__ == '__main__':
+    unittest.main()
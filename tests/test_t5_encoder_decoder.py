@@ -0,0 +1,62 @@
+import unittest
+
+import torch
+from transformers import T5Config, T5ForConditionalGeneration
+
+from models.beam_search.processors import tile
+from models.t5_encoder_decoder import T5Stacker
+
+
+class SharedMemoryDecodingTest(unittest.TestCase):
+    """
+    The beams of an example can share one row of encoder memory: decoding
+    with the memory untiled must match decoding with the tiled memory.
+    """
+
+    def setUp(self):
+        torch.manual_seed(0)
+        config = T5Config(vocab_size=50, d_model=16, d_kv=8, d_ff=32,
+                          num_layers=2, num_heads=2, decoder_start_token_id=0)
+        model = T5ForConditionalGeneration(config)
+        self.decoder = T5Stacker(model.get_decoder()).eval()
+        self.beam_size, batch_size, src_len, tgt_len = 3, 2, 6, 5
+        self.memory = torch.randn(batch_size, src_len, 16)
+        self.mask = torch.ones(batch_size, src_len, dtype=torch.long)
+        self.mask[1, 4:] = 0
+        self.input_ids = torch.randint(1, 50, (batch_size * self.beam_size, tgt_len))
+        self.weights = (torch.rand(batch_size * self.beam_size, tgt_len, src_len) > 0.3).float()
+        self.weights[:, :, 0] = 1.0
+
+    def _decode(self, shared, use_cache, content_weights=False):
+        memory, mask = self.memory, self.mask
+        if not shared:
+            memory, mask = tile(memory, self.beam_size, dim=0), tile(mask, self.beam_size, dim=0)
+        with torch.no_grad():
+            if not use_cache:
+                weights = {'weights': self.weights, 'format': 'hard'} if content_weights else None
+                return self.decoder(input_ids=self.input_ids, encoder_hidden_states=memory,
+                                    encoder_attention_mask=mask, content_weights=weights).last_hidden_state
+            past_key_values, outputs = None, []
+            for i in range(self.input_ids.size(1)):
+                weights = {'weights': self.weights[:, i:i + 1], 'format': 'hard'} if content_weights else None
+                out = self.decoder(input_ids=self.input_ids[:, i:i + 1], encoder_hidden_states=memory,
+                                   encoder_attention_mask=mask, content_weights=weights,
+                                   past_key_values=past_key_values, use_cache=True)
+                past_key_values = out.past_key_values
+                outputs.append(out.last_hidden_state)
+            return torch.cat(outputs, dim=1)
+
+    def test_shared_memory_matches_tiled(self):
+        for use_cache in [False, True]:
+            for content_weights in [False, True]:
+                tiled = self._decode(False, use_cache, content_weights)
+                shared = self._decode(True, use_cache, content_weights)
+                self.assertTrue(torch.allclose(tiled, shared, atol=1e-5),
+                                'use_cache=%s content_weights=%s' % (use_cache, content_weights))
+
+    def test_cached_matches_full(self):
+        self.assertTrue(torch.allclose(self._decode(True, False), self._decode(True, True), atol=1e-5))
+
+
+if __name__ == '__main__':
+    unittest.main()
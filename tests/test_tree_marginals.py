@@ -0,0 +1,153 @@
+import itertools
+import unittest
+
+import torch
+
+from models.encoder import StructuredAttention
+from models.projective_tree import eisner_decode, eisner_inside, projective_marginals
+
+
+def all_trees(n, projective):
+    """
+    Head of every node (-1 for the root 0) of all the trees over the
+    sentences 1..n, the root may have several children.
+    """
+    for heads in itertools.product(range(n + 1), repeat=n):
+        heads = (-1,) + heads
+        if not all(_reaches_root(heads, c) for c in range(1, n + 1)):
+            continue
+        if projective and not all(_descends(heads, heads[c], k)
+                                  for c in range(1, n + 1)
+                                  for k in range(min(c, heads[c]) + 1, max(c, heads[c]))):
+            continue
+        yield heads
+
+
+def _reaches_root(heads, node):
+    seen = set()
+    while node != 0:
+        if node in seen or heads[node] == node:
+            return False
+        seen.add(node)
+        node = heads[node]
+    return True
+
+
+def _descends(heads, head, node):
+    while node not in (-1, head):
+        node = heads[node]
+    return node == head
+
+
+def brute_force_marginals(weight, trees):
+    """
+    Edge `[head, child]` and root marginals of the sentences, `weight(h, c)`
+    being the potential of an edge (h = 0 for the root).
+    """
+    n = len(trees[0]) - 1
+    tree_weights = torch.stack([torch.stack([weight(heads[c], c) for c in range(1, n + 1)]).prod()
+                                for heads in trees])
+    probs = tree_weights / tree_weights.sum()
+    d = torch.zeros(n, n, dtype=torch.double)
+    d0 = torch.zeros(n, dtype=torch.double)
+    for p, heads in zip(probs, trees):
+        for c in range(1, n + 1):
+            if heads[c] == 0:
+                d0[c - 1] += p
+            else:
+                d[heads[c] - 1, c - 1] += p
+    return d, d0, tree_weights
+
+
+class ProjectiveTreeTest(unittest.TestCase):
+    """
+    Eisner's inside pass, marginals and best tree against an enumeration
+    of all the projective trees, on a padded batch.
+    """
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.lengths = [1, 2, 4, 3]
+        n = max(self.lengths)
+        self.edges = torch.randn(len(self.lengths), n, n, dtype=torch.double)
+        self.roots = torch.randn(len(self.lengths), n, dtype=torch.double)
+        self.mask = torch.arange(n).unsqueeze(0) < torch.tensor(self.lengths).unsqueeze(1)
+
+    def _weight(self, b):
+        return lambda h, c: (self.roots[b, c - 1] if h == 0 else self.edges[b, h - 1, c - 1]).exp()
+
+    def test_marginals(self):
+        d, d0 = projective_marginals(self.edges, self.roots, self.mask)
+        for b, n in enumerate(self.lengths):
+            bf_d, bf_d0, _ = brute_force_marginals(self._weight(b), list(all_trees(n, projective=True)))
+            self.assertTrue(torch.allclose(d[b, :n, :n], bf_d))
+            self.assertTrue(torch.allclose(d0[b, :n], bf_d0))
+            self.assertFalse(d[b, n:].any() or d[b, :, n:].any() or d0[b, n:].any())
+
+    def test_log_partition(self):
+        n = max(self.lengths)
+        scores = self.edges.new_zeros(len(self.lengths), n + 1, n + 1)
+        scores[:, 1:, 0] = self.roots
+        scores[:, 1:, 1:] = self.edges.transpose(1, 2)
+        log_z = eisner_inside(scores, torch.tensor(self.lengths))
+        best = eisner_inside(scores, torch.tensor(self.lengths), viterbi=True)
+        for b, n in enumerate(self.lengths):
+            _, _, tree_weights = brute_force_marginals(self._weight(b), list(all_trees(n, projective=True)))
+            self.assertAlmostEqual(log_z[b].item(), tree_weights.sum().log().item())
+            self.assertAlmostEqual(best[b].item(), tree_weights.max().log().item())
+
+    def test_decode(self):
+        n = max(self.lengths)
+        energy = self.edges.new_full((len(self.lengths), n + 1, n + 1), -1e4)
+        energy[:, 0, 1:] = self.roots
+        energy[:, 1:, 1:] = self.edges
+        heads = eisner_decode(energy, [length + 1 for length in self.lengths])
+        for b, n in enumerate(self.lengths):
+            trees = list(all_trees(n, projective=True))
+            _, _, tree_weights = brute_force_marginals(self._weight(b), trees)
+            self.assertEqual(heads[b][:n + 1].tolist(), list(trees[tree_weights.argmax()]))
+            self.assertFalse(heads[b][n + 1:].any())
+
+    def test_count(self):
+        # Projective trees with several root children: 1, 3, 12, 55
+        self.assertEqual([len(list(all_trees(n, projective=True))) for n in range(1, 5)], [1, 3, 12, 55])
+
+
+class MatrixTreeTest(unittest.TestCase):
+    """
+    The LU marginals, computed by groups of documents of the same length,
+    match the torch.inverse marginals of every unpadded document and the
+    enumeration of all the trees.
+    """
+
+    def setUp(self):
+        torch.manual_seed(0)
+        self.attention = StructuredAttention(8, marginal='matrix_tree_lu')
+        self.lengths = torch.tensor([2, 4, 1, 4, 3, 0])
+        n = int(self.lengths.max())
+        # Potentials, the padding is arbitrary.
+        self.scores = torch.rand(len(self.lengths), n, n, dtype=torch.double) + 0.1
+        self.root = torch.rand(len(self.lengths), n, dtype=torch.double) + 0.1
+
+    def test_inverse(self):
+        d, d0 = self.attention._getMatrixTree_lu(self.scores, self.root, self.lengths)
+        for b, n in enumerate(self.lengths.tolist()):
+            if n > 0:
+                ref_d, ref_d0 = self.attention._getMatrixTree_multi(self.scores[b:b+1, :n, :n], self.root[b:b+1, :n])
+                self.assertTrue(torch.allclose(d[b, :n, :n], ref_d[0]))
+                self.assertTrue(torch.allclose(d0[b, :n], ref_d0[0]))
+            self.assertFalse(d[b, n:].any() or d[b, :, n:].any() or d0[b, n:].any())
+
+    def test_brute_force(self):
+        d, d0 = self.attention._getMatrixTree_lu(self.scores, self.root, self.lengths)
+        for b, n in enumerate(self.lengths.tolist()):
+            if n == 0:
+                continue
+            weight = lambda h, c: self.root[b, c - 1] if h == 0 else self.scores[b, h - 1, c - 1]
+            bf_d, bf_d0, _ = brute_force_marginals(weight, list(all_trees(n, projective=False)))
+            self.assertTrue(torch.allclose(d[b, :n, :n], bf_d))
+            self.assertTrue(torch.allclose(d0[b, :n], bf_d0))
+
+
+if __name__ == '__main__':
+    unittest.main()
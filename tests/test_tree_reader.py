@@ -0,0 +1,113 @@
+import itertools
+import unittest
+
+import numpy
+
+from models.tree_reader import chu_liu_edmonds, decode_mst, decode_mst_batch, headlist_to_string
+
+
+def brute_force_mst(score_matrix):
+    """
+    Best score over all the trees rooted at node 0, by enumeration.
+    """
+    length = score_matrix.shape[0]
+    best = float('-inf')
+    for heads in itertools.product(range(length), repeat=length - 1):
+        heads = (-1,) + heads
+        if not is_tree(heads):
+            continue
+        best = max(best, tree_score(score_matrix, heads))
+    return best
+
+
+def is_tree(heads):
+    for node in range(1, len(heads)):
+        seen = set()
+        while node != 0:
+            if node in seen or heads[node] == node:
+                return False
+            seen.add(node)
+            node = heads[node]
+    return True
+
+
+def tree_score(score_matrix, heads):
+    return sum(score_matrix[heads[c], c] for c in range(1, len(heads)))
+
+
+class ChuLiuEdmondsTest(unittest.TestCase):
+    """
+    The decoded tree is a tree rooted at node 0 with the best score.
+    """
+
+    def setUp(self):
+        self.rng = numpy.random.RandomState(0)
+
+    def _check(self, score_matrix):
+        heads = chu_liu_edmonds(score_matrix)
+        self.assertEqual(heads[0], -1)
+        self.assertTrue(is_tree(heads.tolist()))
+        self.assertAlmostEqual(tree_score(score_matrix, heads), brute_force_mst(score_matrix))
+        return heads
+
+    def test_small_graphs(self):
+        self.assertEqual(chu_liu_edmonds(numpy.zeros([1, 1])).tolist(), [-1])
+        self.assertEqual(self._check(self.rng.randn(2, 2)).tolist(), [-1, 0])
+
+    def test_random_graphs(self):
+        for _ in range(200):
+            self._check(self.rng.randn(*[self.rng.randint(3, 7)] * 2))
+
+    def test_ties(self):
+        # Few distinct scores: many cycles and equally good trees.
+        for _ in range(200):
+            length = self.rng.randint(2, 7)
+            self._check(self.rng.randint(0, 3, size=(length, length)).astype(float))
+        self._check(numpy.zeros([5, 5]))
+
+    def test_batch(self):
+        lengths = [1, 2, 5, 6, 3]
+        energy = self.rng.randn(len(lengths), 6, 6)
+        for heads, length, matrix in zip(decode_mst_batch(energy, lengths), lengths, energy):
+            self.assertEqual(heads.shape, (6,))
+            self.assertEqual(heads[:length].tolist(), chu_liu_edmonds(matrix[:length, :length]).tolist())
+            self.assertFalse(heads[length:].any())
+
+
+class DecodeMSTTest(unittest.TestCase):
+
+    def test_labels(self):
+        rng = numpy.random.RandomState(1)
+        energy = rng.randn(4, 7, 7)
+        heads, head_type = decode_mst(energy, 5)
+        self.assertEqual(heads[:5].tolist(), chu_liu_edmonds(energy.max(axis=0)[:5, :5]).tolist())
+        # The root has no head and keeps the default label, as the padding.
+        self.assertEqual(head_type[0], 1)
+        self.assertEqual(head_type[5:].tolist(), [1, 1])
+        for child in range(1, 5):
+            self.assertEqual(head_type[child], energy[:, heads[child], child].argmax())
+
+    def test_no_labels(self):
+        energy = numpy.random.RandomState(2).randn(6, 6)
+        heads, head_type = decode_mst(energy, 4, has_labels=False)
+        self.assertIsNone(head_type)
+        self.assertEqual(heads[:4].tolist(), chu_liu_edmonds(energy[:4, :4]).tolist())
+
+
+class HeadlistToStringTest(unittest.TestCase):
+
+    def test_small_tree(self):
+        self.assertEqual(headlist_to_string([2, 2, -1]),
+                         (['(SENT-2', '(SENT-0 )', '(SENT-1 )', ')'], 1))
+
+    def test_children_order(self):
+        # The children are written in the iteration order of a set, as in
+        # the existing .trees dumps: 11 before 3.
+        heads = [-1, 0, 0, 1, 0, 0, 0, 0, 0, 0, 0, 1]
+        expected = ['(SENT-0', '(SENT-1', '(SENT-11 )', '(SENT-3 )', ')'] + \
+                   ['(SENT-%d )' % i for i in [2, 4, 5, 6, 7, 8, 9, 10]] + [')']
+        self.assertEqual(headlist_to_string(heads), (expected, 2))
+
+
+if __name__ == '__main__':
+    unittest.main()
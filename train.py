@@ -7,7 +7,7 @@ import os
 import argparse
 from models.logging import init_logger
 from train_extractive import train_ext, validate_ext, test_ext
-from train_abstractive import train_abs, validate_abs, test_abs
+from train_abstractive import train_abs, validate_abs, test_abs, serve_abs
 from train_mixture import train_mix, validate_mix, test_mix
 from train_stepwise import train_stepwise, validate_stepwise, test_stepwise
 
@@ -26,7 +26,7 @@ if __name__ == '__main__':
     parser.add_argument("-tokenizer_path", default='facebook/bart-base', type=str)
     parser.add_argument("-predicates_start_from_id", default=-1, type=int)
     parser.add_argument("-downstream_task", default='d2t', type=str, choices=['d2t', 'summarization'])
-    parser.add_argument("-mode", default='train', type=str, choices=['train', 'validate', 'test'])
+    parser.add_argument("-mode", default='train', type=str, choices=['train', 'validate', 'test', 'serve'])
     parser.add_argument("-ext_or_abs", default='abs', type=str, choices=['ext', 'abs', 'mix', 'step', 'marginal_projective_tree', 'soft_src_prompt'])
     parser.add_argument("-prompt_style", default='none', type=str, choices=['none', 'src', 'tgt', 'plan_only'])
     parser.add_argument("-shuffle_plan_tok", type=str2bool, default=False)
@@ -40,6 +40,8 @@ if __name__ == '__main__':
 
     # data parameters
     parser.add_argument("-batch_size", default=140, type=int)
+    parser.add_argument("-batch_policy", default='src', type=str, choices=['src', 'tokens', 'attention'])
+    parser.add_argument("-max_tokens", default=0, type=int)
     parser.add_argument("-max_pos", default=1024, type=int)
     parser.add_argument("-max_tgt_len", default=250, type=int)
     parser.add_argument("-max_prompt_len", default=150, type=int)
@@ -61,6 +63,7 @@ if __name__ == '__main__':
     parser.add_argument("-planning_method", type=str, default='gumbel_tree', choices=['gumbel_tree', 'topk_tree', 'ground_truth', 'random', 'lead_k', 'not_lead_k', 'self_attn', 'ground_truth'])
     parser.add_argument("-ext_topn", default=3, type=float)
     parser.add_argument("-tree_info_dim", default=768, type=int)
+    parser.add_argument("-tree_marginal", default='matrix_tree', type=str, choices=['matrix_tree', 'matrix_tree_lu', 'projective'])
     parser.add_argument("-cross_attn_weight_format", default='hard', type=str, choices=['pred_selfattn', 'hard', 'soft'])
 
     # generation parameters
@@ -89,6 +92,9 @@ if __name__ == '__main__':
     parser.add_argument("-train_steps", default=1000, type=int)
     parser.add_argument("-save_checkpoint_steps", default=5, type=int)
     parser.add_argument('-seed', default=666, type=int)
+    parser.add_argument("-num_workers", default=0, type=int)
+    parser.add_argument("-prefetch_factor", default=2, type=int)
+    parser.add_argument("-pin_memory", type=str2bool, nargs='?', const=True, default=True)
     parser.add_argument('-visible_gpus', default='-1', type=str)
     parser.add_argument('-gpu_ranks', default='0', type=str)
     parser.add_argument('-master_port', default='10000', type=str)
@@ -102,14 +108,27 @@ if __name__ == '__main__':
     parser.add_argument("-test_from", default='')
     parser.add_argument("-test_start_from", default=-1, type=int)
     parser.add_argument("-test_batch_size", default=200, type=int)
+    parser.add_argument("-test_batch_by", default='tgt', type=str, choices=['tgt', 'src', 'src_x_tgt'])
+    parser.add_argument("-test_max_tokens", default=0, type=int)
     parser.add_argument("-block_trigram", type=str2bool, nargs='?', const=True, default=True)
+    parser.add_argument("-block_repeat_tok", type=str2bool, nargs='?', const=True, default=False)
+    parser.add_argument("-use_cache", type=str2bool, nargs='?', const=True, default=True)
     parser.add_argument("-select_topn", default=3, type=float)
     parser.add_argument("-test_data_source", default='test', type=str, choices=['train', 'validation', 'test'])
     parser.add_argument("-test_min_length", default=10, type=int)
     parser.add_argument("-test_max_length", default=60, type=int)
     parser.add_argument("-do_analysis", type=str2bool, nargs='?', const=True, default=False)
+    parser.add_argument("-tree_workers", default=0, type=int)
+
+    # serving parameters
+    parser.add_argument("-serve_host", default='127.0.0.1', type=str)
+    parser.add_argument("-serve_port", default=8080, type=int)
+    parser.add_argument("-serve_max_batch", default=32, type=int)
+    parser.add_argument("-add_plan_to_src", default='none', type=str, choices=['none', 'hard_prompt', 'soft_prompt'])
 
     args = parser.parse_args()
+    if args.batch_policy != 'src' and args.max_tokens <= 0:
+        parser.error('-batch_policy %s requires -max_tokens > 0' % args.batch_policy)
     args.gpu_ranks = [int(i) for i in range(len(args.visible_gpus.split(',')))]
     args.world_size = len(args.gpu_ranks)
     os.environ["CUDA_VISIBLE_DEVICES"] = args.visible_gpus
@@ -144,6 +163,8 @@ if __name__ == '__main__':
             except:
                 step = 0
             test_abs(args, device_id, cp, step)
+        if (args.mode == 'serve'):
+            serve_abs(args, device_id, args.test_from)
 
     elif args.ext_or_abs == 'mix':
         if (args.mode == 'train'):
@@ -14,7 +14,7 @@ import json
 
 import torch
 import distributed
-from transformers import AutoTokenizer
+from models.tokenizer import load_tokenizer
 from models import data_loader, model_builder
 from models.data_loader import load_dataset
 from models.loss import abs_loss, ConentSelectionLossCompute
@@ -25,11 +25,12 @@ from models.predictor_tree import build_predictor_tree
 from models.predictor_tgt_prompt import build_predictor_prompt
 from models.predictor_tgt_intersec import build_predictor_intersec
 from models.predictor_plan import build_predictor_plan
+from models.server import serve
 from models.logging import logger, init_logger
 
 model_flags = ['model_name', 'ext_or_abs', 'planning_method', 'sentence_embedding', 
                'tokenizer_path', 'predicates_start_from_id', 
-               'ext_layers', 'ext_heads', 'ext_ff_size', 'tree_info_dim',]
+               'ext_layers', 'ext_heads', 'ext_ff_size', 'tree_info_dim', 'tree_marginal',]
 
 def str2bool(v):
     if v.lower() in ('yes', 'true', 't', 'y', '1'):
@@ -165,7 +166,7 @@ def train_abs_single(args, device_id):
                                       args.batch_size, device, shuffle=True, is_test=False)
 
     # Load tokenizer
-    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path)
+    tokenizer = load_tokenizer(args.tokenizer_path)
 
     # Load model
     if args.ext_or_abs == 'marginal_projective_tree':
@@ -236,7 +237,7 @@ def validate(args, device_id, pt, step):
                                         args.batch_size, device,
                                         shuffle=False, is_test=False)
 
-    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path)
+    tokenizer = load_tokenizer(args.tokenizer_path)
     symbols = {'PAD': tokenizer.pad_token_id}
 
     if args.ext_or_abs == 'marginal_projective_tree':
@@ -273,7 +274,7 @@ def test_abs(args, device_id, pt, step):
     test_iter = data_loader.Dataloader(args, load_dataset(args, 'test', shuffle=False),
                                        args.test_batch_size, device,
                                        shuffle=False, is_test=True)
-    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path)
+    tokenizer = load_tokenizer(args.tokenizer_path)
 
     if args.ext_or_abs == 'marginal_projective_tree':
         model = MarginalProjectiveTreeSumm(args, device, tokenizer, len(tokenizer), checkpoint)
@@ -296,3 +297,32 @@ def test_abs(args, device_id, pt, step):
     predictor.translate(test_iter, step)
 
 
+
+def serve_abs(args, device_id, pt):
+    device = "cpu" if args.visible_gpus == '-1' else "cuda"
+    if (pt != ''):
+        test_from = pt
+    else:
+        test_from = args.test_from
+    logger.info('Loading checkpoint from %s' % test_from)
+
+    checkpoint = torch.load(test_from, map_location=lambda storage, loc: storage)
+    opt = vars(checkpoint['opt'])
+    for k in opt.keys():
+        if (k in model_flags):
+            setattr(args, k, opt[k])
+
+    tokenizer = load_tokenizer(args.tokenizer_path)
+    if args.ext_or_abs == 'soft_src_prompt':
+        model = SoftSrcPromptSummarizer(args, device, tokenizer, checkpoint)
+    elif args.ext_or_abs == 'abs':
+        model = AbsSummarizer(args, device, tokenizer.cls_token_id, len(tokenizer), checkpoint)
+    else:
+        raise ValueError('-mode serve does not support -ext_or_abs %s' % args.ext_or_abs)
+    model.eval()
+
+    # Requests carry the source and, if the model reads it, the plan.
+    # The modes which decode with a gold tree or target are not served.
+    predictor = build_predictor(args, tokenizer, model, logger)
+    serve(args, predictor, tokenizer, device)
+
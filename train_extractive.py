@@ -17,9 +17,9 @@ from models.data_loader import load_dataset
 from models.model_builder import ExtSummarizer
 from models.trainer_ext import build_trainer
 from models.logging import logger, init_logger
-from transformers import AutoTokenizer
+from models.tokenizer import load_tokenizer
 
-model_flags = ['hidden_size', 'ff_size', 'heads', 'inter_layers', 'encoder', 'ff_actv', 'use_interval', 'rnn_size', 'ext_or_abs']
+model_flags = ['hidden_size', 'ff_size', 'heads', 'inter_layers', 'encoder', 'ff_actv', 'use_interval', 'rnn_size', 'ext_or_abs', 'tree_marginal']
 
 
 class ErrorHandler(object):
@@ -91,7 +91,7 @@ def validate(args, device_id, pt, step):
             setattr(args, k, opt[k])
     print(args)
 
-    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path)
+    tokenizer = load_tokenizer(args.tokenizer_path)
     model = ExtSummarizer(args, device, len(tokenizer), checkpoint, args.sentence_modelling_for_ext)
     model.eval()
 
@@ -117,7 +117,7 @@ def test_ext(args, device_id, pt, step):
             setattr(args, k, opt[k])
     print(args)
 
-    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path)
+    tokenizer = load_tokenizer(args.tokenizer_path)
     model = ExtSummarizer(args, device, len(tokenizer), checkpoint, args.sentence_modelling_for_ext)
     model.eval()
 
@@ -206,7 +206,7 @@ def train_single_ext(args, device_id):
                                         args.batch_size, device, shuffle=True, is_test=False)
 
     print (args.tokenizer_path)
-    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path)
+    tokenizer = load_tokenizer(args.tokenizer_path)
     model = ExtSummarizer(args, device, len(tokenizer), checkpoint, args.sentence_modelling_for_ext)
     optim = model_builder.build_optim(args, model, checkpoint)
 
@@ -21,7 +21,7 @@ from models.model_builder import ExtAbsSummarizer
 from models.predictor import build_predictor
 from models.trainer_mix import build_trainer
 from models.logging import logger, init_logger
-from transformers import AutoTokenizer
+from models.tokenizer import load_tokenizer
 
 model_flags = ['ext_layers', 'ext_heads', 
                'ext_ff_size', 'gumbel_tau', 'tokenizer_path',]
@@ -168,7 +168,7 @@ def train_mix_single(args, device_id):
                                       args.batch_size, device, shuffle=True, is_test=False)
 
     # Create model
-    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path)
+    tokenizer = load_tokenizer(args.tokenizer_path)
     model = ExtAbsSummarizer(args, device, tokenizer.cls_token_id, checkpoint, ext_checkpoint, abs_checkpoint)
     logger.info(model)
 
@@ -237,7 +237,7 @@ def validate(args, device_id, pt, step):
                                         args.batch_size, device,
                                         shuffle=False, is_test=False)
 
-    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path)
+    tokenizer = load_tokenizer(args.tokenizer_path)
     symbols = {'PAD': tokenizer.pad_token_id}
 
     model = ExtAbsSummarizer(args, device, tokenizer.cls_token_id, checkpoint, None)
@@ -269,7 +269,7 @@ def test_mix(args, device_id, pt, step):
     test_iter = data_loader.Dataloader(args, load_dataset(args, 'test', shuffle=False),
                                        args.test_batch_size, device,
                                        shuffle=False, is_test=True)
-    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path)
+    tokenizer = load_tokenizer(args.tokenizer_path)
 
     ext_checkpoint = None
     if args.load_from_ext != '':
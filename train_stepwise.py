@@ -14,7 +14,7 @@ import json
 
 import torch
 import distributed
-from transformers import AutoTokenizer
+from models.tokenizer import load_tokenizer
 from models import data_loader, model_builder
 from models.data_loader import load_dataset
 from models.loss import abs_loss, ConentSelectionLossCompute
@@ -163,7 +163,7 @@ def train_stepwise_single(args, device_id):
         return data_loader.Dataloader(args, load_dataset(args, 'train', shuffle=True), 
                                       args.batch_size, device, shuffle=True, is_test=False)
 
-    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path)
+    tokenizer = load_tokenizer(args.tokenizer_path)
 
     model = StepAbsSummarizer(args, device, tokenizer.cls_token_id, len(tokenizer), checkpoint, abs_checkpoint)
 
@@ -235,7 +235,7 @@ def validate(args, device_id, pt, step):
                                         args.batch_size, device,
                                         shuffle=False, is_test=False)
 
-    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path)
+    tokenizer = load_tokenizer(args.tokenizer_path)
     symbols = {'PAD': tokenizer.pad_token_id}
 
     model = StepAbsSummarizer(args, device, tokenizer.cls_token_id, len(tokenizer), checkpoint, None)
@@ -267,7 +267,7 @@ def test_stepwise(args, device_id, pt, step):
     test_iter = data_loader.Dataloader(args, load_dataset(args, 'test', shuffle=False),
                                        args.test_batch_size, device,
                                        shuffle=False, is_test=True)
-    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_path)
+    tokenizer = load_tokenizer(args.tokenizer_path)
 
     model = StepAbsSummarizer(args, device, tokenizer.cls_token_id, len(tokenizer), checkpoint, None)
     model.eval()